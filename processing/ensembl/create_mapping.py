@@ -1,26 +1,135 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
-from __future__ import print_function
+from __future__ import print_function, division
 import argparse
+import logging
 import sys
-import networkx as nx
-import csv
-from six import next
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("create_mapping")
+
+
+class UnionFind(object):
+    """ Disjoint sets of string ids, that are interned to consecutive integers in the order of their first appearance
+
+    Parents are stored in a numpy array, edges are united in vectorized batches: roots of both ends are found by
+    pointer jumping (compressing paths of all visited nodes), and a larger root is hooked under a smaller one, until
+    both ends of every edge share a root. Thus, a root of every set is its earliest seen id.
+    """
+
+    def __init__(self, capacity=2 ** 20):
+        self.ids = {}
+        self.parent = np.arange(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, names):
+        """ Integer ids of names, new names get the next free ids """
+        ids = self.ids
+        result = np.fromiter((ids.setdefault(name, len(ids)) for name in names), dtype=np.int64, count=len(names))
+        if len(ids) > len(self.parent):
+            capacity = max(len(ids), 2 * len(self.parent))
+            self.parent = np.concatenate([self.parent, np.arange(len(self.parent), capacity, dtype=np.int64)])
+        return result
+
+    def find(self, nodes):
+        """ Roots of nodes, paths of all nodes are compressed on the way """
+        roots = self.parent[nodes]
+        while True:
+            grand_parents = self.parent[roots]
+            if np.array_equal(grand_parents, roots):
+                break
+            roots = grand_parents
+        self.parent[nodes] = roots
+        return roots
+
+    def union(self, nodes1, nodes2):
+        """ Unites sets of nodes1[k] and nodes2[k] for every k """
+        while len(nodes1) > 0:
+            roots1, roots2 = self.find(nodes1), self.find(nodes2)
+            different = roots1 != roots2
+            nodes1, nodes2, roots1, roots2 = nodes1[different], nodes2[different], roots1[different], roots2[different]
+            np.minimum.at(self.parent, np.maximum(roots1, roots2), np.minimum(roots1, roots2))
+
+    def components(self):
+        """ Names of all ids (in the order of their first appearance) and the number of a set of every id
+
+        Sets are numbered in the order of the first appearance of their ids.
+        """
+        parent = self.parent[:len(self.ids)]
+        while True:
+            grand_parents = parent[parent]
+            if np.array_equal(grand_parents, parent):
+                break
+            parent = grand_parents
+        roots = np.flatnonzero(parent == np.arange(len(parent)))
+        names = [None] * len(self.ids)
+        for name, index in self.ids.items():
+            names[index] = name
+        return names, np.searchsorted(roots, parent)
+
+
+def read_edges(source, separator, skip_header=True, chunk_size=1000000):
+    """ Yields chunks of (first id, second id) columns of a mapping file
+
+    :param source: path to a mapping file (plain or compressed, compression is inferred from the extension), "-" for stdin
+    :param separator: columns separator
+    :param skip_header: whether the first line is a header
+    :param chunk_size: number of rows to read at a time
+    """
+    reader = pd.read_csv(sys.stdin if source == "-" else source, sep=separator, header=None, usecols=[0, 1], dtype=str, keep_default_na=False,
+                         skiprows=1 if skip_header else 0, chunksize=chunk_size, compression="infer", engine="c" if len(separator) == 1 else "python",
+                         quoting=3)
+    for chunk in reader:
+        yield chunk[0].values, chunk[1].values
+
+
+def build_components(sources, separators, skip_header=True, chunk_size=1000000):
+    """ Unites ids of every row of all mapping files, empty ids are ignored (a row with a single id makes it a singleton)
+
+    :return: UnionFind instance
+    """
+    union_find = UnionFind()
+    for source, separator in zip(sources, separators):
+        rows_cnt = 0
+        for names1, names2 in read_edges(source, separator=separator, skip_header=skip_header, chunk_size=chunk_size):
+            names = np.column_stack([names1, names2]).ravel()
+            known = names != ""
+            nodes = np.full(len(names), -1, dtype=np.int64)
+            nodes[known] = union_find.intern(names[known])
+            nodes = nodes.reshape(-1, 2)
+            both = (nodes >= 0).all(axis=1)
+            union_find.union(nodes[both, 0], nodes[both, 1])
+            rows_cnt += len(names1)
+        logger.info("Read {r_cnt} rows from {source}, {n_cnt} unique ids so far".format(r_cnt=rows_cnt, source=source, n_cnt=len(union_find)))
+    return union_find
+
+
+def write_components(union_find, dest):
+    """ Writes "id<TAB>component number" lines, grouped by component, ids are in the order of their first appearance within a component """
+    names, components = union_find.components()
+    for index in np.argsort(components, kind="mergesort").tolist():
+        print(names[index], components[index], sep="\t", file=dest)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("mapping", nargs="+", type=argparse.FileType("rt"), default=sys.stdin)
+    parser.add_argument("mapping", nargs="+", type=str, help="Mapping files (plain or compressed), \"-\" for stdin")
     parser.add_argument("-o", "--output", default=sys.stdout, type=argparse.FileType("wt"))
     parser.add_argument("--skip_header", action="store_true", default=False)
-    parser.add_argument("--separator", default="\t")
+    parser.add_argument("--separator", nargs="+", default=["\t"], help="Either a single separator for all mapping files, or one per mapping file")
+    parser.add_argument("--chunk-size", type=int, default=1000000, help="Number of mapping rows to read at a time")
+    parser.add_argument("--logging", type=int, choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL], default=logging.INFO)
     args = parser.parse_args()
-    graph = nx.Graph()
-    for input_file in args.mapping:
-        reader = csv.reader(input_file, delimiter=args.separator)
-        next(reader)
-        for row in reader:
-            graph.add_edge(row[0], row[1])
-
-    for cnt, cc in enumerate(nx.connected_component_subgraphs(graph)):
-        for node in cc:
-            print(node, cnt, file=args.output)
+    if len(args.separator) not in (1, len(args.mapping)):
+        parser.error("Either a single --separator, or one per mapping file is expected")
+    logging.basicConfig(level=args.logging,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    logger.setLevel(args.logging)
+    separators = args.separator * len(args.mapping) if len(args.separator) == 1 else args.separator
+    union_find = build_components(args.mapping, separators, skip_header=args.skip_header, chunk_size=args.chunk_size)
+    write_components(union_find, args.output)
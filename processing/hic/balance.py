@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import logging
+import os
+
+import numpy as np
+from scipy import sparse
+
+from hic_dump import get_cache_key, is_stale, load_contacts, read_header, write_arrays
+
+logger = logging.getLogger("balance")
+
+METHODS = ["VC", "VC_SQRT", "ICE", "KR"]
+BIAS_MAGIC = b"HICBIAS1"
+
+# bias vectors, computed (or loaded) in this process, keyed by (source, chromosome, method, bin size)
+_biases = {}
+
+
+def symmetric_matrix(rows, columns, values, bin_size):
+    """ Full symmetric (bins x bins) CSR matrix of intra chromosomal records, that store a single triangle of the matrix """
+    rows, columns = np.asarray(rows) // bin_size, np.asarray(columns) // bin_size
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    rows, columns, values = rows[known], columns[known], values[known]
+    bins_cnt = int(max(rows.max(), columns.max())) + 1 if len(rows) > 0 else 0
+    off_diagonal = rows != columns
+    return sparse.csr_matrix((np.concatenate([values, values[off_diagonal]]),
+                              (np.concatenate([rows, columns[off_diagonal]]), np.concatenate([columns, rows[off_diagonal]]))),
+                             shape=(bins_cnt, bins_cnt))
+
+
+def _vc(matrix, max_iter=None, tolerance=None):
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+
+def _vc_sqrt(matrix, max_iter=None, tolerance=None):
+    return np.sqrt(_vc(matrix))
+
+
+def _ice(matrix, max_iter=200, tolerance=1e-5):
+    """ Iterative correction: biases are repeatedly multiplied by the (mean normalized) coverage of the corrected matrix """
+    coverage = _vc(matrix)
+    covered = coverage > 0
+    bias = np.ones(matrix.shape[0], dtype=np.float64)
+    for iteration in range(max_iter):
+        inverse = np.where(covered, 1.0 / bias, 0.0)
+        corrected_coverage = inverse * matrix.dot(inverse)
+        corrected_coverage /= corrected_coverage[covered].mean()
+        corrected_coverage[~covered] = 1.0
+        bias *= corrected_coverage
+        if np.abs(corrected_coverage[covered] - 1.0).max() < tolerance:
+            logger.debug("ICE converged in {i_cnt} iterations".format(i_cnt=iteration + 1))
+            return bias
+    logger.warning("ICE did not converge in {i_cnt} iterations".format(i_cnt=max_iter))
+    return bias
+
+
+def _kr(matrix, max_iter=1000, tolerance=1e-6, delta=0.1, upper_delta=3.0):
+    """ Knight-Ruiz matrix balancing (Knight, Ruiz, "A fast algorithm for matrix balancing", 2013)
+
+    Finds x, such that diag(x) * A * diag(x) is doubly stochastic, with an inexact Newton method and inner conjugate gradient iterations.
+    Rows without any contacts are excluded from balancing.
+
+    :return: bias 1 / x
+    """
+    covered = _vc(matrix) > 0
+    bias = np.full(matrix.shape[0], np.nan)
+    a = matrix[covered][:, covered].tocsr()
+    ones = np.ones(a.shape[0], dtype=np.float64)
+    x = ones.copy()
+    g, eta_max = 0.9, 0.1
+    eta, stop_tolerance, residual_tolerance = eta_max, tolerance * 0.5, tolerance ** 2
+    v = x * a.dot(x)
+    rk = 1.0 - v
+    rho_km1 = rk.dot(rk)
+    residual = residual_old = rho_km1
+    iteration = 0
+    while residual > residual_tolerance:
+        iteration += 1
+        if iteration > max_iter:
+            raise ValueError("Knight-Ruiz balancing did not converge in {i_cnt} iterations".format(i_cnt=max_iter))
+        k, y, rho_km2 = 0, ones.copy(), rho_km1
+        inner_tolerance = max(eta ** 2 * residual, residual_tolerance)
+        while rho_km1 > inner_tolerance:
+            k += 1
+            if k == 1:
+                z = rk / v
+                p = z
+                rho_km1 = rk.dot(z)
+            else:
+                p = z + rho_km1 / rho_km2 * p
+            w = x * a.dot(x * p) + v * p
+            alpha = rho_km1 / p.dot(w)
+            ap = alpha * p
+            y_new = y + ap
+            if y_new.min() <= delta:
+                decreasing = ap < 0
+                y = y + ((delta - y[decreasing]) / ap[decreasing]).min() * ap
+                break
+            if y_new.max() >= upper_delta:
+                increasing = y_new > upper_delta
+                y = y + ((upper_delta - y[increasing]) / ap[increasing]).min() * ap
+                break
+            y = y_new
+            rk = rk - alpha * w
+            rho_km2 = rho_km1
+            z = rk / v
+            rho_km1 = rk.dot(z)
+        x = x * y
+        v = x * a.dot(x)
+        rk = 1.0 - v
+        rho_km1 = rk.dot(rk)
+        residual, ratio = rho_km1, rho_km1 / residual_old
+        residual_old = residual
+        eta_old, eta = eta, g * ratio
+        if g * eta_old ** 2 > 0.1:
+            eta = max(eta, g * eta_old ** 2)
+        eta = max(min(eta, eta_max), stop_tolerance / np.sqrt(residual))
+    logger.debug("Knight-Ruiz balancing converged in {i_cnt} iterations".format(i_cnt=iteration))
+    bias[covered] = 1.0 / x
+    return bias
+
+
+_METHODS = {"VC": _vc, "VC_SQRT": _vc_sqrt, "ICE": _ice, "KR": _kr}
+
+
+def compute_bias(matrix, method, max_iter=None, tolerance=None):
+    """ Bias vector of a symmetric contacts matrix, balanced values are A[i, j] / (bias[i] * bias[j])
+
+    Bias is scaled (as in Juicer), so that the total of the balanced matrix equals the total of the observed one,
+    bins without any contacts get a NaN bias.
+
+    :param matrix: symmetric (bins x bins) sparse matrix of raw contacts (see symmetric_matrix)
+    :param method: one of VC, VC_SQRT, ICE, KR
+    :param max_iter: maximum number of iterations of iterative methods
+    :param tolerance: convergence tolerance of iterative methods
+    :return: numpy array of biases, one per bin
+    """
+    options = {name: value for name, value in (("max_iter", max_iter), ("tolerance", tolerance)) if value is not None}
+    bias = _METHODS[method](matrix, **options).astype(np.float64)
+    bias[~(bias > 0)] = np.nan
+    if matrix.nnz > 0:
+        inverse = np.nan_to_num(1.0 / bias)
+        balanced_total = inverse.dot(matrix.dot(inverse))
+        if balanced_total > 0:
+            bias *= np.sqrt(balanced_total / matrix.sum())
+    return bias
+
+
+def get_bias_path(dump_path, method, bin_size):
+    return "{path}.{bin_size}.{method}.bias".format(path=dump_path, bin_size=bin_size, method=method)
+
+
+def read_bias(bias_path, key=None):
+    """ :return: bias vector from a sidecar file, or None, if it is missing or was computed from a different dump """
+    result = read_header(bias_path, BIAS_MAGIC)
+    if result is None:
+        return None
+    header, offset = result
+    if is_stale(header, key):
+        return None
+    return np.fromfile(bias_path, dtype="<f8", count=header["bins_cnt"], offset=offset)
+
+
+def load_dump_bias(dump_path, method, bin_size, dump_bin_size=None, use_cache=True):
+    """ Bias vector of a chromosome, computed from its raw intra chromosomal dump, and cached next to it
+
+    :param dump_path: path to a raw (NONE) intra chromosomal dump
+    :param method: one of VC, VC_SQRT, ICE, KR
+    :param bin_size: resolution (a coarser one, than the dump resolution, is aggregated, see hic_dump.load_dump_resolution)
+    :param dump_bin_size: resolution of the dump, if known
+    :param use_cache: whether to use (and store) the sidecar bias file
+    """
+    memo_key = (os.path.abspath(dump_path), None, method, bin_size)
+    if memo_key in _biases:
+        return _biases[memo_key]
+    bias_path = get_bias_path(dump_path, method, bin_size)
+    key = dict(get_cache_key(dump_path), method=method, bin_size=bin_size)
+    bias = read_bias(bias_path, key=key) if use_cache else None
+    if bias is None:
+        logger.info("Computing {method} bias of {dump} at resolution {bin_size}".format(method=method, dump=dump_path, bin_size=bin_size))
+        rows, columns, values = load_contacts(dump_path, bin_size=bin_size, use_cache=use_cache, dump_bin_size=dump_bin_size)
+        bias = compute_bias(symmetric_matrix(rows, columns, values, bin_size), method)
+        if use_cache:
+            try:
+                write_arrays(bias_path, BIAS_MAGIC, dict(key, bins_cnt=len(bias)), [bias.astype("<f8")])
+            except (IOError, OSError) as error:
+                logger.warning("Could not write bias {bias}: {error}".format(bias=bias_path, error=error))
+    _biases[memo_key] = bias
+    return bias
+
+
+def load_hic_bias(hic_path, chromosome, method, bin_size):
+    """ Bias vector of a chromosome, computed from raw intra chromosomal contacts of a .hic file or a genome store (cached in this process only) """
+    memo_key = (os.path.abspath(hic_path), chromosome, method, bin_size)
+    if memo_key not in _biases:
+        logger.info("Computing {method} bias of chromosome {chromosome} at resolution {bin_size}".format(method=method, chromosome=chromosome,
+                                                                                                      bin_size=bin_size))
+        rows, columns, values = load_contacts(hic_path, chromosomes=(chromosome, chromosome), bin_size=bin_size)
+        _biases[memo_key] = compute_bias(symmetric_matrix(rows, columns, values, bin_size), method)
+    return _biases[memo_key]
+
+
+def get_intra_dump_paths(dump_path):
+    """ Intra chromosomal dumps of both chromosomes of a dump, named as "cell-line_chr1_chr2_resolution_correction.txt"
+
+    Dumps, that are not named after this template, are considered intra chromosomal.
+    """
+    directory, name = os.path.split(dump_path)
+    parts = name.split("_")
+    if len(parts) != 5 or parts[1] == parts[2]:
+        return dump_path, dump_path
+    if parts[4].split(".")[0] != "NONE":
+        logger.warning("Dump {dump} does not seem to be raw (NONE), balancing it anyway".format(dump=dump_path))
+    return tuple(os.path.join(directory, "_".join([parts[0], chromosome, chromosome] + parts[3:])) for chromosome in parts[1:3])
+
+
+def balance_values(rows, columns, values, bin_size, bias1, bias2):
+    """ Balanced values of records, values of records in bins without a bias (no coverage) are NaN """
+    rows, columns = np.asarray(rows) // bin_size, np.asarray(columns) // bin_size
+    bias1 = np.append(bias1, np.nan)[np.minimum(rows, len(bias1))]
+    bias2 = np.append(bias2, np.nan)[np.minimum(columns, len(bias2))]
+    return np.asarray(values, dtype=np.float64) / (bias1 * bias2)
+
+
+def balance_dump_records(dump_path, rows, columns, values, bin_size, method, dump_bin_size=None, use_cache=True):
+    """ Balances raw records of a dump with bias vectors of its chromosomes (see load_dump_bias) """
+    path1, path2 = get_intra_dump_paths(dump_path)
+    for path in {path1, path2}:
+        if not os.path.exists(path):
+            raise ValueError("Intra chromosomal dump {path} is required for {method} balancing of {dump}".format(path=path, method=method,
+                                                                                                                 dump=dump_path))
+    bias1 = load_dump_bias(path1, method, bin_size, dump_bin_size=dump_bin_size, use_cache=use_cache)
+    bias2 = bias1 if path2 == path1 else load_dump_bias(path2, method, bin_size, dump_bin_size=dump_bin_size, use_cache=use_cache)
+    return rows, columns, balance_values(rows, columns, values, bin_size, bias1, bias2)
+
+
+def balance_hic_records(hic_path, chromosomes, rows, columns, values, bin_size, method):
+    """ Balances raw records of a .hic file (or a genome store) with bias vectors of its chromosomes (see load_hic_bias) """
+    bias1 = load_hic_bias(hic_path, chromosomes[0], method, bin_size)
+    bias2 = load_hic_bias(hic_path, chromosomes[1], method, bin_size)
+    return rows, columns, balance_values(rows, columns, values, bin_size, bias1, bias2)
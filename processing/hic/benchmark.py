@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from bgzf import BgzfWriter
+from frag_matrix import compute_frag_matrix, load_hic_data
+from fragment_catalog import load_fragment_catalog
+from metrics import Metrics
+from sparse_to_tsv import read_hic_export, write_dense
+
+logger = logging.getLogger("benchmark")
+
+# synthetic inputs of every scale: chromosome length, dump resolution, number of sampled read pairs,
+# median fragment length and whether a dense sparse_to_tsv matrix is small enough to be written
+SCALES = {
+    "small": {"length": 10000000, "bin_size": 5000, "read_pairs": 200000, "fragment_length": 20000, "dense_output": True},
+    "medium": {"length": 50000000, "bin_size": 5000, "read_pairs": 2000000, "fragment_length": 50000, "dense_output": False},
+    "chr1": {"length": 248956422, "bin_size": 5000, "read_pairs": 20000000, "fragment_length": 100000, "dense_output": False},
+}
+DECAY_EXPONENT = 1.08
+CHROMOSOME = "1"
+
+
+def generate_dump(path, length, bin_size, read_pairs, decay_exponent=DECAY_EXPONENT, seed=0):
+    """ Writes a synthetic intra chromosomal Juicer dump with a power-law contact probability decay
+
+    Read pairs are sampled with a uniformly distributed first bin and a bin distance d with a probability
+    proportional to (d + 1) ^ -decay_exponent, and are then counted per pair of bins.
+
+    :param path: output path, named as "cell-line_chr1_chr2_resolution_correction.txt" for frag_matrix
+    :param length: chromosome length
+    :param bin_size: dump resolution
+    :param read_pairs: number of sampled read pairs
+    :param decay_exponent: exponent of the contact probability decay with distance
+    :param seed: random seed
+    :return: number of written records
+    """
+    random = np.random.RandomState(seed)
+    bins_cnt = (length + bin_size - 1) // bin_size
+    distances_probabilities = np.arange(1, bins_cnt + 1, dtype=np.float64) ** -decay_exponent
+    distances_probabilities /= distances_probabilities.sum()
+    rows = random.randint(0, bins_cnt, size=read_pairs).astype(np.int64)
+    columns = rows + random.choice(bins_cnt, size=read_pairs, p=distances_probabilities)
+    inside = columns < bins_cnt
+    keys, counts = np.unique(rows[inside] * bins_cnt + columns[inside], return_counts=True)
+    pd.DataFrame({"rows": keys // bins_cnt * bin_size, "columns": keys % bins_cnt * bin_size, "values": counts.astype(np.float64)}).to_csv(
+        path, sep="\t", header=False, index=False, columns=["rows", "columns", "values"])
+    return len(keys)
+
+
+def generate_fragments(path, length, fragment_length, chromosome=CHROMOSOME, seed=0):
+    """ Writes synthetic fragments, that are separated by gaps, with log-normally distributed lengths (median fragment_length)
+
+    :return: number of written fragments
+    """
+    random = np.random.RandomState(seed)
+    expected_cnt = 2 * length // fragment_length + 1
+    lengths = np.maximum(random.lognormal(np.log(fragment_length), 1.0, size=expected_cnt).astype(np.int64), 1)
+    gaps = random.lognormal(np.log(fragment_length), 1.0, size=expected_cnt).astype(np.int64)
+    starts = np.cumsum(gaps + np.concatenate([[0], lengths[:-1]]))
+    ends = starts + lengths
+    inside = ends <= length
+    with open(path, "wt") as dest:
+        for index, (start, end) in enumerate(zip(starts[inside].tolist(), ends[inside].tolist())):
+            print("frag_{chromosome}_{index}".format(chromosome=chromosome, index=index), start, end, chromosome, sep="\t", file=dest)
+    return int(inside.sum())
+
+
+def prepare_inputs(work_dir, scale, seed=0):
+    """ Generates (or reuses previously generated) synthetic inputs of a scale
+
+    :return: paths to the dump and to the fragments file
+    """
+    settings = SCALES[scale]
+    dump_path = os.path.join(work_dir, "synthetic-{scale}_{chr}_{chr}_{bin_size}_NONE.txt".format(scale=scale, chr=CHROMOSOME, bin_size=settings["bin_size"]))
+    fragments_path = os.path.join(work_dir, "synthetic-{scale}_fragments.txt".format(scale=scale))
+    if not os.path.exists(dump_path):
+        logger.info("Generating a synthetic dump {path}".format(path=dump_path))
+        records_cnt = generate_dump(dump_path + ".tmp", length=settings["length"], bin_size=settings["bin_size"], read_pairs=settings["read_pairs"],
+                                    seed=seed)
+        os.rename(dump_path + ".tmp", dump_path)
+        logger.info("Generated {r_cnt} records".format(r_cnt=records_cnt))
+    if not os.path.exists(fragments_path):
+        fragments_cnt = generate_fragments(fragments_path, length=settings["length"], fragment_length=settings["fragment_length"], seed=seed)
+        logger.info("Generated {f_cnt} fragments in {path}".format(f_cnt=fragments_cnt, path=fragments_path))
+    # fragments catalog is built once, so that runs time loading it, as frag_matrix does it
+    load_fragment_catalog(fragments_path)
+    return dump_path, fragments_path
+
+
+def run_stages(dump_path, fragments_path, settings, measure, contact):
+    """ Runs frag_matrix and sparse_to_tsv stages on synthetic inputs, every stage gets timed separately
+
+    frag_matrix stages (fragment_filter to output) are the ones of compute_frag_matrix, writing to /dev/null.
+
+    :return: dict of stage name -> metrics (see metrics.Metrics)
+    """
+    metrics = Metrics()
+    step = settings["bin_size"]
+    with metrics.stage("parse", items="hic_records") as counts:
+        counts["hic_records"] = load_hic_data(dump_path, step=step, use_cache=False).nnz
+    load_hic_data(dump_path, step=step, use_cache=True)
+    with metrics.stage("cached_load", items="hic_records") as counts:
+        counts["hic_records"] = load_hic_data(dump_path, step=step, use_cache=True).nnz
+    with metrics.stage("fragments_load", items="fragments") as counts:
+        fragments = load_fragment_catalog(fragments_path)
+        counts["fragments"] = len(fragments)
+    with open(os.devnull, "wt") as dest:
+        compute_frag_matrix(hic=dump_path, fragments=fragments, fragments_filename=fragments_path, output=dest, measure=measure, contact=contact,
+                            metrics=metrics)
+    with metrics.stage("tsv_read", items="hic_records") as counts:
+        export = read_hic_export(dump_path, step=step)
+        counts["hic_records"] = len(export.values)
+    if settings["dense_output"]:
+        with metrics.stage("tsv_write", items="cells") as counts:
+            with BgzfWriter(os.devnull, threads=multiprocessing.cpu_count()) as dest:
+                write_dense(export=export, dest=dest)
+            counts["cells"] = export.shape[0] * export.shape[1]
+    return metrics.stages
+
+
+def _run_stages_process(arguments):
+    logging.getLogger().setLevel(logging.WARNING)
+    # synthetic fragments are often shorter than 2 bins, frag_matrix warns about every such one
+    logging.getLogger("frag_matrix").setLevel(logging.ERROR)
+    return run_stages(*arguments)
+
+
+def run_benchmark(work_dir, scales, repeats=3, measure="inner", contact="matrix", seed=0):
+    """ Runs all stages on every scale repeats times, every repeat in a fresh process, so that peak RSS is per scale
+
+    :return: json serializable results: environment, scales settings and per stage metrics (best wall and CPU times of all repeats)
+    """
+    result = {"date": datetime.datetime.now().isoformat(), "python": platform.python_version(), "platform": platform.platform(),
+              "numpy": np.__version__, "scipy": scipy.__version__, "pandas": pd.__version__, "measure": measure, "contact": contact,
+              "repeats": repeats, "scales": {}}
+    for scale in scales:
+        dump_path, fragments_path = prepare_inputs(work_dir, scale, seed=seed)
+        repeats_stages = []
+        for repeat in range(repeats):
+            logger.info("Running scale {scale}, repeat {repeat}".format(scale=scale, repeat=repeat + 1))
+            pool = multiprocessing.Pool(1)
+            try:
+                repeats_stages.append(pool.apply(_run_stages_process, ((dump_path, fragments_path, SCALES[scale], measure, contact),)))
+            finally:
+                pool.terminate()
+        stages = {}
+        for name in repeats_stages[0]:
+            best = min((stages_metrics[name] for stages_metrics in repeats_stages), key=lambda metrics: metrics["wall"])
+            stages[name] = dict(best, cpu=min(stages_metrics[name]["cpu"] for stages_metrics in repeats_stages))
+        result["scales"][scale] = {"settings": SCALES[scale], "stages": stages}
+    return result
+
+
+def compare_results(current, baseline, tolerance=0.2, min_seconds=0.05):
+    """ Flags stages, that got slower (wall time) or hungrier (peak RSS) than in the baseline by more than tolerance
+
+    Wall time differences smaller than min_seconds are considered noise.
+
+    :return: list of (scale, stage, metric, baseline value, current value) regressions
+    """
+    regressions = []
+    for scale, scale_result in sorted(current["scales"].items()):
+        if scale not in baseline["scales"]:
+            logger.warning("Scale {scale} is missing in the baseline".format(scale=scale))
+            continue
+        baseline_stages = baseline["scales"][scale]["stages"]
+        for stage, metrics in sorted(scale_result["stages"].items()):
+            if stage not in baseline_stages:
+                continue
+            baseline_metrics = baseline_stages[stage]
+            if metrics["wall"] > baseline_metrics["wall"] * (1 + tolerance) and metrics["wall"] - baseline_metrics["wall"] > min_seconds:
+                regressions.append((scale, stage, "wall", baseline_metrics["wall"], metrics["wall"]))
+            if metrics["peak_rss_mb"] > baseline_metrics["peak_rss_mb"] * (1 + tolerance):
+                regressions.append((scale, stage, "peak_rss_mb", baseline_metrics["peak_rss_mb"], metrics["peak_rss_mb"]))
+    return regressions
+
+
+def print_results(result, baseline=None, dest=sys.stdout):
+    print("scale", "stage", "wall", "cpu", "peak_rss_mb", "throughput", "baseline_wall", sep="\t", file=dest)
+    for scale, scale_result in sorted(result["scales"].items()):
+        for stage, metrics in sorted(scale_result["stages"].items()):
+            baseline_wall = ""
+            if baseline is not None and stage in baseline["scales"].get(scale, {}).get("stages", {}):
+                baseline_wall = "{wall:.3f}".format(wall=baseline["scales"][scale]["stages"][stage]["wall"])
+            throughput = "" if metrics["throughput"] is None else "{throughput:.0f}".format(throughput=metrics["throughput"])
+            print(scale, stage, "{wall:.3f}".format(wall=metrics["wall"]), "{cpu:.3f}".format(cpu=metrics["cpu"]),
+                  "{rss:.1f}".format(rss=metrics["peak_rss_mb"]), throughput, baseline_wall, sep="\t", file=dest)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks frag_matrix and sparse_to_tsv stages on synthetic hic data")
+    parser.add_argument("--scales", nargs="+", choices=sorted(SCALES), default=["small", "medium"])
+    parser.add_argument("--work-dir", type=str, default=os.path.join(tempfile.gettempdir(), "hic_benchmark"),
+                        help="Directory for synthetic inputs, that are reused between runs")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--measure", choices=["outer", "inner", "fractions"], default="inner")
+    parser.add_argument("--contact", choices=["value", "matrix"], default="matrix")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", type=str, default=None, help="Path to store results to as a json baseline")
+    parser.add_argument("--compare", type=str, default=None, help="Path to a json baseline to compare results with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown (or memory growth), that is reported as a regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    if not os.path.exists(args.work_dir):
+        os.makedirs(args.work_dir)
+    results = run_benchmark(work_dir=args.work_dir, scales=args.scales, repeats=args.repeats, measure=args.measure, contact=args.contact,
+                            seed=args.seed)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "rt") as source:
+            baseline = json.load(source)
+    print_results(results, baseline=baseline)
+    if args.save is not None:
+        with open(args.save, "wt") as dest:
+            json.dump(results, dest, indent=2, sort_keys=True)
+        logger.info("Results are saved to {path}".format(path=args.save))
+    if baseline is not None:
+        regressions = compare_results(results, baseline, tolerance=args.tolerance)
+        for scale, stage, metric, baseline_value, value in regressions:
+            logger.error("Regression in {scale}/{stage}: {metric} {baseline_value:.3f} -> {value:.3f}".format(
+                scale=scale, stage=stage, metric=metric, baseline_value=baseline_value, value=value))
+        if len(regressions) > 0:
+            sys.exit(1)
+        logger.info("No regressions against {path}".format(path=args.compare))
@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import collections
+import logging
+import os
+import struct
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import six
+
+from hic_dump import read_header, write_arrays
+
+logger = logging.getLogger("bgzf")
+
+# uncompressed size of a block, so that even an incompressible one fits the 16 bit BSIZE field (same as in htslib)
+BLOCK_SIZE = 0xff00
+BGZF_SUFFIX = ".gz"
+BGZF_INDEX_SUFFIX = ".bgzi"
+BGZF_INDEX_MAGIC = b"HICBGZI1"
+# compressed and uncompressed offsets of a block and the number of lines, that end before it
+BLOCKS_DTYPE = np.dtype([("coffset", "<u8"), ("uoffset", "<u8"), ("lines", "<u8")])
+# gzip member header with a "BC" extra subfield, that holds the member size (minus one)
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_FOOTER = struct.Struct("<II")
+EOF_BLOCK = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def is_bgzf_path(path):
+    return isinstance(path, six.string_types) and path.endswith(BGZF_SUFFIX)
+
+
+def get_bgzf_index_path(path):
+    return path + BGZF_INDEX_SUFFIX
+
+
+def compress_block(data, level=6):
+    """ Compresses (at most BLOCK_SIZE bytes of) data into a single BGZF block, a standalone gzip member """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER.size + len(deflated) + _FOOTER.size
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, ord("B"), ord("C"), 2, block_size - 1)
+    return header + deflated + _FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    """ File like writer of BGZF (blocked gzip) streams
+
+    Data is cut into blocks of at most BLOCK_SIZE bytes (at line ends, unless a line is longer than a block),
+    that are compressed independently in a thread pool (zlib releases the GIL) and written in order,
+    so the output is a valid multi member gzip file, that can also be read with gzip / zcat.
+    Offsets of all blocks, with numbers of lines before them, are written to an index (see BgzfReader).
+    """
+
+    def __init__(self, output, index_path=None, threads=1, level=6):
+        """
+        :param output: path or a binary file object to write to
+        :param index_path: path to write a block index to (none is written by default)
+        :param threads: number of compressing threads
+        :param level: zlib compression level
+        """
+        self._own = isinstance(output, six.string_types)
+        self._dest = open(output, "wb") if self._own else output
+        self.index_path = index_path
+        self.level = level
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        self._max_pending = 2 * threads
+        self._pending = collections.deque()
+        self._chunks, self._buffered = [], 0
+        self._coffset, self._uoffset, self._lines = 0, 0, 0
+        # uncompressed offsets and lines before blocks are known at submission, compressed offsets once they are written
+        self._blocks, self._coffsets = [], []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BLOCK_SIZE:
+            buffer = b"".join(self._chunks)
+            start = 0
+            while len(buffer) - start >= BLOCK_SIZE:
+                end = buffer.rfind(b"\n", start, start + BLOCK_SIZE) + 1
+                self._submit(buffer[start:end if end > start else start + BLOCK_SIZE])
+                start = end if end > start else start + BLOCK_SIZE
+            self._chunks, self._buffered = [buffer[start:]], len(buffer) - start
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _submit(self, data):
+        self._blocks.append((self._uoffset, self._lines))
+        self._uoffset += len(data)
+        self._lines += data.count(b"\n")
+        if self._pool is None:
+            self._write_block(compress_block(data, self.level))
+            return
+        self._pending.append(self._pool.apply_async(compress_block, (data, self.level)))
+        while len(self._pending) > self._max_pending:
+            self._write_block(self._pending.popleft().get())
+
+    def _write_block(self, block):
+        self._coffsets.append(self._coffset)
+        self._dest.write(block)
+        self._coffset += len(block)
+
+    def _drain(self):
+        while len(self._pending) > 0:
+            self._write_block(self._pending.popleft().get())
+
+    def flush(self):
+        """ Compresses buffered data into a (short) block and writes all compressed blocks out """
+        if self._buffered > 0:
+            self._submit(b"".join(self._chunks))
+            self._chunks, self._buffered = [], 0
+        self._drain()
+        self._dest.flush()
+
+    def fileno(self):
+        return self._dest.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self._dest.write(EOF_BLOCK)
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        if self._own:
+            self._dest.close()
+        else:
+            self._dest.flush()
+        self.closed = True
+        if self.index_path is not None:
+            blocks = np.zeros(len(self._blocks), dtype=BLOCKS_DTYPE)
+            blocks["coffset"] = self._coffsets
+            blocks["uoffset"] = [uoffset for uoffset, _ in self._blocks]
+            blocks["lines"] = [lines for _, lines in self._blocks]
+            write_bgzf_index(self.index_path, blocks, lines_cnt=self._lines, size=self._uoffset, compressed_size=self._coffset)
+
+
+def write_bgzf_index(path, blocks, lines_cnt, size, compressed_size):
+    """ Writes a block index (see hic_dump.write_arrays): lines and sizes of the whole stream, followed by a BLOCKS_DTYPE array """
+    header = {"blocks_cnt": len(blocks), "lines_cnt": lines_cnt, "size": size, "compressed_size": compressed_size}
+    write_arrays(path, BGZF_INDEX_MAGIC, header, [blocks])
+
+
+def read_block(source):
+    """ Reads and decompresses the next BGZF block of a binary file object, None at the end of the file """
+    header = source.read(_HEADER.size)
+    if len(header) == 0:
+        return None
+    fields = _HEADER.unpack(header) if len(header) == _HEADER.size else None
+    if fields is None or fields[:4] != (31, 139, 8, 4) or fields[8:11] != (ord("B"), ord("C"), 2):
+        raise ValueError("Not a BGZF block at offset {offset}".format(offset=source.tell() - len(header)))
+    rest = source.read(fields[11] + 1 - _HEADER.size)
+    data = zlib.decompress(rest[:-_FOOTER.size], -zlib.MAX_WBITS)
+    crc, size = _FOOTER.unpack(rest[-_FOOTER.size:])
+    if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise ValueError("Corrupted BGZF block at offset {offset}".format(offset=source.tell() - len(rest) - len(header)))
+    return data
+
+
+class BgzfReader(object):
+    """ Random access to lines of a BGZF file, written with a block index (see BgzfWriter)
+
+    Reading from line n only decompresses blocks from the one, that holds the end of line n - 1.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        index_path = get_bgzf_index_path(path) if index_path is None else index_path
+        result = read_header(index_path, BGZF_INDEX_MAGIC)
+        if result is None:
+            raise ValueError("No block index {index} for {path}".format(index=index_path, path=path))
+        header, offset = result
+        if os.path.getsize(path) != header["compressed_size"] + len(EOF_BLOCK):
+            raise ValueError("Block index {index} is stale for {path}".format(index=index_path, path=path))
+        self.lines_cnt = header["lines_cnt"]
+        self.size = header["size"]
+        if header["blocks_cnt"] > 0:
+            self.blocks = np.memmap(index_path, dtype=BLOCKS_DTYPE, mode="r", offset=offset, shape=(header["blocks_cnt"],))
+        else:
+            self.blocks = np.zeros(0, dtype=BLOCKS_DTYPE)
+
+    def __len__(self):
+        return self.lines_cnt
+
+    def find(self, line):
+        """ :return: number of the block, in which the line starts, and the number of line ends to skip in it """
+        if line == 0 or len(self.blocks) == 0:
+            return 0, 0
+        lines_after = np.append(self.blocks["lines"][1:], self.lines_cnt)
+        block = min(int(np.searchsorted(lines_after, line, side="left")), len(self.blocks) - 1)
+        return block, line - int(self.blocks["lines"][block])
+
+    def lines(self, first=0, count=None):
+        """ Yields (decoded) lines of the file, starting at line number first (0-based, header lines included) """
+        if len(self.blocks) == 0 or first >= self.lines_cnt + 1 or count == 0:
+            return
+        block, skip = self.find(first)
+        with open(self.path, "rb") as source:
+            source.seek(int(self.blocks["coffset"][block]))
+            carry = b""
+            while True:
+                data = read_block(source)
+                if data is None or len(data) == 0:
+                    break
+                parts = (carry + data).split(b"\n")
+                carry = parts.pop()
+                for part in parts:
+                    if skip > 0:
+                        skip -= 1
+                        continue
+                    yield (part + b"\n").decode("utf-8")
+                    if count is not None:
+                        count -= 1
+                        if count == 0:
+                            return
+            if len(carry) > 0 and skip == 0:
+                yield carry.decode("utf-8")
+
+
+def open_text_output(path, compression=None, threads=1):
+    """ Opens a text output: stdout for "-", a BGZF writer (with a block index next to a file) for gzip compression, a plain file otherwise """
+    if compression == "gzip":
+        if path == "-":
+            return BgzfWriter(sys.stdout.buffer if hasattr(sys.stdout, "buffer") else sys.stdout, threads=threads)
+        return BgzfWriter(path, index_path=get_bgzf_index_path(path), threads=threads)
+    return sys.stdout if path == "-" else open(path, "wt")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints lines of a BGZF file (see BgzfWriter), seeking to the first one with the block index")
+    parser.add_argument("path", type=str)
+    parser.add_argument("--first", type=int, default=0, help="Number of the first line to print (0-based, header lines included)")
+    parser.add_argument("--count", type=int, default=None, help="Number of lines to print, all the rest by default")
+    args = parser.parse_args()
+    for line in BgzfReader(args.path).lines(first=args.first, count=args.count):
+        sys.stdout.write(line)
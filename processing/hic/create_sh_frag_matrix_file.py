@@ -1,11 +1,185 @@
 # -*- coding: utf-8 -*-
-from __future__ import print_function
+from __future__ import print_function, division
 import argparse
 import logging
+import multiprocessing
 import os
+import sys
+import time
+
+from fragment_catalog import load_fragment_catalog
+from frag_matrix import FragmentIndex, compute_frag_matrix, read_groups
+from genome_store import get_genome_store_path, update_genome_store
+
+logger = logging.getLogger("create_sh_frag_matrix_job_files")
+
+# rough peak memory of a frag_matrix run per byte of its text hic dump (parsed arrays, CSR matrices and their products)
+MEMORY_PER_DUMP_BYTE = 3
+# seconds between checks of finished jobs and of liveness of worker processes in "run" mode
+POLL_INTERVAL = 0.5
+
+_worker_fragments = None
+_worker_pids = None
+
+
+def get_hic_export_files(hic_dir, chromosomes):
+    """ Hic dump files (named as "cell-line_chr1_chr2_resolution_correction.txt", possibly gzip compressed) in a directory,
+    that match the chromosomes selection
+
+    :return: list of (file name, chr1, chr2, resolution, correction) tuples
+    """
+    result = []
+    for hic_file in sorted(os.listdir(hic_dir)):
+        if not (hic_file.endswith(".txt") or hic_file.endswith(".txt.gz")) or len(hic_file.split("_")) != 5:
+            continue
+        cell_line, chr1, chr2, resolution, correction = hic_file.split("_")
+        if chr1 == chr2 and chromosomes == "inter":
+            continue
+        if chr1 != chr2 and chromosomes == "intra":
+            continue
+        correction = correction.split(".")[0]
+        result.append((hic_file, chr1, chr2, resolution, correction))
+    return result
+
+
+def get_contacts_file_name(frag_lengths, chr1, chr2, resolution, correction, prefix="all"):
+    return "{prefix}_{frag_lengths}_{chr1}_{chr2}_{bin_size}_{correction}.txt".format(prefix=prefix, frag_lengths=frag_lengths, chr1=chr1, chr2=chr2,
+                                                                                      bin_size=resolution, correction=correction)
+
+
+def _init_worker(fragments_path, pids):
+    # every worker maps the same fragments catalog, rather than receiving a copy of all fragments
+    global _worker_fragments, _worker_pids
+    _worker_fragments = load_fragment_catalog(fragments_path)
+    _worker_pids = pids
+
+
+def _run_frag_matrix(job_number, hic_path, output_path, fragments_path, options):
+    start_time = time.time()
+    # the parent watches the process, that runs the job, so that a killed worker fails the job, rather than hangs the runner
+    _worker_pids[job_number] = os.getpid()
+    try:
+        compute_frag_matrix(hic=hic_path, fragments=_worker_fragments, fragments_filename=fragments_path, output=output_path, **options)
+    except Exception as error:
+        return hic_path, time.time() - start_time, "{name}: {error}".format(name=type(error).__name__, error=error)
+    return hic_path, time.time() - start_time, None
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def run_frag_matrix_jobs(jobs, fragments_path, options, workers, memory_budget=None):
+    """ Runs frag_matrix for every (hic path, output path) job in a local process pool
+
+    Fragments catalog is built once and memory mapped by every worker process, jobs are started largest hic dump first,
+    and a job is only started, if its estimated memory fits into the memory budget, next to the already running ones
+    (a single job is always allowed to run).
+    A job fails, if it raises, or if the worker process, that runs it, dies (e.g. is killed for running out of memory).
+
+    :param jobs: list of (hic path, output path) pairs
+    :param fragments_path: path, the fragments are loaded from (see fragment_catalog.load_fragment_catalog)
+    :param options: keyword arguments for compute_frag_matrix
+    :param workers: maximum number of concurrently running jobs
+    :param memory_budget: maximum total estimated memory (in bytes) of concurrently running jobs, None for no limit
+    :return: dict of hic path -> (elapsed seconds, error message or None)
+    """
+    pending = sorted(jobs, key=lambda job: os.path.getsize(job[0]), reverse=True)
+    estimates = {hic_path: os.path.getsize(hic_path) * MEMORY_PER_DUMP_BYTE for hic_path, _ in jobs}
+    numbers = {hic_path: number for number, (hic_path, _) in enumerate(jobs)}
+    # pids of worker processes, that run jobs (set by workers in shared memory, zero until a job starts)
+    pids = multiprocessing.Array("l", len(jobs), lock=False)
+    running = {}
+    results = {}
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(fragments_path, pids))
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < workers:
+                fitting = [job for job in pending if memory_budget is None or len(running) == 0 or
+                           sum(estimates[hic_path] for hic_path in running) + estimates[job[0]] <= memory_budget]
+                if len(fitting) == 0:
+                    break
+                hic_path, output_path = fitting[0]
+                pending.remove(fitting[0])
+                logger.info("Starting {hic} ({size:.1f} Mb, ~{memory:.1f} Gb of memory)".format(hic=os.path.basename(hic_path),
+                                                                                                  size=os.path.getsize(hic_path) / 2 ** 20,
+                                                                                                  memory=estimates[hic_path] / 2 ** 30))
+                running[hic_path] = (pool.apply_async(_run_frag_matrix, (numbers[hic_path], hic_path, output_path, fragments_path, options)), time.time())
+            finished = []
+            for hic_path, (result, start_time) in running.items():
+                if result.ready():
+                    try:
+                        _, elapsed, error = result.get()
+                    except Exception as exception:
+                        elapsed, error = time.time() - start_time, "{name}: {error}".format(name=type(exception).__name__, error=exception)
+                    finished.append((hic_path, elapsed, error))
+                elif pids[numbers[hic_path]] > 0 and not _is_alive(pids[numbers[hic_path]]):
+                    finished.append((hic_path, time.time() - start_time, "worker process {pid} died".format(pid=pids[numbers[hic_path]])))
+            if len(finished) == 0:
+                time.sleep(POLL_INTERVAL)
+            for hic_path, elapsed, error in finished:
+                del running[hic_path]
+                results[hic_path] = (elapsed, error)
+                if error is None:
+                    logger.info("Finished {hic} in {elapsed:.1f}s ({done}/{total})".format(hic=os.path.basename(hic_path), elapsed=elapsed,
+                                                                                          done=len(results), total=len(jobs)))
+                else:
+                    logger.error("Failed {hic} after {elapsed:.1f}s ({done}/{total}): {error}".format(hic=os.path.basename(hic_path),
+                                                                                                    elapsed=elapsed, done=len(results),
+                                                                                                    total=len(jobs), error=error))
+    finally:
+        # all results are collected by now, but the pool would wait for jobs of dead workers on close
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def run_genome_frag_matrix(store_path, jobs, fragment_index, fragments_path, options):
+    """ Runs frag_matrix for every (chr1, chr2, output path) job sequentially in this process, reading contacts from a genome store
+
+    Fragments are filtered and binned once for all jobs (see frag_matrix.FragmentIndex), and records of every chromosome pair
+    are streamed from the memory mapped store (see genome_store.py), rather than parsed from a dump by a separate process.
+
+    :param store_path: path to a genome store
+    :param jobs: list of (chr1, chr2, output path) tuples
+    :param fragment_index: FragmentIndex, built for options["frag_lengths"]
+    :param fragments_path: path, the fragments were loaded from
+    :param options: keyword arguments for compute_frag_matrix
+    :return: dict of (chr1, chr2) -> (elapsed seconds, error message or None)
+    """
+    results = {}
+    for chr1, chr2, output_path in jobs:
+        start_time = time.time()
+        try:
+            compute_frag_matrix(hic=store_path, fragments=None, fragments_filename=fragments_path, output=output_path, chromosomes=(chr1, chr2),
+                                fragment_index=fragment_index, **options)
+            error = None
+        except Exception as exception:
+            error = "{name}: {error}".format(name=type(exception).__name__, error=exception)
+        results[(chr1, chr2)] = (time.time() - start_time, error)
+        if error is None:
+            logger.info("Finished chromosomes {chr1} and {chr2} in {elapsed:.1f}s ({done}/{total})"
+                        "".format(chr1=chr1, chr2=chr2, elapsed=results[(chr1, chr2)][0], done=len(results), total=len(jobs)))
+        else:
+            logger.error("Failed chromosomes {chr1} and {chr2} ({done}/{total}): {error}".format(chr1=chr1, chr2=chr2, done=len(results),
+                                                                                              total=len(jobs), error=error))
+    return results
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["sbatch", "run", "genome"], default="sbatch",
+                        help="Either create sbatch scripts for every chromosome pair, run all of them locally in a process pool, "
+                             "or run all of them in a single process from a genome store of all dumps (see genome_store.py)")
+    parser.add_argument("--store-dir", type=str, default=None,
+                        help="Directory for genome stores in \"genome\" mode (--hic-dir by default), stores are only rebuilt, when dumps change")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Number of concurrent jobs in \"run\" mode")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="Total (estimated) memory in Gb of concurrent jobs in \"run\" mode, not limited by default")
     parser.add_argument("--frag-matrix-path", type=str, default=os.path.join("group", "cbi", "maxal", "hicproject", "software", "HiC", "processing", "hic", "frag_matrix.py"))
     parser.add_argument("--chromosomes", choices=["inter", "intra", "all"], default="all")
     parser.add_argument("--output-sh-file-prefix", default="")
@@ -18,25 +192,64 @@ if __name__ == "__main__":
     parser.add_argument("--logging", type=int, choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL], default=logging.INFO)
     parser.add_argument("-o", "--output-dir", required=True)
     parser.add_argument("--contact", default="matrix", choices=["matrix", "value"])
+    parser.add_argument("--groups", type=str, default=None,
+                        help="\"fragment<TAB>group\" mapping, group x group contacts totals are computed instead of fragment pairs ones")
     args = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG,
+    logging.basicConfig(level=args.logging,
                         format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
                         datefmt='%m-%d %H:%M:%S')
-    logger = logging.getLogger("create_sh_frag_matrix_job_files")
     logger.setLevel(args.logging)
     args = parser.parse_args()
-    if not os.path.exists(args.frag_matrix_path):
+    if args.mode == "sbatch" and not os.path.exists(args.frag_matrix_path):
         logging.critical("Path {path} for frag_matrix executable does not exist".format(path=args.frag_matrix_path))
-        exit(1)
+        sys.exit(1)
     if not os.path.exists(args.fragments) or not os.path.isfile(args.fragments):
         logging.critical("Path {path} for fragments does not exist".format(path=args.fragments))
-        exit(1)
+        sys.exit(1)
     if not os.path.exists(args.hic_dir) or not os.path.isdir(args.hic_dir):
         logging.critical("Path {path} for hic files directory does not exist".format(path=args.hic_dir))
-        exit(1)
+        sys.exit(1)
+    if args.groups is not None and not os.path.isfile(args.groups):
+        logging.critical("Path {path} for fragment groups does not exist".format(path=args.groups))
+        sys.exit(1)
+    output_prefix = "all" if args.groups is None else "groups"
     if not os.path.exists(args.output_dir):
         logger.debug("Output directory {path} does not exist. Creating one".format(path=args.output_dir))
         os.makedirs(args.output_dir)
+    hic_export_files = get_hic_export_files(hic_dir=args.hic_dir, chromosomes=args.chromosomes)
+    logger.info("Found {hic_cnt} hic files".format(hic_cnt=len(hic_export_files)))
+    if args.mode in ("run", "genome"):
+        logger.info("Loading fragments info from {f_filename}".format(f_filename=os.path.basename(args.fragments)))
+        fragments = load_fragment_catalog(args.fragments)
+        options = {"measure": args.measure, "contact": args.contact, "frag_lengths": int(args.frag_lengths)}
+        if args.groups is not None:
+            options["groups"] = read_groups(args.groups)
+        start_time = time.time()
+        if args.mode == "genome":
+            fragment_index = FragmentIndex(fragments=fragments, frag_lengths=int(args.frag_lengths))
+            stores = {}
+            for hic_file, chr1, chr2, resolution, correction in hic_export_files:
+                stores.setdefault((hic_file.split("_")[0], resolution, correction), []).append((hic_file, chr1, chr2))
+            results = {}
+            for (cell_line, resolution, correction), dumps in sorted(stores.items()):
+                store_path = get_genome_store_path(args.hic_dir if args.store_dir is None else args.store_dir, cell_line, resolution, correction)
+                update_genome_store([os.path.join(args.hic_dir, hic_file) for hic_file, _, _ in dumps], store_path)
+                jobs = [(chr1, chr2, os.path.join(args.output_dir, get_contacts_file_name(args.frag_lengths, chr1, chr2, resolution, correction,
+                                                                                          prefix=output_prefix)))
+                        for _, chr1, chr2 in dumps]
+                results.update(run_genome_frag_matrix(store_path=store_path, jobs=jobs, fragment_index=fragment_index,
+                                                      fragments_path=os.path.abspath(args.fragments), options=options))
+        else:
+            jobs = [(os.path.join(args.hic_dir, hic_file),
+                     os.path.join(args.output_dir, get_contacts_file_name(args.frag_lengths, chr1, chr2, resolution, correction,
+                                                                          prefix=output_prefix)))
+                    for hic_file, chr1, chr2, resolution, correction in hic_export_files]
+            results = run_frag_matrix_jobs(jobs=jobs, fragments_path=os.path.abspath(args.fragments), options=options,
+                                           workers=args.workers, memory_budget=None if args.memory_budget is None else args.memory_budget * 2 ** 30)
+        failed = [job for job, (elapsed, error) in results.items() if error is not None]
+        logger.info("Ran {job_cnt} jobs in {elapsed:.1f}s, {failed_cnt} failed".format(job_cnt=len(results), elapsed=time.time() - start_time,
+                                                                                    failed_cnt=len(failed)))
+        sys.exit(1 if len(failed) > 0 else 0)
     file_template = "\n".join([
         "#!/bin/sh",
         "#SBATCH -p short",
@@ -45,33 +258,22 @@ if __name__ == "__main__":
         "#SBATCH -e {base_name}.err",
         "#SBATCH -o {base_name}.out",
         "module load python/2.7.6",
-        "python {frag_matrix_path} --fragments {fragments_path} --hic {hic_path} --frag-lengths {frag_lengths} --contact {contact} --measure {measure} --output {output_file_rel_path}"
+        "python {frag_matrix_path} --fragments {fragments_path} --hic {hic_path} --frag-lengths {frag_lengths} --contact {contact} --measure {measure} --output {output_file_rel_path}{groups_option}"
     ])
-    hic_export_files = [f for f in os.listdir(args.hic_dir) if f.endswith(".txt") and len(f.split("_")) > 4]
-    logger.info("Found {hic_cnt} hic files".format(hic_cnt=len(hic_export_files)))
     batch_runner_path = args.batch_runner_path
     if len(args.batch_runner_path) == 0:
         batch_runner_path = "_".join(["run-all", args.frag_lengths, args.chromosomes, args.measure]) + ".sh"
     with open(os.path.join(args.output_dir, batch_runner_path), "wt") as batch_runner_dest:
         print("#!/bin/sh", file=batch_runner_dest)
-        for hic_file in hic_export_files:
-            cell_line, chr1, chr2, resolution, correction = hic_file.split("_")
+        for hic_file, chr1, chr2, resolution, correction in hic_export_files:
             logger.debug("Working with {file_name}".format(file_name=hic_file))
-            if chr1 == chr2 and args.chromosomes == "inter":
-                continue
-            if chr1 != chr2 and args.chromosomes == "intra":
-                continue
-            if correction.endswith(".txt"):
-                correction = correction[:-4]
             logger.debug("Creating batch sh file for {hic_file_name}".format(hic_file_name=hic_file))
             sh_file_name = "{prefix}{chr1}_{chr2}.sh".format(chr1=chr1, chr2=chr2, prefix=args.output_sh_file_prefix)
             print("echo \"submitting file {sh_file_name}\"".format(sh_file_name=sh_file_name), file=batch_runner_dest)
             print("sbatch {sh_file_name}".format(sh_file_name=sh_file_name), file=batch_runner_dest)
-            contacts_file_name = "all_{frag_lengths}_{chr1}_{chr2}_{bin_size}_{correction}.txt".format(frag_lengths=args.frag_lengths,
-                                                                                                       chr1=chr1, chr2=chr2, bin_size=resolution,
-                                                                                                       correction=correction)
+            contacts_file_name = get_contacts_file_name(args.frag_lengths, chr1, chr2, resolution, correction, prefix=output_prefix)
             with open(os.path.join(args.output_dir, sh_file_name), "wt") as dest:
-                print(file_template.format(base_name=hic_file[:-4],
+                print(file_template.format(base_name=hic_file.split(".")[0],
                                            frag_matrix_path=os.path.abspath(args.frag_matrix_path),
                                            fragments_path=os.path.abspath(args.fragments),
                                            hic_path=os.path.join(args.hic_dir, hic_file),
@@ -79,4 +281,6 @@ if __name__ == "__main__":
                                            measure=args.measure,
                                            time=args.time,
                                            contact=args.contact,
-                                           output_file_rel_path=contacts_file_name), file=dest)
+                                           output_file_rel_path=contacts_file_name,
+                                           groups_option="" if args.groups is None else " --groups {path}".format(path=os.path.abspath(args.groups))),
+                      file=dest)
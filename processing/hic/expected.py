@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("expected")
+
+DATA_TYPES = ["observed", "oe", "expected", "pearson"]
+
+
+def _valid_bins(indexes, values, bins_cnt):
+    """ Mask of bins, that have at least one (non NaN) contact """
+    valid = np.zeros(bins_cnt, dtype=bool)
+    valid[indexes[~np.isnan(values)]] = True
+    return valid
+
+
+def diagonal_pairs_counts(valid):
+    """ Number of pairs of valid bins (i, i + d) for every distance d, computed as an FFT based autocorrelation of the valid bins mask """
+    bins_cnt = len(valid)
+    if bins_cnt == 0:
+        return np.zeros(0, dtype=np.int64)
+    size = 1 << int(np.ceil(np.log2(2 * bins_cnt)))
+    spectrum = np.fft.rfft(valid.astype(np.float64), size)
+    return np.rint(np.fft.irfft(spectrum * np.conj(spectrum), size)[:bins_cnt]).astype(np.int64)
+
+
+def compute_expected(rows, columns, values, bin_size, intra=True, bins_cnt=None):
+    """ Expected contacts values: mean value of every diagonal (distance) for intra chromosomal contacts, and mean value of the whole matrix
+    for inter chromosomal ones. Means are taken over pairs of bins, that both have at least one contact (missing records count as zeros).
+
+    :param rows: genomic positions of the first chromosome (a single triangle of the matrix for intra chromosomal contacts)
+    :param columns: genomic positions of the second chromosome
+    :param values: contacts values (NaN values are ignored)
+    :param bin_size: resolution
+    :param intra: whether contacts are intra chromosomal
+    :param bins_cnt: number of bins of the chromosome(s) (a pair for inter chromosomal contacts), taken from the data extent by default
+    :return: numpy array of expected values by distance (in bins), or a single element array for inter chromosomal contacts
+    """
+    rows, columns = np.asarray(rows) // bin_size, np.asarray(columns) // bin_size
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    if intra:
+        if bins_cnt is None:
+            bins_cnt = int(max(rows.max(), columns.max())) + 1 if len(rows) > 0 else 0
+        valid = _valid_bins(np.concatenate([rows, columns]), np.concatenate([values, values]), bins_cnt)
+        sums = np.bincount(np.abs(columns - rows)[known], weights=values[known], minlength=bins_cnt)[:bins_cnt]
+        counts = diagonal_pairs_counts(valid)
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    if bins_cnt is None:
+        bins_cnt = (int(rows.max()) + 1 if len(rows) > 0 else 0, int(columns.max()) + 1 if len(columns) > 0 else 0)
+    pairs_cnt = _valid_bins(rows, values, bins_cnt[0]).sum() * _valid_bins(columns, values, bins_cnt[1]).sum()
+    return np.array([values[known].sum() / pairs_cnt if pairs_cnt > 0 else np.nan])
+
+
+def expected_values(rows, columns, bin_size, expected, intra=True):
+    """ Expected values at records positions (see compute_expected) """
+    if not intra:
+        return np.full(len(rows), expected[0])
+    distances = np.abs(np.asarray(columns) // bin_size - np.asarray(rows) // bin_size)
+    return np.append(expected, np.nan)[np.minimum(distances, len(expected))]
+
+
+def observed_over_expected(rows, columns, values, bin_size, intra=True, expected=None):
+    """ Observed / expected values of records, only records, that are present, are transformed, so the matrix stays sparse
+
+    :param expected: expected values (see compute_expected), computed from the records by default
+    """
+    if expected is None:
+        expected = compute_expected(rows, columns, values, bin_size, intra=intra)
+    return np.asarray(values, dtype=np.float64) / expected_values(rows, columns, bin_size, expected, intra=intra)
+
+
+def expected_block(expected, row_bins, column_bins, intra=True):
+    """ Dense block of expected values for rows row_bins and columns column_bins (bin indexes) """
+    if not intra:
+        return np.full((len(row_bins), len(column_bins)), expected[0])
+    distances = np.abs(np.asarray(column_bins)[np.newaxis, :] - np.asarray(row_bins)[:, np.newaxis])
+    return np.append(expected, np.nan)[np.minimum(distances, len(expected))]
+
+
+def pearson_blocks(matrix, block_rows):
+    """ Yields (first row, dense block) of a Pearson correlation matrix of rows of a (symmetric) sparse O/E matrix, block by block
+
+    Correlations of a block of rows B with all rows are (B * M^T - n * mean_B * mean^T) / (n * std_B * std^T),
+    so only a (block_rows x rows) dense block is allocated at a time.
+
+    :param matrix: (n x n) scipy.sparse.csr_matrix of O/E values
+    :param block_rows: number of rows in a block
+    """
+    matrix = matrix.tocsr()
+    matrix.data = np.nan_to_num(matrix.data)
+    columns_cnt = matrix.shape[1]
+    means = np.asarray(matrix.sum(axis=1)).ravel() / columns_cnt
+    squares = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel() / columns_cnt
+    deviations = np.sqrt(np.maximum(squares - means ** 2, 0.0))
+    transposed = matrix.T.tocsc()
+    for block_start in range(0, matrix.shape[0], block_rows):
+        block_end = min(block_start + block_rows, matrix.shape[0])
+        products = matrix[block_start:block_end].dot(transposed).toarray() / columns_cnt
+        covariances = products - means[block_start:block_end, np.newaxis] * means[np.newaxis, :]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            yield block_start, covariances / (deviations[block_start:block_end, np.newaxis] * deviations[np.newaxis, :])
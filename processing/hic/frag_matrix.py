@@ -3,39 +3,57 @@
 from __future__ import print_function, division
 
 import argparse
+import collections
 import csv
 import datetime
+import gzip
+import io
 import logging
+import multiprocessing
 import os
 import sys
-import math
-from collections import defaultdict
 
+import numpy as np
+import pandas as pd
+import six
+from scipy import sparse
 
-class Fragment(object):
-    __slots__ = ["name", "start", "end", "chromosome"]
+from bgzf import BgzfWriter, get_bgzf_index_path, is_bgzf_path
+from expected import observed_over_expected
+from fragment_catalog import Fragment, FragmentArrays, FragmentCatalog, load_fragment_catalog
+from frag_matrix_binary import BinaryContactsWriter
+from genome_store import open_genome_store
+from hic_dump import is_genome_store, is_hic_file, load_contacts
+from metrics import PROFILERS, Metrics, profiling
 
-    def __init__(self, name, start, end, chromosome):
-        self.name = name
-        self.start = start
-        self.end = end
-        self.chromosome = chromosome
+logger = logging.getLogger("frag_matrix")
 
 
-def load_hic_data(hic_filename):
-    result = defaultdict(dict)
-    with open(hic_filename, "rt") as source:
-        reader = csv.reader(source, delimiter='\t', quotechar='|')
-        for cnt, row in enumerate(reader):
-            if row[0].strip().startswith("#"):
-                logger.debug("Skipping row {row}".format(row="\t".join(row)))
-                continue
-            row_id, column_id, value = int(row[0]), int(row[1]), float(row[2])
-            result[row_id][column_id] = value
-    return result
+def load_hic_data(hic_filename, step, use_cache=True, chromosomes=None, norm="NONE", dump_step=None, data="observed"):
+    """ Loads a sparse Juicer dump (or a chromosome pair from a .hic file) into a CSR matrix, indexed by bins (genomic coordinate divided by step)
+
+    :param hic_filename: path to the "position1<TAB>position2<TAB>value" dump file (plain or gzip compressed), or to a .hic file
+    :param step: a discreet step, that the hic contact are counted with
+    :param use_cache: whether to use (and create) a binary sidecar cache of the parsed dump (see hic_dump.load_dump)
+    :param chromosomes: pair of chromosomes to read from a .hic file
+    :param norm: normalization to read from a .hic file
+    :param dump_step: resolution of the dump, if it differs from step, coarser data is read from the dump pyramid (see hic_dump.build_pyramid)
+    :param data: observed contacts, or observed / expected ones (oe), expected values are computed from the observed contacts
+    :return: scipy.sparse.csr_matrix with dump rows as matrix rows and dump columns as matrix columns
+    """
+    rows, columns, values = load_contacts(hic_filename, chromosomes=chromosomes, bin_size=step, norm=norm, use_cache=use_cache,
+                                          dump_bin_size=dump_step)
+    if data == "oe":
+        intra = chromosomes is None or chromosomes[0] == chromosomes[1]
+        values = observed_over_expected(rows, columns, values, step, intra=intra)
+    rows = rows // step
+    columns = columns // step
+    shape = (int(rows.max()) + 1 if len(rows) > 0 else 0, int(columns.max()) + 1 if len(columns) > 0 else 0)
+    return sparse.csr_matrix((values, (rows, columns)), shape=shape)
 
 
 def get_fragments(fragments_filename):
+    """ A list of Fragment instances (see fragment_catalog.load_fragment_catalog for a columnar genome wide catalog) """
     result = []
     with open(fragments_filename, "rt") as source:
         reader = csv.reader(source, delimiter="\t")
@@ -45,81 +63,311 @@ def get_fragments(fragments_filename):
     return result
 
 
-def count_contacts(hic_data, f1, f2, measure, step):
-    """
+class FragmentBins(object):
+    """ Bins, that are overlapped by every fragment in a list, together with their measure specific multipliers
 
-    :param hic_data: dict of dict like data storage
-    :param f1: fragment 1 (instance of Fragment)
-    :param f2: fragment 2 (instance of Fragment)
-    :param measure: a choice of a measure (inner/outer/fraction)
-    :param step: a discreet step, that the hic contact are counted with
-    :return:
+    Fragment i covers a contiguous run of bins first[i], ..., last[i] - 1, that are stored in
+    bins[offsets[i]:offsets[i + 1]] with their respective multipliers in weights[offsets[i]:offsets[i + 1]]
     """
-    def get_contact(data, i, j, im, jm, observed):
-        index1, index2 = i, j
-        if (index1, index2) in observed:
-            return 0
-        contact = data[index1].get(index2, 0) * im * jm
-        observed.add((index1, index2))
-        return contact
-
-    def get_before_after_indexes(f, fsa, feb, fully_inside, measure):
+
+    def __init__(self, fragments, step, measure):
+        """
+
+        :param fragments: a list of Fragment instances, or FragmentArrays
+        :param step: a discreet step, that the hic contact are counted with
+        :param measure: a choice of a measure (inner/outer/fraction)
+        """
+        self.fragments = fragments
+        self.step = step
+        self.measure = measure
+        if isinstance(fragments, FragmentArrays):
+            starts, ends = np.asarray(fragments.starts, dtype=np.int64), np.asarray(fragments.ends, dtype=np.int64)
+        else:
+            starts = np.array([f.start for f in fragments], dtype=np.int64)
+            ends = np.array([f.end for f in fragments], dtype=np.int64)
+        self.first = starts // step
+        self.last = np.maximum(-(-ends // step), self.first)
+        self.short = (ends // step) <= -(-starts // step)
+        counts = self.last - self.first
+        self.offsets = np.zeros(len(fragments) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.owners = np.repeat(np.arange(len(fragments), dtype=np.int64), counts)
+        self.bins = self.first[self.owners] + np.arange(self.offsets[-1], dtype=np.int64) - self.offsets[self.owners]
+        overlap = np.minimum(ends[self.owners], (self.bins + 1) * step) - np.maximum(starts[self.owners], self.bins * step)
         if measure == "outer":
-            before, after = [1], [1]
+            self.weights = np.ones(len(self.bins), dtype=np.float64)
         elif measure == "inner":
-            before, after = [0], [0]
+            self.weights = (overlap == step).astype(np.float64)
         else:  # fractions
-            before, after = [(fsa - f.start) / step], [(f.end - feb) / step]
-        if fully_inside:
-            after = []
-            before = [((f.start - feb) + (fsa - f.end)) / step], []
-        return before, after
-
-    result = 0
-    f1sb = int(math.floor(fragment1.start / step) * step)
-    f1sa = int(math.ceil(fragment1.start / step) * step)
-    f1eb = int(math.floor(fragment1.end / step) * step)
-    f1ea = int(math.ceil(fragment1.end / step) * step)
-
-    if f1eb <= f1sa:
-        logger.warning("Fragment {fragment} is short ({f_length} is less than 2 bins of size {size}).".format(fragment=fragment1.name, size=step,
-                                                                                                              f_length=fragment1.end - fragment1.start))
-        logger.debug("Fragment {f}: start={start}, end={end}, fsb={fsb}, fsa={fsa}, feb={feb}, fea={fea}"
-                     "".format(f=fragment1.name, start=fragment1.start, end=fragment1.end, fsb=f1sb, fsa=f1sa, feb=f1eb, fea=f1ea))
-
-    f2sb = int(math.floor(fragment2.start / step) * step)
-    f2sa = int(math.ceil(fragment2.start / step) * step)
-    f2eb = int(math.floor(fragment2.end / step) * step)
-    f2ea = int(math.ceil(fragment2.end / step) * step)
-
-    if f2eb <= f2sa:
-        logger.warning("Fragment {fragment} is short ({f_length} is less than 2 bins of size {size}).".format(fragment=fragment2.name, size=step,
-                                                                                                              f_length=fragment2.end - fragment2.start))
-        logger.debug("Fragment {f}: start={start}, end={end}, fsb={fsb}, fsa={fsa}, feb={feb}, fea={fea}"
-                     "".format(f=fragment2.name, start=fragment2.start, end=fragment2.end, fsb=f2sb, fsa=f2sa, feb=f2eb, fea=f2ea))
-
-    f1_inner_multipliers = [1] * (f1eb - f1sa)  # in case of short fragment multiplication will happen with negative number and en empty list will be produced
-    f2_inner_multipliers = [1] * (f2eb - f2sa)  # same
-
-    f1b, f1a = get_before_after_indexes(f=fragment1, fsa=f1sa, feb=f1eb, fully_inside=f1sb == f1eb and f1sa == f1ea, measure=measure)
-    f2b, f2a = get_before_after_indexes(f=fragment1, fsa=f1sa, feb=f1eb, fully_inside=f2sb == f2eb and f2sa == f2ea, measure=measure)
-
-    f1_multipliers = f1b + f1_inner_multipliers + f1a
-    f2_multipliers = f2b + f2_inner_multipliers + f2a
-
-    f1_indexes = range(f1sb, f1ea, step)
-    f2_indexes = range(f2sb, f2ea, step)
-
-    counted = set()
-    list_result = []
-    for f1_index, f1_multiplier in zip(f1_indexes, f1_multipliers):
-        current = []
-        for f2_index, f2_multiplier in zip(f2_indexes, f2_multipliers):
-            value = get_contact(data=hic_data, i=f1_index, im=f1_multiplier, j=f2_index, jm=f2_multiplier, observed=counted)
-            current.append(value)
-            result += value
-        list_result.append(current)
-    return result, list_result
+            self.weights = overlap / step
+        # bins, whose multiplier was an integer in the original per-pair implementation,
+        # an absent contact in them is reported as "0" rather than "0.0"
+        self.exact = self.weights == 1.0 if measure == "fractions" else np.ones(len(self.bins), dtype=bool)
+        self.inexact = np.bincount(self.owners[~self.exact], minlength=len(fragments)) > 0
+
+    @property
+    def bins_cnt(self):
+        return int(self.last.max()) if len(self.fragments) > 0 else 0
+
+    @property
+    def names(self):
+        """ numpy object array of fragment names """
+        if isinstance(self.fragments, FragmentArrays):
+            return self.fragments.names
+        return np.array([f.name for f in self.fragments], dtype=object)
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def matrix(self, bins_cnt, weighted=True):
+        """ A sparse (bins x fragments) matrix W, such that W^T * A * W' yields fragment contacts totals
+
+        Being stored row wise, it is also a sorted bin -> overlapping fragments interval index,
+        so that products with it only touch fragments, that overlap bins with hic entries.
+        """
+        data = self.weights if weighted else np.ones(len(self.bins), dtype=np.float64)
+        return sparse.csr_matrix((data, (self.bins, self.owners)), shape=(bins_cnt, len(self.fragments)))
+
+    def slice(self, i):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+
+class FragmentIndex(object):
+    """ Fragments, that are longer than frag_lengths, grouped by chromosome (in the original order), with their FragmentBins built
+    on demand and kept, so that contacts of many chromosome pairs are computed in a single process from a single fragments list
+
+    Fragments of every chromosome are FragmentArrays, sliced from a FragmentCatalog, and filtered by length with a single vectorized pass.
+    """
+
+    def __init__(self, fragments, frag_lengths=-1):
+        """
+        :param fragments: FragmentCatalog (see fragment_catalog.load_fragment_catalog), or a list of Fragment instances
+        """
+        if not isinstance(fragments, FragmentCatalog):
+            fragments = FragmentCatalog.from_fragments(fragments)
+        self.catalog = fragments
+        self.frag_lengths = frag_lengths
+        self.fragments_cnt = len(fragments)
+        self.chromosomes = collections.OrderedDict()
+        for chromosome in fragments.chromosomes:
+            chromosome_fragments = fragments.fragments(chromosome, longer_than=frag_lengths)
+            if len(chromosome_fragments) > 0:
+                self.chromosomes[chromosome] = chromosome_fragments
+        self._bins = {}
+
+    def __len__(self):
+        return sum(len(fragments) for fragments in self.chromosomes.values())
+
+    def fragments(self, chromosome):
+        return self.chromosomes.get(chromosome, FragmentArrays(chromosome, np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64),
+                                                               np.zeros(0, dtype=np.int64)))
+
+    def bins(self, chromosome, step, measure):
+        key = (chromosome, step, measure)
+        if key not in self._bins:
+            self._bins[key] = FragmentBins(fragments=self.fragments(chromosome), step=step, measure=measure)
+        return self._bins[key]
+
+
+class FragmentGroups(object):
+    """ Fragment -> group mapping (a fragment may belong to several groups), groups are numbered in the order of their first appearance """
+
+    def __init__(self, fragment_names, group_names, path=None):
+        self.path = path
+        codes, self.names = pd.factorize(np.asarray(group_names, dtype=object))
+        self.names = list(self.names)
+        self.groups = {}
+        for fragment_name, code in zip(fragment_names, codes.tolist()):
+            self.groups.setdefault(fragment_name, []).append(code)
+
+    def __len__(self):
+        return len(self.names)
+
+    def indicator(self, names):
+        """ Sparse (fragments x groups) matrix G, such that G[i, g] is 1, if fragment names[i] belongs to group g """
+        rows, columns = [], []
+        for index, name in enumerate(names):
+            for group in self.groups.get(name, ()):
+                rows.append(index)
+                columns.append(group)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, columns)), shape=(len(names), len(self.names)))
+
+
+def read_groups(groups_filename, separator="\t"):
+    """ Reads "fragment<SEPARATOR>group" lines (such as ensembl/create_mapping.py components) into FragmentGroups """
+    df = pd.read_csv(groups_filename, sep=separator, header=None, usecols=[0, 1], dtype=str, keep_default_na=False, compression="infer", quoting=3)
+    return FragmentGroups(df[0].values, df[1].values, path=os.path.abspath(groups_filename))
+
+
+def aggregate_groups(contacts_values, contacts_observed, indicator1, indicator2, same_chromosomes):
+    """ Group x group contacts totals G1^T * C * G2 and numbers of observed fragment pairs, that contribute to them
+
+    For intra chromosomal contacts only pairs of fragments, that frag_matrix reports (upper triangle of C), are counted,
+    and every unordered pair of groups is reported once, in the (group1 <= group2) orientation.
+
+    :param contacts_values: (fragments1 x fragments2) sparse matrix of contacts totals (see count_contacts)
+    :param contacts_observed: (fragments1 x fragments2) sparse matrix of hic entries counts
+    :param indicator1: (fragments1 x groups) indicator matrix (see FragmentGroups.indicator)
+    :param indicator2: (fragments2 x groups) indicator matrix
+    :return: pair of (groups x groups) sparse matrices: contacts totals and observed fragment pairs counts
+    """
+    observed = (contacts_observed > 0).astype(np.float64)
+    if same_chromosomes:
+        contacts_values, observed = sparse.triu(contacts_values), sparse.triu(observed)
+    totals = indicator1.T.dot(contacts_values).dot(indicator2)
+    pairs = indicator1.T.dot(observed).dot(indicator2)
+    if same_chromosomes:
+        totals = sparse.triu(totals) + sparse.tril(totals, -1).T
+        pairs = sparse.triu(pairs) + sparse.tril(pairs, -1).T
+    return totals.tocsr(), pairs.tocsr()
+
+
+def write_group_contacts(output, header, groups, totals, pairs):
+    """ Writes "group1<TAB>group2<TAB>total<TAB>fragment pairs" lines for pairs of groups with at least one observed fragment pair
+
+    :return: number of written pairs of groups
+    """
+    pairs = pairs.tocoo()
+    order = np.lexsort((pairs.col, pairs.row))
+    rows, columns, counts = pairs.row[order], pairs.col[order], pairs.data[order]
+    values = np.asarray(totals[rows, columns]).ravel() if len(rows) > 0 else np.zeros(0)
+    for line in header:
+        print(line, file=output)
+    for row, column, value, count in zip(rows.tolist(), columns.tolist(), values.tolist(), counts.tolist()):
+        print(groups.names[row], groups.names[column], value, int(round(count)), sep="\t", file=output)
+    return len(rows)
+
+
+def resize_hic_data(hic_data, shape):
+    """ Pads hic data matrix with empty rows/columns, so that it covers all of the fragments bins """
+    shape = (max(hic_data.shape[0], shape[0]), max(hic_data.shape[1], shape[1]))
+    if shape != hic_data.shape:
+        hic_data = hic_data.copy()
+        hic_data.resize(shape)
+    return hic_data
+
+
+def count_contacts(hic_data, bins1, bins2):
+    """ Computes contacts totals for all pairs of fragments as a single sparse W1^T * A * W2 product
+
+    :param hic_data: scipy.sparse.csr_matrix like data storage (see load_hic_data), that covers all bins of both fragment sets
+    :param bins1: FragmentBins for fragments, whose bins are rows of hic_data
+    :param bins2: FragmentBins for fragments, whose bins are columns of hic_data
+    :return: a pair of (fragments1 x fragments2) sparse matrices: weighted contacts totals and counts of observed hic entries
+    """
+    rows_cnt, columns_cnt = hic_data.shape
+    totals = bins1.matrix(rows_cnt).T.tocsr().dot(hic_data).dot(bins2.matrix(columns_cnt)).tocsr()
+    pattern = sparse.csr_matrix((np.ones(hic_data.nnz, dtype=np.float64), hic_data.indices, hic_data.indptr), shape=hic_data.shape)
+    observed = bins1.matrix(rows_cnt, weighted=False).T.tocsr().dot(pattern).dot(bins2.matrix(columns_cnt, weighted=False)).tocsr()
+    return totals, observed
+
+
+def contacts_submatrix(hic_data, bins1, i, bins2, j, observed=True):
+    """ Per bin contacts between two fragments
+
+    :param hic_data: scipy.sparse.csr_matrix like data storage, that covers all bins of both fragment sets
+    :param bins1: FragmentBins for fragments, whose bins are rows of hic_data
+    :param i: index of the first fragment in bins1
+    :param bins2: FragmentBins for fragments, whose bins are columns of hic_data
+    :param j: index of the second fragment in bins2
+    :param observed: whether there is any hic entry between the two fragments (hic data is not sliced otherwise)
+    :return: (bins of fragment i x bins of fragment j) array of contacts values and a mask of values, that are formatted as floats
+    """
+    w1, w2 = bins1.weights[bins1.slice(i)], bins2.weights[bins2.slice(j)]
+    e1, e2 = bins1.exact[bins1.slice(i)], bins2.exact[bins2.slice(j)]
+    values = np.zeros((len(w1), len(w2)), dtype=np.float64)
+    stored = np.zeros((len(w1), len(w2)), dtype=bool)
+    if observed:
+        submatrix = hic_data[bins1.first[i]:bins1.last[i], bins2.first[j]:bins2.last[j]].tocoo()
+        values[submatrix.row, submatrix.col] = submatrix.data
+        stored[submatrix.row, submatrix.col] = True
+    values = values * w1[:, np.newaxis] * w2[np.newaxis, :]
+    as_float = stored | ~(e1[:, np.newaxis] & e2[np.newaxis, :])
+    return values, as_float
+
+
+def contacts_entries(hic_data, bins1, i, bins2, j, observed=True):
+    """ Per bin contacts between two fragments at hic entries only, in CSR form (see contacts_submatrix for a dense submatrix)
+
+    :return: row pointers, column indexes and contacts values of hic entries between bins of fragment i and of fragment j,
+        and whether weights of bins of fragment i and of fragment j are exact
+    """
+    w1, w2 = bins1.weights[bins1.slice(i)], bins2.weights[bins2.slice(j)]
+    e1, e2 = bins1.exact[bins1.slice(i)], bins2.exact[bins2.slice(j)]
+    if not observed:
+        return np.zeros(len(w1) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), e1, e2
+    submatrix = hic_data[bins1.first[i]:bins1.last[i], bins2.first[j]:bins2.last[j]].tocsr()
+    submatrix.sort_indices()
+    rows = np.repeat(np.arange(len(w1)), np.diff(submatrix.indptr))
+    return submatrix.indptr, submatrix.indices, submatrix.data * w1[rows] * w2[submatrix.indices], e1, e2
+
+
+def format_matrix_rows(values, as_float):
+    """ Tab separated rows of a contacts submatrix (absent contacts with integer multipliers are reported as "0") """
+    return ["\t".join(str(value) if is_float else "0" for value, is_float in zip(values_row, as_float_row))
+            for values_row, as_float_row in zip(values.tolist(), as_float.tolist())]
+
+
+def contacts_matrix(hic_data, bins1, i, bins2, j, observed=True):
+    """ Per bin contacts between two fragments, as a list of formatted rows (one per bin of fragment i), see contacts_submatrix """
+    values, as_float = contacts_submatrix(hic_data=hic_data, bins1=bins1, i=i, bins2=bins2, j=j, observed=observed)
+    return format_matrix_rows(values, as_float)
+
+
+def get_pairs_entries(matrix, pairs1, pairs2):
+    """ Entries of a sparse matrix at (pairs1[k], pairs2[k]) positions as a flat numpy array """
+    if len(pairs1) == 0:
+        return np.zeros(0, dtype=matrix.dtype)
+    return np.asarray(matrix[pairs1, pairs2]).ravel()
+
+
+def format_total(value, is_float):
+    return str(value) if is_float else "0"
+
+
+def fragment_pairs(bins1, bins2, same_chromosomes):
+    """ Fragment pairs to report, ordered by their (sorted) names
+
+    Every unordered pair of names is reported once, with a (fragment1, fragment2) orientation,
+    in which it is encountered first, when iterating over fragments1 x fragments2
+
+    :param bins1: FragmentBins for the first set of fragments
+    :param bins2: FragmentBins for the second set of fragments
+    :param same_chromosomes: whether both fragment sets are the same (intra chromosomal contacts)
+    :return: indexes of fragments in both sets and indexes of the ordered pair of names in the returned names array
+    """
+    if same_chromosomes:
+        pairs1, pairs2 = np.triu_indices(len(bins1))
+    else:
+        pairs1 = np.repeat(np.arange(len(bins1)), len(bins2))
+        pairs2 = np.tile(np.arange(len(bins2)), len(bins1))
+    return order_fragment_pairs(bins1, bins2, pairs1, pairs2)
+
+
+def observed_fragment_pairs(bins1, bins2, contacts_observed, same_chromosomes):
+    """ Same as fragment_pairs, but only for pairs of fragments, that have at least one hic entry between their bins
+
+    :param contacts_observed: (fragments1 x fragments2) sparse matrix of hic entries counts (see count_contacts)
+    """
+    observed = contacts_observed.tocoo()
+    pairs1, pairs2 = observed.row.astype(np.int64), observed.col.astype(np.int64)
+    if same_chromosomes:
+        upper = pairs1 <= pairs2
+        pairs1, pairs2 = pairs1[upper], pairs2[upper]
+    return order_fragment_pairs(bins1, bins2, pairs1, pairs2)
+
+
+def order_fragment_pairs(bins1, bins2, pairs1, pairs2):
+    names, ranks = np.unique(np.concatenate([bins1.names, bins2.names]), return_inverse=True)
+    ranks1, ranks2 = ranks[:len(bins1)][pairs1], ranks[len(bins1):][pairs2]
+    swapped = ranks1 >= ranks2
+    keys1, keys2 = np.where(swapped, ranks2, ranks1), np.where(swapped, ranks1, ranks2)
+    order = np.lexsort((pairs2, pairs1, keys2, keys1))
+    keys1, keys2 = keys1[order], keys2[order]
+    unique = np.ones(len(order), dtype=bool)
+    unique[1:] = (keys1[1:] != keys1[:-1]) | (keys2[1:] != keys2[:-1])
+    order = order[unique]
+    return pairs1[order], pairs2[order], names, keys1[unique], keys2[unique]
 
 
 def get_chromosomes_from_hic_filename(hic):
@@ -131,6 +379,393 @@ def get_step_from_hic_filename(hic):
     return int(os.path.basename(hic).split("_")[3])
 
 
+VALIDATED_METADATA = ["hic source", "fragments source", "measure", "bin size", "fragment min. size", "chromosome 1", "chromosome 2"]
+# metadata, that is only reported, when it differs from the default value
+OPTIONAL_METADATA = [("normalization", "NONE"), ("data", "observed")]
+
+
+def get_output_metadata(hic, fragments_filename, measure, step, frag_lengths, chr1, chr2, norm="NONE", data="observed"):
+    """ Output header values, that must match for results of two runs to be interchangeable """
+    return {"hic source": os.path.abspath(hic), "fragments source": os.path.abspath(fragments_filename), "measure": measure,
+            "bin size": str(step), "fragment min. size": str(frag_lengths), "chromosome 1": chr1, "chromosome 2": chr2,
+            "normalization": norm, "data": data}
+
+
+def get_output_header(hic, fragments_filename, measure, step, frag_lengths, chr1, chr2, f1_cnt, f2_cnt, norm="NONE", data="observed"):
+    """ Header lines of the text output """
+    optional = {"normalization": norm, "data": data}
+    return ["# python :: {python_version}".format(python_version=".".join(map(str, sys.version_info))),
+            "# hic source :: {hic} ".format(hic=os.path.abspath(hic)),
+            "# fragments source :: {fragments}".format(fragments=os.path.abspath(fragments_filename)),
+            "# measure :: {measure}".format(measure=measure),
+            "# bin size :: {step}".format(step=step),
+            "# fragment min. size :: {f_lengths}".format(f_lengths=frag_lengths),
+            "# chromosome 1 :: {f1}".format(f1=chr1),
+            "# chromosome 2 :: {f2}".format(f2=chr2),
+            "# chromosome {chr1} fragment cnt :: {f1_cnt}".format(f1_cnt=f1_cnt, chr1=chr1),
+            "# chromosome {chr2} fragment cnt :: {f2_cnt}".format(f2_cnt=f2_cnt, chr2=chr2)] + \
+           ["# {key} :: {value}".format(key=key, value=optional[key]) for key, default in OPTIONAL_METADATA if optional[key] != default]
+
+
+def get_fragments_path(output_path):
+    """ Path of a file, that stores coordinates of fragments, that output results were computed for """
+    return output_path + ".fragments"
+
+
+def write_fragments(fragments_filename, fragments):
+    with open(fragments_filename, "wt") as dest:
+        for fragment in fragments:
+            print(fragment.name, fragment.start, fragment.end, fragment.chromosome, sep="\t", file=dest)
+
+
+def get_changed_fragments(fragments, previous_fragments):
+    """ Names of fragments, whose coordinates differ from (or are missing in) the previous fragments list """
+    previous = {f.name: (f.start, f.end, f.chromosome) for f in previous_fragments}
+    return set(f.name for f in fragments if previous.get(f.name) != (f.start, f.end, f.chromosome))
+
+
+class ExistingContacts(object):
+    """ Sequential reader of a previous frag_matrix output
+
+    Lines are looked up in the same (sorted by fragments names) order, as they are reported in,
+    so the whole file is read in a single pass without being held in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.metadata = {}
+        self.contact = None
+        self._source = open_text_input(path)
+        self._key = None
+        self._line = None
+        self._advance()
+        if self._line is not None:
+            self.contact = "value" if len(self._line.rstrip("\n").split("\t")) == 3 else "matrix"
+
+    def _advance(self):
+        line = self._source.readline()
+        while line.startswith("#"):
+            if " :: " in line:
+                key, value = line[1:].split(" :: ", 1)
+                self.metadata[key.strip()] = value.strip()
+            line = self._source.readline()
+        if not line.endswith("\n"):  # end of file, or an incomplete last line of an interrupted run
+            self._key, self._line = None, None
+            return
+        fields = line.split("\t", 2)
+        self._key, self._line = (fields[0], fields[1]), line
+
+    def get(self, key1, key2):
+        """ Previously reported line for a pair of fragments (keys must be queried in ascending order), or None """
+        while self._key is not None and self._key < (key1, key2):
+            self._advance()
+        return self._line if self._key == (key1, key2) else None
+
+    def validate(self, metadata, contact):
+        """ Raises ValueError, if previous results were produced with different settings """
+        for key in VALIDATED_METADATA:
+            if self.metadata.get(key) != metadata[key]:
+                raise ValueError("Existing results {path} have {key} \"{existing}\", while \"{current}\" is expected"
+                                 "".format(path=self.path, key=key, existing=self.metadata.get(key), current=metadata[key]))
+        for key, default in OPTIONAL_METADATA:
+            if self.metadata.get(key, default) != metadata.get(key, default):
+                raise ValueError("Existing results {path} have {key} \"{existing}\", while \"{current}\" is expected"
+                                 "".format(path=self.path, key=key, existing=self.metadata.get(key, default), current=metadata.get(key, default)))
+        if self.contact is not None and self.contact != contact:
+            raise ValueError("Existing results {path} contain contact {existing}, while {current} is expected"
+                             "".format(path=self.path, existing=self.contact, current=contact))
+
+    def close(self):
+        self._source.close()
+
+
+def open_text_input(path):
+    """ Opens a (possibly gzip compressed, see bgzf.py) frag_matrix output for reading """
+    if is_bgzf_path(path):
+        return io.TextIOWrapper(gzip.open(path, "rb"))
+    return open(path, "rt")
+
+
+def open_partial_output(output_path, compress_threads=1):
+    """ Opens "<output_path>.partial" for writing, as a BGZF stream with a block index (see bgzf.py), if output_path ends with .gz """
+    partial_path = output_path + ".partial"
+    if is_bgzf_path(output_path):
+        return BgzfWriter(partial_path, index_path=get_bgzf_index_path(partial_path), threads=compress_threads)
+    return open(partial_path, "wt")
+
+
+def finish_partial_output(output_path):
+    """ Renames complete partial results (and their block index) to output_path """
+    partial_path = output_path + ".partial"
+    if is_bgzf_path(output_path):
+        os.rename(get_bgzf_index_path(partial_path), get_bgzf_index_path(output_path))
+    os.rename(partial_path, output_path)
+
+
+def get_resume_key(partial_path, metadata, contact, fragments):
+    """ Prepares results of an interrupted run for being continued
+
+    If partial results were produced with the same settings and fragments, they are truncated
+    to the last complete line and the (sorted) key of this line is returned, None otherwise.
+    """
+    if not os.path.exists(partial_path) or not os.path.exists(get_fragments_path(partial_path)):
+        return None
+    partial = ExistingContacts(partial_path)
+    try:
+        partial.validate(metadata, contact)
+    except ValueError as error:
+        logger.warning("Not resuming from {path}: {error}".format(path=partial_path, error=error))
+        partial.close()
+        return None
+    partial.close()
+    previous_fragments = get_fragments(get_fragments_path(partial_path))
+    if len(fragments) != len(previous_fragments) or len(get_changed_fragments(fragments, previous_fragments)) > 0:
+        logger.warning("Not resuming from {path}: fragments have changed".format(path=partial_path))
+        return None
+    resume_key, complete_size = None, 0
+    with open(partial_path, "rt") as source:
+        for line in source:
+            if not line.endswith("\n"):
+                break
+            complete_size += len(line)
+            if not line.startswith("#"):
+                fields = line.split("\t", 2)
+                resume_key = (fields[0], fields[1])
+    with open(partial_path, "at") as dest:
+        dest.truncate(complete_size)
+    return resume_key if resume_key is not None else ("", "")
+
+
+def write_binary_contacts(output_path, hic_data, bins1, bins2, pairs1, pairs2, names, keys1, keys2, pairs_values, pairs_float, pairs_entries,
+                          metadata, header, dtype=np.float64):
+    """ Writes per bin contacts of all reported fragment pairs down in a compact binary format (see frag_matrix_binary)
+
+    :param pairs_entries: number of hic entries between bins of every pair (see count_contacts)
+    """
+    rows_key1 = bins1.names[pairs1] == names[keys1]
+    # only names of fragments of reported pairs are stored, keys are renumbered accordingly (names stay sorted)
+    used = np.unique(np.concatenate([keys1, keys2]))
+    names, keys1, keys2 = names[used], np.searchsorted(used, keys1), np.searchsorted(used, keys2)
+    bins_cnt1, bins_cnt2 = np.diff(bins1.offsets), np.diff(bins2.offsets)
+    writer = BinaryContactsWriter(output_path, names=names.tolist(), keys1=keys1, keys2=keys2, rows_cnt=bins_cnt1[pairs1], columns_cnt=bins_cnt2[pairs2],
+                                  entries_cnt=pairs_entries, totals=pairs_values, totals_float=pairs_float, rows_key1=rows_key1, attributes=metadata,
+                                  header_lines=header, dtype=dtype)
+    for i, j, entries_cnt in zip(pairs1.tolist(), pairs2.tolist(), pairs_entries.tolist()):
+        writer.write(*contacts_entries(hic_data=hic_data, bins1=bins1, i=i, bins2=bins2, j=j, observed=entries_cnt > 0))
+    writer.close()
+    logger.info("Wrote {p_cnt} fragment pairs to {output}".format(p_cnt=len(pairs1), output=output_path))
+
+
+def compute_frag_matrix(hic, fragments, fragments_filename, output, measure="inner", contact="matrix", frag_lengths=-1, write_zeros=False,
+                        use_cache=True, chromosomes=None, bin_size=None, norm="NONE", existing=None, checkpoint_interval=10000,
+                        output_format="text", binary_dtype=np.float64, metrics=None, data="observed", fragment_index=None, groups=None,
+                        compress_threads=1):
+    """ Computes contacts between all fragments of a chromosome pair and writes them down in a text (or binary) format
+
+    If output is a path, results are written to "<output>.partial" first, which is flushed to disk every
+    checkpoint_interval pairs and is renamed to output on completion. Partial results of an interrupted run
+    with the same settings and fragments are continued rather than recomputed. Outputs, whose path ends with .gz, are written
+    as BGZF streams (see bgzf.py), compressed in compress_threads threads, such runs are not resumed.
+
+    :param hic: path to a Juicer dump, named as "cell-line_chr1_chr2_resolution_correction.txt", to a genome store (see genome_store.py),
+                or to a .hic file
+    :param fragments: FragmentCatalog or a list of Fragment instances (for the whole genome), ignored if fragment_index is given
+    :param fragments_filename: path, the fragments were loaded from (reported in the output header)
+    :param output: an open file object or a path to write results to
+    :param measure: a choice of a measure (inner/outer/fraction)
+    :param contact: whether to report contacts totals (value) or per bin contacts (matrix)
+    :param frag_lengths: fragments, that are not longer than this, are ignored
+    :param write_zeros: whether to report pairs of fragments without any hic entry between them
+    :param use_cache: whether to use a binary sidecar cache of the parsed dump
+    :param chromosomes: pair of chromosomes to read, if hic is a genome store or a .hic file
+    :param bin_size: resolution to read, required if hic is a .hic file, for dumps a resolution coarser than
+                     the one in the file name is read from the dump pyramid (see hic_dump.build_pyramid),
+                     for genome stores it defaults to the store resolution
+    :param norm: normalization to read, if hic is a .hic file
+    :param existing: path to results of a previous run with the same settings, only missing pairs
+                     and pairs with fragments, whose coordinates have changed, are recomputed
+    :param checkpoint_interval: number of reported pairs between flushes of partial results to disk
+    :param output_format: text, or binary (see frag_matrix_binary, output must be a path, existing results are not reused)
+    :param binary_dtype: type of per bin contacts values in the binary format (float64 or float32)
+    :param data: observed contacts, or observed / expected ones (oe, see expected.py)
+    :param metrics: metrics.Metrics instance to record stages of the run to (a new one is created by default)
+    :param fragment_index: FragmentIndex, shared by runs for many chromosome pairs (built from fragments by default)
+    :param compress_threads: number of threads, compressing .gz text output
+    :param groups: FragmentGroups, if given, group x group contacts totals are written instead of fragment pairs (see aggregate_groups)
+    :return: metrics of the run
+    """
+    if output_format == "binary" and (not isinstance(output, six.string_types) or existing is not None):
+        raise ValueError("Binary output requires an output path and can not reuse existing results")
+    if groups is not None and (output_format == "binary" or existing is not None):
+        raise ValueError("Group contacts are only written in the text format and can not reuse existing results")
+    metrics = Metrics() if metrics is None else metrics
+    if is_hic_file(hic):
+        if chromosomes is None or bin_size is None:
+            raise ValueError("Chromosomes and bin size are required, when hic source is a .hic file")
+        chr1, chr2 = chromosomes
+        step, dump_step = bin_size, None
+    elif is_genome_store(hic):
+        if chromosomes is None:
+            raise ValueError("Chromosomes are required, when hic source is a genome store")
+        chr1, chr2 = chromosomes
+        step, dump_step = bin_size if bin_size is not None else open_genome_store(hic).bin_size, None
+    else:
+        chr1, chr2 = get_chromosomes_from_hic_filename(hic=hic)
+        dump_step = get_step_from_hic_filename(hic=hic)
+        step = dump_step if bin_size is None else bin_size
+    logger.info("Working with chromosomes {chr1} and {chr2} and a step of {step}".format(chr1=chr1, chr2=chr2, step=step))
+    with metrics.stage("fragment_filter", items="fragments") as counts:
+        if fragment_index is None:
+            if frag_lengths > 0:
+                logger.info("Filtering out fragments shorter than {f_length_thresh}".format(f_length_thresh=frag_lengths))
+            fragment_index = FragmentIndex(fragments=fragments, frag_lengths=frag_lengths)
+            if frag_lengths > 0:
+                logger.info("A total of {f_cnt} are longer than {f_length_thresh}".format(f_cnt=len(fragment_index), f_length_thresh=frag_lengths))
+        elif fragment_index.frag_lengths != frag_lengths:
+            raise ValueError("Fragment index is built for fragments longer than {index}, rather than {f_length_thresh}"
+                             "".format(index=fragment_index.frag_lengths, f_length_thresh=frag_lengths))
+        counts["fragments"] = fragment_index.fragments_cnt
+        logger.info("Taking fragments that belong to {chr1} or {chr2} chromosomes".format(chr1=chr1, chr2=chr2))
+        fragments1, fragments2 = fragment_index.fragments(chr1), fragment_index.fragments(chr2)
+        counts["fragments1"], counts["fragments2"] = len(fragments1), len(fragments2)
+    logger.info("Will be computing pairwise contact between {f1_cnt} and {f2_cnt} fragments".format(f1_cnt=len(fragments1), f2_cnt=len(fragments2)))
+    logger.info("Loading HiC data from {hic_filename}".format(hic_filename=os.path.basename(hic)))
+    with metrics.stage("load", items="hic_records") as counts:
+        hic_data = load_hic_data(hic_filename=hic, step=step, use_cache=use_cache, chromosomes=(chr1, chr2), norm=norm,
+                                 dump_step=dump_step, data=data)
+        counts["hic_records"] = hic_data.nnz
+    with metrics.stage("fragment_bins", items="bins") as counts:
+        bins1 = fragment_index.bins(chr1, step=step, measure=measure)
+        bins2 = fragment_index.bins(chr2, step=step, measure=measure)
+        counts["bins"] = len(bins1.bins) + (0 if chr1 == chr2 else len(bins2.bins))
+        counts["short_fragments"] = int(bins1.short.sum()) + (0 if chr1 == chr2 else int(bins2.short.sum()))
+    if logger.isEnabledFor(logging.WARNING):
+        for fragment_bins in ([bins1] if chr1 == chr2 else [bins1, bins2]):
+            for index in np.flatnonzero(fragment_bins.short):
+                fragment = fragment_bins.fragments[index]
+                logger.warning("Fragment {fragment} is short ({f_length} is less than 2 bins of size {size})."
+                               "".format(fragment=fragment.name, size=step, f_length=fragment.end - fragment.start))
+    logger.info("Computing contacts")
+    with metrics.stage("contacts", items="pairs") as counts:
+        hic_data = resize_hic_data(hic_data=hic_data, shape=(bins1.bins_cnt, bins2.bins_cnt))
+        contacts_values, contacts_observed = count_contacts(hic_data=hic_data, bins1=bins1, bins2=bins2)
+        counts["pairs"] = contacts_observed.nnz
+    if groups is not None:
+        logger.info("Aggregating contacts of {g_cnt} fragment groups".format(g_cnt=len(groups)))
+        header = get_output_header(hic=hic, fragments_filename=fragments_filename, measure=measure, step=step, frag_lengths=frag_lengths,
+                                   chr1=chr1, chr2=chr2, f1_cnt=len(fragments1), f2_cnt=len(fragments2), norm=norm, data=data)
+        if groups.path is not None:
+            header.append("# groups :: {groups}".format(groups=groups.path))
+        with metrics.stage("groups", items="group_pairs") as counts:
+            indicator1 = groups.indicator(bins1.names)
+            indicator2 = indicator1 if chr1 == chr2 else groups.indicator(bins2.names)
+            counts["grouped_fragments"] = int((indicator1.getnnz(axis=1) > 0).sum())
+            if chr1 != chr2:
+                counts["grouped_fragments"] += int((indicator2.getnnz(axis=1) > 0).sum())
+            totals, pairs = aggregate_groups(contacts_values, contacts_observed, indicator1, indicator2, same_chromosomes=chr1 == chr2)
+        with metrics.stage("output", items="group_pairs") as counts:
+            if isinstance(output, six.string_types):
+                with open_partial_output(output, compress_threads=compress_threads) as dest:
+                    counts["group_pairs"] = write_group_contacts(dest, header, groups, totals, pairs)
+                finish_partial_output(output)
+            else:
+                counts["group_pairs"] = write_group_contacts(output, header, groups, totals, pairs)
+        logger.info("Wrote {g_cnt} pairs of groups".format(g_cnt=counts["group_pairs"]))
+        return metrics
+    with metrics.stage("pairs", items="pairs") as counts:
+        if write_zeros:
+            pairs1, pairs2, names, keys1, keys2 = fragment_pairs(bins1=bins1, bins2=bins2, same_chromosomes=chr1 == chr2)
+        else:
+            pairs1, pairs2, names, keys1, keys2 = observed_fragment_pairs(bins1=bins1, bins2=bins2, contacts_observed=contacts_observed,
+                                                                          same_chromosomes=chr1 == chr2)
+        logger.info("A total of {p_cnt} fragment pairs will be reported".format(p_cnt=len(pairs1)))
+        pairs_values = get_pairs_entries(contacts_values, pairs1, pairs2).tolist()
+        pairs_entries = np.rint(get_pairs_entries(contacts_observed, pairs1, pairs2)).astype(np.int64)
+        pairs_observed = pairs_entries > 0
+        bins_cnt1, bins_cnt2 = np.diff(bins1.offsets), np.diff(bins2.offsets)
+        pairs_float = (pairs_observed | (bins1.inexact[pairs1] & (bins_cnt2[pairs2] > 0)) | (bins2.inexact[pairs2] & (bins_cnt1[pairs1] > 0))).tolist()
+        counts["pairs"], counts["observed_pairs"] = len(pairs1), int(pairs_observed.sum())
+    logger.info("Computed all pairwise contacts. Outputting results.")
+    reported_fragments = list(fragments1) if chr1 == chr2 else list(fragments1) + list(fragments2)
+    metadata = get_output_metadata(hic=hic, fragments_filename=fragments_filename, measure=measure, step=step, frag_lengths=frag_lengths,
+                                   chr1=chr1, chr2=chr2, norm=norm, data=data)
+    if output_format == "binary":
+        header = get_output_header(hic=hic, fragments_filename=fragments_filename, measure=measure, step=step, frag_lengths=frag_lengths,
+                                   chr1=chr1, chr2=chr2, f1_cnt=len(fragments1), f2_cnt=len(fragments2), norm=norm, data=data)
+        with metrics.stage("output", items="pairs") as counts:
+            write_binary_contacts(output, hic_data, bins1, bins2, pairs1, pairs2, names, keys1, keys2, pairs_values, pairs_float, pairs_entries,
+                                  metadata, header, dtype=binary_dtype)
+            counts["pairs"] = counts["computed_pairs"] = len(pairs1)
+        return metrics
+    existing_contacts, changed_fragments = None, set()
+    if existing is not None:
+        logger.info("Reusing unchanged results from {existing}".format(existing=existing))
+        existing_contacts = ExistingContacts(existing)
+        existing_contacts.validate(metadata, contact)
+        if os.path.exists(get_fragments_path(existing)):
+            changed_fragments = get_changed_fragments(reported_fragments, get_fragments(get_fragments_path(existing)))
+            logger.info("A total of {f_cnt} fragments have changed since the existing results".format(f_cnt=len(changed_fragments)))
+        else:
+            logger.warning("No fragments coordinates are stored for {existing}, assuming them unchanged".format(existing=existing))
+    resume_key, output_path, compressed = None, None, False
+    if isinstance(output, six.string_types):
+        output_path, partial_path, compressed = output, output + ".partial", is_bgzf_path(output)
+        if not compressed:
+            resume_key = get_resume_key(partial_path, metadata, contact, reported_fragments)
+        if resume_key is not None:
+            logger.info("Resuming interrupted run from {partial}".format(partial=partial_path))
+            output = open(partial_path, "at")
+        else:
+            output = open_partial_output(output_path, compress_threads=compress_threads)
+            write_fragments(get_fragments_path(partial_path), reported_fragments)
+    if resume_key is None:
+        for line in get_output_header(hic=hic, fragments_filename=fragments_filename, measure=measure, step=step, frag_lengths=frag_lengths,
+                                      chr1=chr1, chr2=chr2, f1_cnt=len(fragments1), f2_cnt=len(fragments2), norm=norm, data=data):
+            print(line, file=output)
+    debug_pairs = logger.isEnabledFor(logging.DEBUG)
+    with metrics.stage("output", items="pairs") as counts:
+        reused_cnt, computed_cnt, skipped_cnt = 0, 0, 0
+        # lines are formatted into a batch, that is written out (and, for uncompressed outputs, flushed to disk) every checkpoint_interval pairs
+        batch = []
+        for i, j, key1, key2, value, is_float, is_observed in zip(pairs1.tolist(), pairs2.tolist(), names[keys1], names[keys2],
+                                                                  pairs_values, pairs_float, pairs_observed.tolist()):
+            if resume_key is not None and (key1, key2) <= resume_key:
+                skipped_cnt += 1
+                continue
+            if existing_contacts is not None and key1 not in changed_fragments and key2 not in changed_fragments:
+                line = existing_contacts.get(key1, key2)
+                if line is not None:
+                    batch.append(line)
+                    reused_cnt += 1
+                    continue
+            if debug_pairs:
+                logger.debug("Computing contacts between fragments {f1} and {f2} (total {value})".format(f1=key1, f2=key2, value=value))
+            if contact == "value":
+                batch.append("{f1}\t{f2}\t{total}\n".format(f1=key1, f2=key2, total=format_total(value, is_float)))
+            elif contact == "matrix":
+                rows = contacts_matrix(hic_data=hic_data, bins1=bins1, i=i, bins2=bins2, j=j, observed=is_observed)
+                if debug_pairs:
+                    logger.debug("Contacts matrix of {f1} and {f2}: {matrix}".format(f1=key1, f2=key2, matrix=rows))
+                batch.append("{f1}\t{f2}\t{rows_cnt}\t{rows}\n".format(f1=key1, f2=key2, rows_cnt=len(rows), rows="\t".join(rows)))
+            computed_cnt += 1
+            if len(batch) >= checkpoint_interval:
+                output.write("".join(batch))
+                batch = []
+                if output_path is not None and not compressed:
+                    output.flush()
+                    os.fsync(output.fileno())
+        output.write("".join(batch))
+        counts["pairs"], counts["computed_pairs"], counts["reused_pairs"], counts["resumed_pairs"] = len(pairs1), computed_cnt, reused_cnt, skipped_cnt
+        if existing_contacts is not None:
+            existing_contacts.close()
+            logger.info("Reused {r_cnt} and computed {c_cnt} fragment pairs".format(r_cnt=reused_cnt, c_cnt=computed_cnt))
+        if output_path is not None:
+            output.close()
+            os.rename(get_fragments_path(partial_path), get_fragments_path(output_path))
+            finish_partial_output(output_path)
+    return metrics
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--hic", type=str, required=True)
@@ -138,11 +773,42 @@ if __name__ == "__main__":
     parser.add_argument("--measure", choices=["outer", "inner", "fractions"], default="inner")
     parser.add_argument("--contact", choices=["value", "matrix"], default="matrix")
     parser.add_argument("--existing", type=str, default=None)
+    parser.add_argument("--write-zeros", action="store_true", default=False,
+                        help="Report every pair of fragments, rather than only pairs with at least one hic entry between them")
     parser.add_argument("--frag-lengths", type=int, default=-1)
+    parser.add_argument("--no-dump-cache", action="store_false", dest="dump_cache", default=True)
+    parser.add_argument("--chromosomes", type=str, nargs=2, default=None, help="Chromosomes to read, if --hic is a genome store or a .hic file")
+    parser.add_argument("--bin-size", type=int, default=None,
+                        help="Resolution to read, required if --hic is a .hic file, for dumps it defaults to the one in the file name, "
+                             "coarser ones are read from the dump pyramid (see hic_dump.py)")
+    parser.add_argument("--norm", type=str, choices=["NONE", "VC", "VC_SQRT", "KR", "ICE"], default="NONE",
+                        help="Normalization to read from a .hic file, raw (NONE) dumps are balanced natively with bias vectors of their chromosomes, "
+                             "computed from intra chromosomal dumps next to them (see balance.py)")
+    parser.add_argument("--data", choices=["observed", "oe"], default="observed",
+                        help="Report observed contacts, or observed / expected ones, with expected values computed from the observed contacts")
+    parser.add_argument("--groups", type=str, default=None,
+                        help="\"fragment<SEPARATOR>group\" mapping, group x group contacts totals are written instead of fragment pairs")
+    parser.add_argument("--groups-separator", type=str, default="\t")
     parser.add_argument("--logging", type=int, choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL], default=logging.INFO)
-    parser.add_argument("-o", "--output", default=sys.stdout, type=argparse.FileType("wt"))
+    parser.add_argument("--checkpoint-interval", type=int, default=10000,
+                        help="Number of reported fragment pairs between flushes of partial results to disk (when output is a file)")
+    parser.add_argument("-o", "--output", default="-", type=str,
+                        help="Results are written to \"<output>.partial\" until completed, an interrupted run is continued on restart")
+    parser.add_argument("--output-format", choices=["text", "binary"], default="text",
+                        help="Binary output (see frag_matrix_binary) stores per bin contacts compactly and supports random access by fragment pair")
+    parser.add_argument("--compress-threads", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of threads, compressing text output, if -o/--output ends with .gz (see bgzf.py)")
+    parser.add_argument("--binary-dtype", choices=["float64", "float32"], default="float64")
+    parser.add_argument("--metrics-out", type=str, default=None, help="Path to write a json report of per stage times, memory and counts to")
+    parser.add_argument("--profile", choices=PROFILERS, default=None, help="Profile the run with cProfile or with a sampling profiler")
+    parser.add_argument("--profile-out", type=str, default="frag_matrix.prof",
+                        help="Path to write cProfile stats or sampled collapsed stacks to")
     args = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG,
+    if args.output_format == "binary" and (args.output == "-" or args.existing is not None):
+        parser.error("--output-format binary requires an -o/--output path and can not be combined with --existing")
+    if args.groups is not None and (args.output_format == "binary" or args.existing is not None):
+        parser.error("--groups can not be combined with --output-format binary or --existing")
+    logging.basicConfig(level=args.logging,
                         format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
                         datefmt='%m-%d %H:%M:%S')
     logger = logging.getLogger("frag_matrix")
@@ -150,60 +816,29 @@ if __name__ == "__main__":
     start_time = datetime.datetime.now()
     logger.info("Starting the whole show...")
     logger.info("Loading fragments info from {f_filename}".format(f_filename=os.path.basename(args.fragments)))
-    fragments = get_fragments(fragments_filename=args.fragments)
+    metrics = Metrics()
+    with metrics.stage("fragments_load", items="fragments") as counts:
+        fragments = load_fragment_catalog(args.fragments, use_cache=args.dump_cache)
+        counts["fragments"] = len(fragments)
     logger.info("Loaded a total of {f_cnt} fragments".format(f_cnt=len(fragments)))
-    if args.frag_lengths > 0:
-        logger.info("Filtering out fragments shorter than {f_length_thresh}".format(f_length_thresh=args.frag_lengths))
-        fragments = [f for f in fragments if f.end - f.start > args.frag_lengths]
-        logger.info("A total of {f_cnt} are longer than {f_length_thresh}".format(f_cnt=len(fragments), f_length_thresh=args.frag_lengths))
-    chr1, chr2 = get_chromosomes_from_hic_filename(hic=args.hic)
-    step = get_step_from_hic_filename(hic=args.hic)
-    logger.info("Working with chromosomes {chr1} and {chr2} and a step of {step}".format(chr1=chr1, chr2=chr2, step=step))
-    logger.info("Filtering fragments that do not belong to {chr1} or {chr2} chromosomes".format(chr1=chr1, chr2=chr2))
-    fragments = [fragment for fragment in fragments if fragment.chromosome in [chr1, chr2]]
-    if chr1 == chr2:
-        fragments1 = fragments[:]
-        fragments2 = fragments[:]
-    else:
-        fragments1 = [f for f in fragments if f.chromosome == chr1]
-        fragments2 = [f for f in fragments if f.chromosome == chr2]
-    logger.info("Will be computing pairwise contact between {f1_cnt} and {f2_cnt} fragments".format(f1_cnt=len(fragments1), f2_cnt=len(fragments2)))
-    logger.info("Loading HiC data from {hic_filename}".format(hic_filename=os.path.basename(args.hic)))
-    data = load_hic_data(hic_filename=args.hic)
-    contacts_values = defaultdict(dict)
-    contacts_matrices = defaultdict(dict)
-    observed = set()
-    logger.info("Computing contacts")
-    for fragment1 in fragments1:
-        for fragment2 in fragments2:
-            f1, f2 = (fragment1.name, fragment2.name) if fragment1.name < fragment2.name else (fragment2.name, fragment1.name)
-            if (f1, f2) in observed:
-                continue
-            logger.debug("Computing contacts between fragments {f1} and {f2}".format(f1=fragment1.name, f2=fragment2.name))
-            fragments_contact_value, fragments_contact_matrix = count_contacts(hic_data=data, f1=fragment1, f2=fragment2, measure=args.measure, step=step)
-            logger.debug("Done. {f1} and {f2} have {c_cnt} HiC contacts".format(f1=fragment1.name, f2=fragment2.name, c_cnt=fragments_contact_value))
-            logger.debug("Done. {f1} and {f2} have {c_cnt} HiC contacts matrix".format(f1=fragment1.name, f2=fragment2.name, c_cnt=str(fragments_contact_matrix)))
-            observed.add((f1, f2))
-            contacts_values[f1][f2] = fragments_contact_value
-            contacts_matrices[f1][f2] = fragments_contact_matrix
-    logger.info("Computed all pairwise contacts. Outputting results.")
-    print("# python :: {python_version}".format(python_version=".".join(map(str, sys.version_info))), file=args.output)
-    print("# hic source :: {hic} ".format(hic=os.path.abspath(args.hic)), file=args.output)
-    print("# fragments source :: {fragments}".format(fragments=os.path.abspath(args.fragments)), file=args.output)
-    print("# measure :: {measure}".format(measure=args.measure), file=args.output)
-    print("# bin size :: {step}".format(step=step), file=args.output)
-    print("# fragment min. size :: {f_lengths}".format(f_lengths=args.frag_lengths), file=args.output)
-    print("# chromosome 1 :: {f1}".format(f1=chr1), file=args.output)
-    print("# chromosome 2 :: {f2}".format(f2=chr2), file=args.output)
-    print("# chromosome {chr1} fragment cnt :: {f1_cnt}".format(f1_cnt=len(fragments1), chr1=chr1), file=args.output)
-    print("# chromosome {chr2} fragment cnt :: {f2_cnt}".format(f2_cnt=len(fragments2), chr2=chr2), file=args.output)
-    for key1 in sorted(contacts_values.keys()):
-        for key2 in sorted(contacts_values[key1].keys()):
-            if args.contact == "value":
-                print(key1, key2, contacts_values[key1][key2], sep="\t", file=args.output)
-            elif args.contact == "matrix":
-                rows = []
-                for row in contacts_matrices[key1][key2]:
-                    rows.append("\t".join(map(str, row)))
-                print(key1, key2, len(rows), "\t".join(rows), sep="\t", file=args.output)
+    groups = None
+    if args.groups is not None:
+        with metrics.stage("groups_load", items="groups") as counts:
+            groups = read_groups(args.groups, separator=args.groups_separator)
+            counts["groups"] = len(groups)
+        logger.info("Loaded {g_cnt} fragment groups from {g_filename}".format(g_cnt=len(groups), g_filename=os.path.basename(args.groups)))
+    if is_hic_file(args.hic) and (args.chromosomes is None or args.bin_size is None):
+        parser.error("--chromosomes and --bin-size are required, when --hic is a .hic file")
+    if is_genome_store(args.hic) and args.chromosomes is None:
+        parser.error("--chromosomes are required, when --hic is a genome store")
+    with profiling(args.profile, args.profile_out):
+        compute_frag_matrix(hic=args.hic, fragments=fragments, fragments_filename=args.fragments,
+                            output=sys.stdout if args.output == "-" else args.output,
+                            measure=args.measure, existing=args.existing, checkpoint_interval=args.checkpoint_interval,
+                            contact=args.contact, frag_lengths=args.frag_lengths, write_zeros=args.write_zeros, use_cache=args.dump_cache,
+                            chromosomes=args.chromosomes, bin_size=args.bin_size, norm=args.norm,
+                            output_format=args.output_format, binary_dtype=np.dtype(args.binary_dtype), metrics=metrics,
+                            data=args.data, groups=groups, compress_threads=args.compress_threads)
+    if args.metrics_out is not None:
+        metrics.write(args.metrics_out)
     logger.info("All done. It only took us: {time_cnt}".format(time_cnt=str(datetime.datetime.now() - start_time)))
@@ -0,0 +1,273 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+BINARY_MAGIC = b"FRAGMAT2"
+ALIGNMENT = 64
+PAIRS_DTYPE = np.dtype([("key1", "<i4"), ("key2", "<i4"), ("rows", "<i4"), ("columns", "<i4"), ("offset", "<i8"), ("total", "<f8"),
+                        ("total_float", "u1"), ("rows_key1", "u1")])
+EXACT_FLUSH_BITS = 8 * 2 ** 20
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _index_dtype(max_value):
+    """ The smallest of uint16, int32 and int64, that holds values up to max_value """
+    for dtype in ["<u2", "<i4"]:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype("<i8")
+
+
+def _sections(fragments_cnt, names_size, pairs_cnt, indptr_cnt, entries_cnt, exact_cnt, indptr_dtype, indices_dtype, dtype):
+    """ Offsets of sections, relative to the start of data (just after the aligned json header) """
+    result = {"name_offsets": 0}
+    result["names"] = _aligned(result["name_offsets"] + 8 * (fragments_cnt + 1))
+    result["pairs"] = _aligned(result["names"] + names_size)
+    result["indptr"] = _aligned(result["pairs"] + PAIRS_DTYPE.itemsize * pairs_cnt)
+    result["indices"] = _aligned(result["indptr"] + indptr_dtype.itemsize * indptr_cnt)
+    result["values"] = _aligned(result["indices"] + indices_dtype.itemsize * entries_cnt)
+    result["exact"] = _aligned(result["values"] + np.dtype(dtype).itemsize * entries_cnt)
+    result["end"] = result["exact"] + (exact_cnt + 7) // 8
+    return result
+
+
+class BinaryContactsWriter(object):
+    """ Streaming writer of frag_matrix results in a compact binary format
+
+    The file consists of a magic string, a json header (attributes, text header lines, sections offsets)
+    and aligned sections: fragment names table (offsets and utf-8 bytes), pairs table (fragment names indexes,
+    submatrix shape, offset of its first entry, total), submatrices of all pairs in CSR form
+    (row pointers, relative to the first entry of a pair, column indexes and values of hic entries only, concatenated,
+    pointers and indexes are stored in the smallest integer type, that fits all pairs)
+    and a bit mask of bins, whose weights are exact (absent contacts of a row and a column with exact bins
+    are formatted as integer zeros in the text format), rows bins of a pair followed by its columns bins.
+    Pairs must be written in the order, they are listed in the pairs table.
+    """
+
+    def __init__(self, path, names, keys1, keys2, rows_cnt, columns_cnt, entries_cnt, totals, totals_float, rows_key1, attributes, header_lines,
+                 dtype=np.float64):
+        """
+
+        :param path: output path (file is written to "<path>.partial" and renamed on close)
+        :param names: sorted fragment names
+        :param keys1: indexes of the first (by name) fragment of every pair in names
+        :param keys2: indexes of the second (by name) fragment of every pair in names
+        :param rows_cnt: number of rows of every pair submatrix
+        :param columns_cnt: number of columns of every pair submatrix
+        :param entries_cnt: number of hic entries of every pair submatrix
+        :param totals: contacts total of every pair
+        :param totals_float: whether a total is formatted as float in the text format
+        :param rows_key1: whether submatrix rows are bins of the first (by name) fragment of a pair
+        :param attributes: dict of metadata to store
+        :param header_lines: header lines of the text format
+        :param dtype: float32 or float64, type of stored values
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        names_bytes = [name.encode("utf-8") for name in names]
+        name_offsets = np.zeros(len(names_bytes) + 1, dtype="<i8")
+        np.cumsum([len(name) for name in names_bytes], out=name_offsets[1:])
+        pairs = np.zeros(len(keys1), dtype=PAIRS_DTYPE)
+        pairs["key1"], pairs["key2"] = keys1, keys2
+        pairs["rows"], pairs["columns"] = rows_cnt, columns_cnt
+        entries_cnt = np.asarray(entries_cnt, dtype=np.int64)
+        np.cumsum(entries_cnt[:-1], out=pairs["offset"][1:])
+        pairs["total"], pairs["total_float"], pairs["rows_key1"] = totals, totals_float, rows_key1
+        self.entries_cnt = int(entries_cnt.sum())
+        self._shapes = np.stack([pairs["rows"], pairs["columns"], entries_cnt], axis=1) if len(pairs) > 0 else np.zeros((0, 3), dtype=np.int64)
+        indptr_cnt, exact_cnt = int(pairs["rows"].sum()) + len(pairs), int(pairs["rows"].sum()) + int(pairs["columns"].sum())
+        # row pointers and column indexes are local to a pair, so they mostly fit 16 bits
+        self._indptr_dtype = _index_dtype(int(entries_cnt.max()) if len(pairs) > 0 else 0)
+        self._indices_dtype = _index_dtype(int(pairs["columns"].max()) if len(pairs) > 0 else 0)
+        sections = _sections(len(names_bytes), int(name_offsets[-1]), len(pairs), indptr_cnt, self.entries_cnt, exact_cnt, self._indptr_dtype,
+                             self._indices_dtype, self.dtype)
+        header = {"attributes": attributes, "header": header_lines, "dtype": self.dtype.str, "indptr_dtype": self._indptr_dtype.str,
+                  "indices_dtype": self._indices_dtype.str, "fragments_cnt": len(names_bytes), "pairs_cnt": len(pairs), "indptr_cnt": indptr_cnt,
+                  "entries_cnt": self.entries_cnt, "exact_cnt": exact_cnt, "sections": sections}
+        header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+        self._data_start = _aligned(len(BINARY_MAGIC) + 4 + len(header_bytes))
+        self._partial_path = path + ".partial"
+        self._dest = open(self._partial_path, "wb")
+        self._dest.write(BINARY_MAGIC)
+        self._dest.write(struct.pack("<I", len(header_bytes)))
+        self._dest.write(header_bytes)
+        self._write_at(sections["name_offsets"], name_offsets.tobytes())
+        self._write_at(sections["names"], b"".join(names_bytes))
+        self._write_at(sections["pairs"], pairs.tobytes())
+        self._sections = sections
+        self._pairs_written = 0
+        self._indptr_written = 0
+        self._entries_written = 0
+        self._exact_written = 0
+        self._exact_pending = []
+        self._exact_pending_cnt = 0
+
+    def _write_at(self, offset, data):
+        self._dest.seek(self._data_start + offset)
+        self._dest.write(data)
+
+    def _flush_exact(self, final=False):
+        if len(self._exact_pending) == 0:
+            return
+        bits = np.concatenate(self._exact_pending)
+        complete = len(bits) if final else len(bits) // 8 * 8
+        self._write_at(self._sections["exact"] + self._exact_written // 8, np.packbits(bits[:complete]).tobytes())
+        self._exact_written += complete
+        self._exact_pending = [bits[complete:]]
+        self._exact_pending_cnt = len(bits) - complete
+
+    def write(self, indptr, indices, values, rows_exact, columns_exact):
+        """ Appends a submatrix of the next pair (in the pairs table order) in CSR form
+
+        :param indptr: row pointers (rows + 1 of them, starting at 0)
+        :param indices: column indexes of hic entries
+        :param values: contacts values of hic entries
+        :param rows_exact: whether weights of rows bins are exact
+        :param columns_exact: whether weights of columns bins are exact
+        """
+        rows_cnt, columns_cnt, entries_cnt = self._shapes[self._pairs_written].tolist()
+        if (len(indptr) - 1, len(rows_exact), len(columns_exact), len(indices)) != (rows_cnt, rows_cnt, columns_cnt, entries_cnt):
+            raise ValueError("Submatrix of pair {index} does not match its shape or its number of entries in the pairs table"
+                             "".format(index=self._pairs_written))
+        self._write_at(self._sections["indptr"] + self._indptr_written * self._indptr_dtype.itemsize,
+                       np.ascontiguousarray(indptr, dtype=self._indptr_dtype).tobytes())
+        self._write_at(self._sections["indices"] + self._entries_written * self._indices_dtype.itemsize,
+                       np.ascontiguousarray(indices, dtype=self._indices_dtype).tobytes())
+        self._write_at(self._sections["values"] + self._entries_written * self.dtype.itemsize,
+                       np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+        self._pairs_written += 1
+        self._indptr_written += len(indptr)
+        self._entries_written += len(indices)
+        self._exact_pending.extend([np.asarray(rows_exact, dtype=bool), np.asarray(columns_exact, dtype=bool)])
+        self._exact_pending_cnt += len(rows_exact) + len(columns_exact)
+        if self._exact_pending_cnt >= EXACT_FLUSH_BITS:
+            self._flush_exact()
+
+    def close(self):
+        self._flush_exact(final=True)
+        if self._pairs_written != len(self._shapes):
+            raise ValueError("Written {w_cnt} pairs, while {p_cnt} are expected".format(w_cnt=self._pairs_written, p_cnt=len(self._shapes)))
+        self._dest.seek(0, os.SEEK_END)
+        if self._dest.tell() < self._data_start + self._sections["end"]:
+            self._dest.truncate(self._data_start + self._sections["end"])
+        self._dest.close()
+        os.rename(self._partial_path, self.path)
+
+
+class BinaryContacts(object):
+    """ Random access reader of binary frag_matrix results (see BinaryContactsWriter)
+
+    Sections are memory mapped, so a single pair submatrix is read without loading the whole file,
+    dense submatrices are only built on access.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as source:
+            if source.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError("File {path} is not a binary frag_matrix output".format(path=path))
+            header_length, = struct.unpack("<I", source.read(4))
+            header = json.loads(source.read(header_length).decode("utf-8"))
+        self.attributes = header["attributes"]
+        self.header_lines = header["header"]
+        self.dtype = np.dtype(header["dtype"])
+        data_start = _aligned(len(BINARY_MAGIC) + 4 + header_length)
+        sections = header["sections"]
+        fragments_cnt, pairs_cnt, entries_cnt = header["fragments_cnt"], header["pairs_cnt"], header["entries_cnt"]
+        name_offsets = np.fromfile(path, dtype="<i8", count=fragments_cnt + 1, offset=data_start + sections["name_offsets"])
+        with open(path, "rb") as source:
+            source.seek(data_start + sections["names"])
+            names_bytes = source.read(int(name_offsets[-1]))
+        self.names = [names_bytes[start:end].decode("utf-8") for start, end in zip(name_offsets[:-1].tolist(), name_offsets[1:].tolist())]
+        self._name_indexes = {name: index for index, name in enumerate(self.names)}
+        self.pairs = self._memmap(PAIRS_DTYPE, pairs_cnt, data_start + sections["pairs"])
+        self._indptr = self._memmap(np.dtype(header["indptr_dtype"]), header["indptr_cnt"], data_start + sections["indptr"])
+        self._indices = self._memmap(np.dtype(header["indices_dtype"]), entries_cnt, data_start + sections["indices"])
+        self._values = self._memmap(self.dtype, entries_cnt, data_start + sections["values"])
+        self._exact = self._memmap(np.uint8, (header["exact_cnt"] + 7) // 8, data_start + sections["exact"])
+        self._pair_keys = self.pairs["key1"].astype(np.int64) * max(fragments_cnt, 1) + self.pairs["key2"]
+        # positions of row pointers and of exact bits of every pair (and past the last one)
+        rows_cnt, columns_cnt = self.pairs["rows"].astype(np.int64), self.pairs["columns"].astype(np.int64)
+        self._indptr_offsets = np.concatenate([[0], np.cumsum(rows_cnt + 1)])
+        self._exact_offsets = np.concatenate([[0], np.cumsum(rows_cnt + columns_cnt)])
+
+    def _memmap(self, dtype, count, offset):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def pair_index(self, name1, name2):
+        """ Index of a pair of fragments in the pairs table (names can be given in any order), None if the pair is not stored """
+        if name1 not in self._name_indexes or name2 not in self._name_indexes:
+            return None
+        key1, key2 = sorted([self._name_indexes[name1], self._name_indexes[name2]])
+        key = key1 * max(len(self.names), 1) + key2
+        index = int(np.searchsorted(self._pair_keys, key))
+        if index < len(self._pair_keys) and self._pair_keys[index] == key:
+            return index
+        return None
+
+    def _submatrix(self, index):
+        """ Dense submatrix of a pair and a mask of values, that are formatted as floats (hic entries and absent contacts of inexact bins) """
+        pair = self.pairs[index]
+        rows_cnt, columns_cnt = int(pair["rows"]), int(pair["columns"])
+        indptr = np.asarray(self._indptr[self._indptr_offsets[index]:self._indptr_offsets[index + 1]], dtype=np.int64)
+        start, end = int(pair["offset"]), int(pair["offset"]) + int(indptr[-1])
+        rows, columns = np.repeat(np.arange(rows_cnt), np.diff(indptr)), np.asarray(self._indices[start:end], dtype=np.int64)
+        values = np.zeros((rows_cnt, columns_cnt), dtype=np.float64)
+        values[rows, columns] = self._values[start:end]
+        bits_start, bits_cnt = int(self._exact_offsets[index]), rows_cnt + columns_cnt
+        bits = np.unpackbits(self._exact[bits_start // 8:(bits_start + bits_cnt + 7) // 8])[bits_start % 8:bits_start % 8 + bits_cnt].astype(bool)
+        as_float = ~(bits[:rows_cnt, np.newaxis] & bits[np.newaxis, rows_cnt:])
+        as_float[rows, columns] = True
+        return values, as_float
+
+    def matrix(self, name1, name2):
+        """ Per bin contacts between two fragments, with bins of name1 as rows, None if the pair is not stored """
+        index = self.pair_index(name1, name2)
+        if index is None:
+            return None
+        values, _ = self._submatrix(index)
+        rows_name = self.names[self.pairs["key1"][index]] if self.pairs["rows_key1"][index] else self.names[self.pairs["key2"][index]]
+        return values if rows_name == name1 else values.T
+
+    def total(self, name1, name2):
+        """ Contacts total between two fragments, 0 if the pair is not stored """
+        index = self.pair_index(name1, name2)
+        return 0.0 if index is None else float(self.pairs["total"][index])
+
+    def to_text(self, dest, contact="matrix"):
+        """ Writes results down in the text format of frag_matrix """
+        from frag_matrix import format_matrix_rows, format_total
+        for line in self.header_lines:
+            print(line, file=dest)
+        for index, pair in enumerate(self.pairs):
+            key1, key2 = self.names[pair["key1"]], self.names[pair["key2"]]
+            if contact == "value":
+                print(key1, key2, format_total(float(pair["total"]), bool(pair["total_float"])), sep="\t", file=dest)
+            else:
+                rows = format_matrix_rows(*self._submatrix(index))
+                print(key1, key2, len(rows), "\t".join(rows), sep="\t", file=dest)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts binary frag_matrix results back to the text format")
+    parser.add_argument("binary", type=str)
+    parser.add_argument("--contact", choices=["value", "matrix"], default="matrix")
+    parser.add_argument("-o", "--output", default=sys.stdout, type=argparse.FileType("wt"))
+    args = parser.parse_args()
+    BinaryContacts(args.binary).to_text(args.output, contact=args.contact)
@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from hic_dump import CACHE_ALIGNMENT, get_cache_key, read_header, write_arrays
+
+logger = logging.getLogger("fragment_catalog")
+
+CATALOG_SUFFIX = ".catalog"
+CATALOG_MAGIC = b"HICFRAG3"
+# fragment catalogs, opened in this process, keyed by path, size and modification time
+_catalogs = {}
+
+
+class Fragment(object):
+    __slots__ = ["name", "start", "end", "chromosome"]
+
+    def __init__(self, name, start, end, chromosome):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.chromosome = chromosome
+
+
+class FragmentArrays(object):
+    """ Fragments of a single chromosome as typed arrays, that behaves as a (read only) list of Fragment instances
+
+    Fragment instances are only created, when fragments are accessed one by one, names are decoded on first access.
+    """
+
+    def __init__(self, chromosome, names, starts, ends):
+        """
+        :param names: numpy array of utf-8 encoded names (bytes) or of (decoded) names
+        """
+        self.chromosome = chromosome
+        self._names = names
+        self.starts = starts
+        self.ends = ends
+
+    @property
+    def names(self):
+        """ numpy object array of fragment names """
+        if self._names.dtype.kind == "S":
+            self._names = np.char.decode(self._names, "utf-8").astype(object)
+        return self._names
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(np.arange(len(self))[index])
+        return Fragment(name=self.names[index], start=int(self.starts[index]), end=int(self.ends[index]), chromosome=self.chromosome)
+
+    def __iter__(self):
+        for name, start, end in zip(self.names.tolist(), self.starts.tolist(), self.ends.tolist()):
+            yield Fragment(name=name, start=start, end=end, chromosome=self.chromosome)
+
+    def take(self, indexes):
+        """ Fragments at (an array of) indexes """
+        return FragmentArrays(self.chromosome, self.names[indexes], self.starts[indexes], self.ends[indexes])
+
+
+def parse_fragments(fragments_path):
+    """ Parses a "name<TAB>start<TAB>end<TAB>chromosome" fragments file with a vectorized (pandas C engine) parser
+
+    :return: names, starts, ends and chromosomes numpy arrays
+    """
+    try:
+        df = pd.read_csv(fragments_path, sep="\t", header=None, usecols=[0, 1, 2, 3], names=["name", "start", "end", "chromosome"],
+                         dtype={"name": str, "start": np.int64, "end": np.int64, "chromosome": str}, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        return np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object)
+    return df["name"].values, df["start"].values, df["end"].values, df["chromosome"].values
+
+
+class FragmentCatalog(object):
+    """ Columnar catalog of fragments of the whole genome
+
+    Fragments are grouped by chromosome (chromosomes in the order of their first appearance, fragments of a chromosome
+    in the original order), so fragments of a chromosome are a slice of names, starts and ends arrays.
+    For every chromosome its fragments are also ordered by start (by_start, with their sorted starts), so fragments,
+    that overlap a genomic interval, are found by binary search.
+    """
+
+    def __init__(self, chromosomes, offsets, max_lengths, names, starts, ends, by_start, sorted_starts, path=None):
+        """
+        :param chromosomes: list of chromosome names
+        :param offsets: numpy array, fragments of i-th chromosome are at offsets[i]:offsets[i + 1]
+        :param max_lengths: numpy array of maximum fragment lengths of chromosomes
+        :param names: numpy array of utf-8 encoded (fixed width) names
+        :param by_start: numpy array of (catalog) indexes of fragments of every chromosome, ordered by start
+        :param sorted_starts: starts[by_start]
+        :param path: file, the catalog is mapped from
+        """
+        self.path = path
+        self.chromosomes = chromosomes
+        self.offsets = offsets
+        self.max_lengths = max_lengths
+        self.names = names
+        self.starts = starts
+        self.ends = ends
+        self.by_start = by_start
+        self.sorted_starts = sorted_starts
+        self._numbers = {chromosome: number for number, chromosome in enumerate(chromosomes)}
+
+    @classmethod
+    def from_arrays(cls, names, starts, ends, chromosomes, path=None):
+        """ Builds a catalog in memory from (ungrouped) fragment columns, such as the ones of parse_fragments """
+        codes, table = pd.factorize(np.asarray(chromosomes, dtype=object))
+        order = np.argsort(codes, kind="mergesort")
+        codes, starts, ends = codes[order], np.asarray(starts, dtype=np.int64)[order], np.asarray(ends, dtype=np.int64)[order]
+        encoded = np.char.encode(np.asarray(names, dtype=object)[order].astype(np.str_), "utf-8") if len(order) > 0 else np.zeros(0, dtype="S1")
+        offsets = np.zeros(len(table) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(table)), out=offsets[1:])
+        by_start = np.lexsort((starts, codes)).astype(np.int64)
+        max_lengths = np.zeros(len(table), dtype=np.int64)
+        np.maximum.at(max_lengths, codes, ends - starts)
+        return cls(chromosomes=list(table), offsets=offsets, max_lengths=max_lengths, names=encoded, starts=starts, ends=ends, by_start=by_start,
+                   sorted_starts=starts[by_start], path=path)
+
+    @classmethod
+    def from_fragments(cls, fragments):
+        """ Builds a catalog in memory from a list of Fragment instances """
+        return cls.from_arrays(names=[f.name for f in fragments], starts=[f.start for f in fragments], ends=[f.end for f in fragments],
+                               chromosomes=[f.chromosome for f in fragments])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _range(self, chromosome):
+        number = self._numbers.get(chromosome)
+        return (0, 0) if number is None else (int(self.offsets[number]), int(self.offsets[number + 1]))
+
+    def fragments(self, chromosome, longer_than=-1):
+        """ FragmentArrays of a chromosome (in the original order), only with fragments longer than longer_than, if it is positive """
+        first, last = self._range(chromosome)
+        names, starts, ends = self.names[first:last], self.starts[first:last], self.ends[first:last]
+        if longer_than > 0:
+            kept = ends - starts > longer_than
+            names, starts, ends = names[kept], starts[kept], ends[kept]
+        return FragmentArrays(chromosome, names, starts, ends)
+
+    def overlapping(self, chromosome, start, end):
+        """ Indexes (in the chromosome, see fragments) of fragments, that overlap [start, end) genomic interval, in ascending order """
+        first, last = self._range(chromosome)
+        if first == last:
+            return np.zeros(0, dtype=np.int64)
+        sorted_starts = self.sorted_starts[first:last]
+        # a fragment, that starts before start - max. length of chromosome fragments, can not reach start
+        low = np.searchsorted(sorted_starts, start - self.max_lengths[self._numbers[chromosome]], side="right")
+        high = np.searchsorted(sorted_starts, end, side="left")
+        candidates = np.asarray(self.by_start[first + low:first + high])
+        return np.sort(candidates[self.ends[candidates] > start]) - first
+
+    def bin_fragments(self, chromosome, bin_index, bin_size):
+        """ Indexes (in the chromosome) of fragments, that overlap a bin of a given resolution """
+        return self.overlapping(chromosome, bin_index * bin_size, (bin_index + 1) * bin_size)
+
+    def write(self, path, source):
+        """ Writes the catalog down (see hic_dump.write_arrays), source is a key of the fragments file (see hic_dump.get_cache_key) """
+        counts = np.diff(self.offsets)
+        chromosomes = [{"name": chromosome, "offset": int(self.offsets[number]), "fragments_cnt": int(counts[number]),
+                        "max_length": int(self.max_lengths[number])} for number, chromosome in enumerate(self.chromosomes)]
+        header = {"source": source, "fragments_cnt": len(self), "name_dtype": self.names.dtype.str, "chromosomes": chromosomes}
+        write_arrays(path, CATALOG_MAGIC, header, [self.names, self.starts, self.ends, self.by_start, self.sorted_starts])
+
+
+def get_catalog_path(fragments_path):
+    return fragments_path + CATALOG_SUFFIX
+
+
+def map_catalog(path, header, offset):
+    """ Memory maps a catalog file, with its header and the offset of its first array (see hic_dump.read_header) """
+    fragments_cnt = header["fragments_cnt"]
+    dtypes = [np.dtype(header["name_dtype"])] + [np.dtype("<i8")] * 4
+    data = np.memmap(path, dtype=np.uint8, mode="r") if fragments_cnt > 0 else None
+    arrays = []
+    for dtype in dtypes:
+        arrays.append(data[offset:offset + fragments_cnt * dtype.itemsize].view(dtype) if data is not None else np.zeros(0, dtype=dtype))
+        offset = -(-(offset + fragments_cnt * dtype.itemsize) // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+    chromosomes = header["chromosomes"]
+    offsets = np.array([chromosome["offset"] for chromosome in chromosomes] + [fragments_cnt], dtype=np.int64)
+    names, starts, ends, by_start, sorted_starts = arrays
+    return FragmentCatalog(chromosomes=[chromosome["name"] for chromosome in chromosomes], offsets=offsets,
+                           max_lengths=np.array([chromosome["max_length"] for chromosome in chromosomes], dtype=np.int64),
+                           names=names, starts=starts, ends=ends, by_start=by_start, sorted_starts=sorted_starts, path=path)
+
+
+def load_fragment_catalog(fragments_path, use_cache=True):
+    """ Fragment catalog of a fragments file, memory mapped from a sidecar file next to it (built, if it is missing or stale),
+    and opened once per process
+
+    :param use_cache: whether to use (and create) the sidecar file, the catalog is built in memory otherwise
+    """
+    if not use_cache:
+        return FragmentCatalog.from_arrays(*parse_fragments(fragments_path))
+    key = get_cache_key(fragments_path)
+    memo_key = (key["path"], key["size"], key["mtime"])
+    if memo_key in _catalogs:
+        return _catalogs[memo_key]
+    catalog_path = get_catalog_path(fragments_path)
+    result = read_header(catalog_path, CATALOG_MAGIC)
+    if result is not None and result[0]["source"] == key:
+        catalog = map_catalog(catalog_path, *result)
+        logger.info("Loaded {f_cnt} fragments from catalog {catalog}".format(f_cnt=len(catalog), catalog=catalog_path))
+    else:
+        catalog = FragmentCatalog.from_arrays(*parse_fragments(fragments_path))
+        try:
+            catalog.write(catalog_path, key)
+            catalog = map_catalog(catalog_path, *read_header(catalog_path, CATALOG_MAGIC))
+            logger.info("Cataloged {f_cnt} fragments to {catalog}".format(f_cnt=len(catalog), catalog=catalog_path))
+        except (IOError, OSError) as error:
+            logger.warning("Could not write fragments catalog {catalog}: {error}".format(catalog=catalog_path, error=error))
+    _catalogs[memo_key] = catalog
+    return catalog
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds a fragments catalog next to a fragments file, and lists fragments, that overlap a region "
+                                                 "or a bin")
+    parser.add_argument("fragments", type=str, help="\"name<TAB>start<TAB>end<TAB>chromosome\" fragments file")
+    parser.add_argument("--region", type=str, default=None, help="List fragments, that overlap a \"chromosome:start-end\" region")
+    parser.add_argument("--bin", type=str, default=None, help="List fragments, that overlap a \"chromosome:bin_index\" bin of --bin-size resolution")
+    parser.add_argument("--bin-size", type=int, default=None)
+    args = parser.parse_args()
+    if args.bin is not None and args.bin_size is None:
+        parser.error("--bin requires --bin-size")
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    catalog = load_fragment_catalog(args.fragments)
+    if args.region is not None:
+        chromosome, interval = args.region.rsplit(":", 1)
+        start, end = (int(position.replace(",", "")) for position in interval.split("-"))
+        indexes = catalog.overlapping(chromosome, start, end)
+    elif args.bin is not None:
+        chromosome, bin_index = args.bin.rsplit(":", 1)
+        indexes = catalog.bin_fragments(chromosome, int(bin_index), args.bin_size)
+    else:
+        indexes = None
+    if indexes is not None:
+        fragments = catalog.fragments(chromosome)
+        for index in indexes.tolist():
+            fragment = fragments[index]
+            print(fragment.name, fragment.start, fragment.end, fragment.chromosome, sep="\t")
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from hic_dump import (CACHE_ALIGNMENT, COLUMNS, GENOME_STORE_SUFFIX, coarsen, columns_arrays, get_cache_key, load_dump, read_header,
+                      write_arrays)
+
+logger = logging.getLogger("genome_store")
+
+GENOME_STORE_MAGIC = b"HICGENO1"
+PAIRS_DTYPE = np.dtype([("chr1", "<i4"), ("chr2", "<i4"), ("records_cnt", "<i8")])
+
+# genome stores, opened in this process, keyed by path, size and modification time
+_stores = {}
+
+
+def parse_dump_name(dump_path):
+    """ :return: cell line, chr1, chr2, resolution and correction of a dump, named as "cell-line_chr1_chr2_resolution_correction.txt" """
+    parts = os.path.basename(dump_path).split("_")
+    if len(parts) != 5:
+        raise ValueError("Dump {path} is not named as \"cell-line_chr1_chr2_resolution_correction.txt\"".format(path=dump_path))
+    cell_line, chr1, chr2, resolution, correction = parts
+    return cell_line, chr1, chr2, int(resolution), correction.split(".")[0]
+
+
+def chromosome_order(name):
+    """ Sort key, that puts numbered chromosomes first (in numerical order), followed by the rest of them (X, Y, M, ...) """
+    return (0, int(name), "") if name.isdigit() else (1, 0, name)
+
+
+def get_genome_store_path(directory, cell_line, resolution, correction):
+    return os.path.join(directory, "{cell_line}_{resolution}_{correction}{suffix}".format(cell_line=cell_line, resolution=resolution,
+                                                                                         correction=correction, suffix=GENOME_STORE_SUFFIX))
+
+
+def _sources(dump_paths):
+    return sorted((key["path"], key["size"], key["mtime"]) for key in map(get_cache_key, dump_paths))
+
+
+def build_genome_store(dump_paths, store_path, use_cache=True):
+    """ Packs dumps of all chromosome pairs of a cell line (at a single resolution and correction) into a single file
+
+    Layout (see hic_dump.write_arrays): json header with a chromosome table (number of bins of every chromosome and the offset of its
+    first bin in the genome wide bin numbering) and keys of the source dumps, followed by a pair index (chr1 and chr2 numbers and
+    records count, sorted by chromosome numbers) and then by rows, columns and values arrays of every pair in the index order.
+    Dumps are read twice (to lay out the index, and to copy the records), which is cheap with their sidecar caches.
+
+    :param dump_paths: dumps, named as "cell-line_chr1_chr2_resolution_correction.txt"
+    :param store_path: path to write the store to
+    :param use_cache: whether to use (and create) sidecar binary caches of the dumps
+    :return: path to the store
+    """
+    names = [parse_dump_name(path) for path in dump_paths]
+    if len(names) == 0:
+        raise ValueError("No dumps to build a genome store {path} from".format(path=store_path))
+    if len(set((cell_line, resolution, correction) for cell_line, _, _, resolution, correction in names)) > 1:
+        raise ValueError("All dumps of a genome store must share a cell line, a resolution and a correction")
+    cell_line, _, _, bin_size, correction = names[0]
+    if len(set(frozenset((chr1, chr2)) for _, chr1, chr2, _, _ in names)) < len(names):
+        raise ValueError("Every chromosome pair must be dumped only once for a genome store")
+    extents, pairs = {}, []
+    for path, (_, chr1, chr2, _, _) in zip(dump_paths, names):
+        rows, columns, _ = load_dump(path, use_cache=use_cache)
+        for chromosome, positions in ((chr1, rows), (chr2, columns)):
+            extents[chromosome] = max(extents.get(chromosome, 0), int(positions.max()) // bin_size + 1 if len(positions) > 0 else 0)
+        pairs.append((chr1, chr2, path, len(rows)))
+    chromosomes = sorted(extents, key=chromosome_order)
+    numbers = {chromosome: number for number, chromosome in enumerate(chromosomes)}
+    pairs.sort(key=lambda pair: (numbers[pair[0]], numbers[pair[1]]))
+    bin_offsets = np.cumsum([0] + [extents[chromosome] for chromosome in chromosomes])
+    header = {"cell_line": cell_line, "bin_size": bin_size, "correction": correction, "pairs_cnt": len(pairs),
+              "chromosomes": [{"name": chromosome, "bins_cnt": extents[chromosome], "bin_offset": int(bin_offsets[number])}
+                              for number, chromosome in enumerate(chromosomes)],
+              "sources": _sources(dump_paths)}
+    index = np.array([(numbers[chr1], numbers[chr2], records_cnt) for chr1, chr2, _, records_cnt in pairs], dtype=PAIRS_DTYPE)
+
+    def arrays():
+        yield index
+        for chr1, chr2, path, records_cnt in pairs:
+            records = load_dump(path, use_cache=use_cache)
+            if len(records[0]) != records_cnt:
+                raise ValueError("Dump {path} has changed while building a genome store".format(path=path))
+            logger.debug("Storing {r_cnt} records of chromosomes {chr1} and {chr2}".format(r_cnt=records_cnt, chr1=chr1, chr2=chr2))
+            for array in columns_arrays(*records):
+                yield array
+
+    write_arrays(store_path, GENOME_STORE_MAGIC, header, arrays())
+    logger.info("Stored {p_cnt} chromosome pairs ({r_cnt} records) in {path}".format(p_cnt=len(pairs), r_cnt=int(index["records_cnt"].sum()),
+                                                                                      path=store_path))
+    return store_path
+
+
+def update_genome_store(dump_paths, store_path, use_cache=True):
+    """ Builds a genome store (see build_genome_store), unless the existing one was built from the same dumps (paths, sizes and modification times)
+
+    :return: path to the store
+    """
+    result = read_header(store_path, GENOME_STORE_MAGIC)
+    if result is not None and [tuple(source) for source in result[0]["sources"]] == _sources(dump_paths):
+        logger.info("Genome store {path} is up to date".format(path=store_path))
+        return store_path
+    return build_genome_store(dump_paths, store_path, use_cache=use_cache)
+
+
+class GenomeStore(object):
+    """ Genome wide store of contact records of all chromosome pairs (see build_genome_store)
+
+    The whole store is a single read only memory map, records of a chromosome pair are views into it,
+    so only pages of the pairs, that are actually read, are loaded, and they are shared between processes.
+    """
+
+    def __init__(self, path):
+        result = read_header(path, GENOME_STORE_MAGIC)
+        if result is None:
+            raise ValueError("{path} is not a genome store".format(path=path))
+        header, offset = result
+        self.path = path
+        self.bin_size = header["bin_size"]
+        self.cell_line = header["cell_line"]
+        self.correction = header["correction"]
+        self.chromosomes = [chromosome["name"] for chromosome in header["chromosomes"]]
+        self.bins_cnt = np.array([chromosome["bins_cnt"] for chromosome in header["chromosomes"]], dtype=np.int64)
+        self.bin_offsets = np.array([chromosome["bin_offset"] for chromosome in header["chromosomes"]], dtype=np.int64)
+        self._numbers = {chromosome: number for number, chromosome in enumerate(self.chromosomes)}
+        self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        self.pairs = self._data[offset:offset + header["pairs_cnt"] * PAIRS_DTYPE.itemsize].view(PAIRS_DTYPE)
+        self._keys = self.pairs["chr1"].astype(np.int64) * len(self.chromosomes) + self.pairs["chr2"]
+        # every column starts at an aligned offset, so the size of a pair block only depends on its records count
+        sizes = [-(-self.pairs["records_cnt"] * np.dtype(dtype).itemsize // CACHE_ALIGNMENT) * CACHE_ALIGNMENT for _, dtype in COLUMNS]
+        first = -(-(offset + self.pairs.nbytes) // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+        self._offsets = first + np.concatenate([[0], np.cumsum(np.sum(sizes, axis=0))[:-1]]).astype(np.int64)
+        self._sizes = sizes
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def number(self, chromosome):
+        if chromosome not in self._numbers:
+            raise ValueError("Chromosome {chromosome} is not in genome store {path}".format(chromosome=chromosome, path=self.path))
+        return self._numbers[chromosome]
+
+    def chromosome_pairs(self):
+        """ :return: list of (chr1, chr2) pairs in the store order """
+        return [(self.chromosomes[chr1], self.chromosomes[chr2]) for chr1, chr2 in zip(self.pairs["chr1"].tolist(), self.pairs["chr2"].tolist())]
+
+    def global_bins(self, chromosome, positions):
+        """ Genome wide bin numbers of genomic positions of a chromosome (chromosomes are laid out one after another in the store order) """
+        return self.bin_offsets[self.number(chromosome)] + np.asarray(positions) // self.bin_size
+
+    def _find(self, chr1, chr2):
+        key = self.number(chr1) * len(self.chromosomes) + self.number(chr2)
+        position = int(np.searchsorted(self._keys, key))
+        return position if position < len(self._keys) and self._keys[position] == key else None
+
+    def _columns(self, position):
+        records_cnt, offset = int(self.pairs["records_cnt"][position]), int(self._offsets[position])
+        result = []
+        for (_, dtype), sizes in zip(COLUMNS, self._sizes):
+            dtype = np.dtype(dtype).newbyteorder("<")
+            result.append(self._data[offset:offset + records_cnt * dtype.itemsize].view(dtype))
+            offset += int(sizes[position])
+        return tuple(result)
+
+    def records(self, chr1, chr2, bin_size=None):
+        """ Contact records of a chromosome pair (either order of chromosomes is accepted, records of a swapped pair are transposed)
+
+        :param bin_size: resolution, a coarser one than the store resolution is aggregated on the fly (see hic_dump.coarsen)
+        :return: rows (positions of chr1), columns (positions of chr2) and values numpy arrays
+        """
+        position, swapped = self._find(chr1, chr2), False
+        if position is None:
+            position, swapped = self._find(chr2, chr1), True
+        if position is None:
+            raise ValueError("No contacts of chromosomes {chr1} and {chr2} in genome store {path}".format(chr1=chr1, chr2=chr2, path=self.path))
+        rows, columns, values = self._columns(position)
+        if swapped:
+            rows, columns = columns, rows
+        if bin_size is None or bin_size == self.bin_size:
+            return rows, columns, values
+        if bin_size % self.bin_size != 0:
+            raise ValueError("Resolution {bin_size} can not be aggregated from the genome store resolution {store_bin_size}"
+                             "".format(bin_size=bin_size, store_bin_size=self.bin_size))
+        return coarsen(rows, columns, values, bin_size=bin_size)
+
+
+def open_genome_store(path):
+    """ Opens a genome store once per process (as long as the file does not change) """
+    key = get_cache_key(path)
+    memo_key = (key["path"], key["size"], key["mtime"])
+    if memo_key not in _stores:
+        _stores[memo_key] = GenomeStore(path)
+    return _stores[memo_key]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Packs Juicer dumps of all chromosome pairs into a single memory mapped genome store")
+    parser.add_argument("dumps", type=str, nargs="+", help="Dumps, named as \"cell-line_chr1_chr2_resolution_correction.txt\"")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Store path, \"cell-line_resolution_correction{suffix}\" next to the dumps by default".format(suffix=GENOME_STORE_SUFFIX))
+    parser.add_argument("--no-dump-cache", action="store_false", dest="dump_cache", default=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    output = args.output
+    if output is None:
+        cell_line, _, _, resolution, correction = parse_dump_name(args.dumps[0])
+        output = get_genome_store_path(os.path.dirname(args.dumps[0]), cell_line, resolution, correction)
+    update_genome_store(args.dumps, output, use_cache=args.dump_cache)
@@ -0,0 +1,348 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+import six
+
+from hic_file import NORMALIZATIONS, HicFile
+
+logger = logging.getLogger("hic_dump")
+
+CACHE_SUFFIX = ".cache"
+CACHE_MAGIC = b"HICDUMP1"
+CACHE_ALIGNMENT = 64
+PYRAMID_SUFFIX = ".pyramid"
+PYRAMID_MAGIC = b"HICPYRA1"
+GENOME_STORE_SUFFIX = ".genome"
+COLUMNS = [("rows", np.int64), ("columns", np.int64), ("values", np.float64)]
+
+
+def parse_dump(source):
+    """ Parses a sparse "position1<TAB>position2<TAB>value" Juicer dump with a vectorized (pandas C engine) parser
+
+    :param source: path (plain or compressed, compression is inferred from the extension) or an open file object
+    :return: rows, columns and values numpy arrays
+    """
+    try:
+        df = pd.read_csv(source, sep="\t", header=None, comment="#", usecols=[0, 1, 2], names=["rows", "columns", "values"],
+                         dtype={"rows": np.int64, "columns": np.int64, "values": np.float64}, compression="infer", float_precision="round_trip")
+    except pd.errors.EmptyDataError:
+        return tuple(np.zeros(0, dtype=dtype) for _, dtype in COLUMNS)
+    return tuple(df[name].values for name, _ in COLUMNS)
+
+
+def get_cache_path(dump_path):
+    return dump_path + CACHE_SUFFIX
+
+
+def get_cache_key(dump_path):
+    stat = os.stat(dump_path)
+    return {"path": os.path.abspath(dump_path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _aligned(offset):
+    return (offset + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+
+
+def write_arrays(path, magic, header, arrays):
+    """ Writes magic, json header length, json header, and then aligned raw (little endian) arrays, through a temporary file """
+    header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+    offset = _aligned(len(magic) + 4 + len(header_bytes))
+    tmp_path = path + ".tmp{pid}".format(pid=os.getpid())
+    with open(tmp_path, "wb") as dest:
+        dest.write(magic)
+        dest.write(struct.pack("<I", len(header_bytes)))
+        dest.write(header_bytes)
+        for array in arrays:
+            dest.write(b"\0" * (offset - dest.tell()))
+            dest.write(array.tobytes())
+            offset = _aligned(offset + array.nbytes)
+    os.rename(tmp_path, path)
+
+
+def read_header(path, magic):
+    """ :return: json header and offset of the first array, or None, if file is missing or has a different magic """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as source:
+        if source.read(len(magic)) != magic:
+            logger.warning("File {path} has an unexpected format, ignoring it".format(path=path))
+            return None
+        header_length, = struct.unpack("<I", source.read(4))
+        header = json.loads(source.read(header_length).decode("utf-8"))
+    return header, _aligned(len(magic) + 4 + header_length)
+
+
+def map_columns(path, records_cnt, offset):
+    """ Memory maps rows, columns and values arrays of records_cnt records, starting at offset
+
+    :return: tuple of arrays and offset just after them
+    """
+    result = []
+    for name, dtype in COLUMNS:
+        dtype = np.dtype(dtype).newbyteorder("<")
+        if records_cnt == 0:
+            result.append(np.zeros(0, dtype=dtype))
+        else:
+            result.append(np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(records_cnt,)))
+        offset = _aligned(offset + records_cnt * dtype.itemsize)
+    return tuple(result), offset
+
+
+def columns_arrays(rows, columns, values):
+    return [np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<")) for (_, dtype), array in zip(COLUMNS, (rows, columns, values))]
+
+
+def is_stale(header, key):
+    return key is not None and any(header.get(name) != value for name, value in key.items())
+
+
+def write_cache(cache_path, key, rows, columns, values):
+    """ Stores parsed dump arrays in a binary file: magic, json header length, json header, and then aligned raw arrays """
+    write_arrays(cache_path, CACHE_MAGIC, dict(key, records_cnt=len(rows)), columns_arrays(rows, columns, values))
+
+
+def read_cache(cache_path, key=None):
+    """ Memory maps arrays from a binary cache file
+
+    :param key: if specified, cache is only used if it was created for a dump with the same path, size and modification time
+    :return: rows, columns and values numpy arrays (read only memory maps), or None, if cache is missing or stale
+    """
+    result = read_header(cache_path, CACHE_MAGIC)
+    if result is None:
+        return None
+    header, offset = result
+    if is_stale(header, key):
+        logger.info("Cache {cache} is stale, ignoring it".format(cache=cache_path))
+        return None
+    return map_columns(cache_path, header["records_cnt"], offset)[0]
+
+
+def load_dump(source, use_cache=True):
+    """ Loads a sparse Juicer dump, reusing (and creating if needed) a sidecar binary cache next to the dump file
+
+    Cache is keyed by dump path, size and modification time, so a changed dump is parsed anew.
+    Caching is only done for dumps, specified by a path (not for file objects, such as stdin).
+
+    :param source: path to the dump (plain or gzip compressed) or an open file object
+    :param use_cache: whether to use the sidecar binary cache
+    :return: rows, columns and values numpy arrays
+    """
+    if not use_cache or not isinstance(source, six.string_types):
+        return parse_dump(source)
+    cache_path = get_cache_path(source)
+    key = get_cache_key(source)
+    cached = read_cache(cache_path, key=key)
+    if cached is not None:
+        logger.info("Loaded {r_cnt} hic records from cache {cache}".format(r_cnt=len(cached[0]), cache=cache_path))
+        return cached
+    rows, columns, values = parse_dump(source)
+    try:
+        write_cache(cache_path, key, rows, columns, values)
+        logger.info("Cached {r_cnt} hic records to {cache}".format(r_cnt=len(rows), cache=cache_path))
+    except (IOError, OSError) as error:
+        logger.warning("Could not write hic dump cache {cache}: {error}".format(cache=cache_path, error=error))
+    return rows, columns, values
+
+
+def coarsen(rows, columns, values, bin_size):
+    """ Aggregates sparse contact records to a coarser resolution by summing values of records, that fall into the same coarse bin
+
+    Records with NaN values (missing normalization) are ignored.
+
+    :param rows: genomic positions of the first chromosome (multiples of the dump resolution)
+    :param columns: genomic positions of the second chromosome
+    :param values: contacts values
+    :param bin_size: coarse resolution
+    :return: rows, columns (genomic positions of coarse bins, sorted by rows and then by columns) and values numpy arrays
+    """
+    known = ~np.isnan(values)
+    rows, columns, values = np.asarray(rows)[known] // bin_size, np.asarray(columns)[known] // bin_size, np.asarray(values)[known]
+    if len(rows) == 0:
+        return tuple(np.zeros(0, dtype=dtype) for _, dtype in COLUMNS)
+    width = int(columns.max()) + 1
+    keys, inverse = np.unique(rows * width + columns, return_inverse=True)
+    summed = np.bincount(inverse.ravel(), weights=values, minlength=len(keys))
+    return keys // width * bin_size, keys % width * bin_size, summed
+
+
+def get_pyramid_path(dump_path):
+    return dump_path + PYRAMID_SUFFIX
+
+
+def build_pyramid(dump_path, bin_sizes, dump_bin_size, use_cache=True):
+    """ Aggregates a (finest resolution) dump to all coarser resolutions and stores them in a sidecar file next to the dump
+
+    Every resolution is aggregated from the coarsest already aggregated resolution, that it is a multiple of.
+
+    :param dump_path: path to the dump
+    :param bin_sizes: coarse resolutions, every one must be a multiple of dump_bin_size
+    :param dump_bin_size: resolution of the dump
+    :param use_cache: whether to use the sidecar binary cache of the dump
+    :return: path to the pyramid file
+    """
+    bin_sizes = sorted(set(bin_size for bin_size in bin_sizes if bin_size != dump_bin_size))
+    for bin_size in bin_sizes:
+        if bin_size % dump_bin_size != 0:
+            raise ValueError("Resolution {bin_size} is not a multiple of the dump {path} resolution {dump_bin_size}"
+                             "".format(bin_size=bin_size, path=dump_path, dump_bin_size=dump_bin_size))
+    levels = {dump_bin_size: load_dump(dump_path, use_cache=use_cache)}
+    for bin_size in bin_sizes:
+        source_bin_size = max(level for level in levels if bin_size % level == 0)
+        levels[bin_size] = coarsen(*levels[source_bin_size], bin_size=bin_size)
+        logger.info("Aggregated {r_cnt} records at resolution {bin_size} (from {source})".format(r_cnt=len(levels[bin_size][0]), bin_size=bin_size,
+                                                                                                 source=source_bin_size))
+    header = dict(get_cache_key(dump_path), dump_bin_size=dump_bin_size,
+                  levels=[{"bin_size": bin_size, "records_cnt": len(levels[bin_size][0])} for bin_size in bin_sizes])
+    pyramid_path = get_pyramid_path(dump_path)
+    write_arrays(pyramid_path, PYRAMID_MAGIC, header, [array for bin_size in bin_sizes for array in columns_arrays(*levels[bin_size])])
+    return pyramid_path
+
+
+def read_pyramid(pyramid_path, key=None):
+    """ Memory maps all resolutions of a pyramid file
+
+    :param key: if specified, pyramid is only used if it was built from a dump with the same path, size and modification time
+    :return: resolution of the dump and a dict of resolution -> (rows, columns, values), or None, if pyramid is missing or stale
+    """
+    result = read_header(pyramid_path, PYRAMID_MAGIC)
+    if result is None:
+        return None
+    header, offset = result
+    if is_stale(header, key):
+        logger.info("Pyramid {pyramid} is stale, ignoring it".format(pyramid=pyramid_path))
+        return None
+    levels = {}
+    for level in header["levels"]:
+        levels[level["bin_size"]], offset = map_columns(pyramid_path, level["records_cnt"], offset)
+    return header["dump_bin_size"], levels
+
+
+def get_dump_bin_size(dump_path):
+    """ Resolution of a dump, named as "cell-line_chr1_chr2_resolution_correction.txt", None for other names """
+    parts = os.path.basename(dump_path).split("_")
+    return int(parts[3]) if len(parts) == 5 and parts[3].isdigit() else None
+
+
+def load_dump_resolution(source, bin_size, dump_bin_size=None, use_cache=True):
+    """ Loads a dump at a given resolution, either from the dump itself, or from its pyramid (see build_pyramid)
+
+    If the resolution is not stored in the pyramid, dump records are aggregated on the fly from the dump resolution,
+    which is taken from the pyramid or from the dump file name, if it is not given. Records of a dump of an unknown resolution
+    are only returned, if they are positioned at multiples of the requested resolution.
+
+    :param source: path to the dump or an open file object
+    :param bin_size: requested resolution
+    :param dump_bin_size: resolution of the dump, if known
+    :param use_cache: whether to use the sidecar binary cache of the dump
+    :return: rows, columns and values numpy arrays
+    """
+    pyramid = None
+    if use_cache and isinstance(source, six.string_types):
+        pyramid = read_pyramid(get_pyramid_path(source), key=get_cache_key(source))
+    if pyramid is not None:
+        pyramid_dump_bin_size, levels = pyramid
+        if bin_size in levels:
+            logger.info("Loaded {r_cnt} hic records at resolution {bin_size} from pyramid {pyramid}"
+                        "".format(r_cnt=len(levels[bin_size][0]), bin_size=bin_size, pyramid=get_pyramid_path(source)))
+            return levels[bin_size]
+        if dump_bin_size is None:
+            dump_bin_size = pyramid_dump_bin_size
+    if dump_bin_size is None and isinstance(source, six.string_types):
+        dump_bin_size = get_dump_bin_size(source)
+    if dump_bin_size is None:
+        rows, columns, values = load_dump(source, use_cache=use_cache)
+        if np.any(rows % bin_size != 0) or np.any(columns % bin_size != 0):
+            raise ValueError("Records of {source} are not at resolution {bin_size}, and the dump resolution is unknown to aggregate them"
+                             "".format(source=getattr(source, "name", source), bin_size=bin_size))
+        return rows, columns, values
+    if bin_size == dump_bin_size:
+        return load_dump(source, use_cache=use_cache)
+    if bin_size % dump_bin_size != 0:
+        raise ValueError("Resolution {bin_size} can not be aggregated from the dump resolution {dump_bin_size}"
+                         "".format(bin_size=bin_size, dump_bin_size=dump_bin_size))
+    logger.info("Resolution {bin_size} is not stored in a pyramid, aggregating dump records on the fly".format(bin_size=bin_size))
+    return coarsen(*load_dump(source, use_cache=use_cache), bin_size=bin_size)
+
+
+def is_hic_file(source):
+    return isinstance(source, six.string_types) and source.endswith(".hic")
+
+
+def is_genome_store(source):
+    return isinstance(source, six.string_types) and source.endswith(GENOME_STORE_SUFFIX)
+
+
+def load_contacts(source, chromosomes=None, bin_size=None, norm="NONE", use_cache=True, dump_bin_size=None):
+    """ Loads sparse contact records either from a Juicer dump (see load_dump_resolution), a genome wide store of dumps (see genome_store.py),
+    or directly from a local .hic file
+
+    :param source: path to a dump / genome store / .hic file, or an open dump file object
+    :param chromosomes: pair of chromosomes to read from a genome store or a .hic file
+    :param bin_size: resolution to read (for dumps, coarser resolutions are read from the dump pyramid, see build_pyramid)
+    :param norm: normalization to read from a .hic file, raw dumps (and .hic files, for normalizations, that Juicer does not store)
+                 are balanced natively (see balance.py)
+    :param use_cache: whether to use the sidecar binary cache (and the pyramid) for dumps
+    :param dump_bin_size: resolution of the dump, if known
+    :return: rows, columns and values numpy arrays
+    """
+    # balance and genome_store depend on this module, so they are imported on demand
+    if is_genome_store(source):
+        if chromosomes is None:
+            raise ValueError("Chromosomes must be specified for reading from a genome store {path}".format(path=source))
+        from genome_store import open_genome_store
+        store = open_genome_store(source)
+        records = store.records(chromosomes[0], chromosomes[1], bin_size=bin_size)
+        if norm == "NONE":
+            return records
+        if bin_size is None:
+            raise ValueError("Bin size must be specified for {norm} balancing of {path}".format(norm=norm, path=source))
+        from balance import balance_hic_records
+        return balance_hic_records(source, chromosomes, *records, bin_size=bin_size, method=norm)
+    if not is_hic_file(source):
+        if bin_size is None:
+            if norm != "NONE":
+                raise ValueError("Bin size must be specified for {norm} balancing of {path}".format(norm=norm, path=source))
+            return load_dump(source, use_cache=use_cache)
+        records = load_dump_resolution(source, bin_size=bin_size, dump_bin_size=dump_bin_size, use_cache=use_cache)
+        if norm == "NONE":
+            return records
+        if not isinstance(source, six.string_types):
+            raise ValueError("Only dumps, specified by a path, can be balanced")
+        from balance import balance_dump_records
+        return balance_dump_records(source, *records, bin_size=bin_size, method=norm, dump_bin_size=dump_bin_size, use_cache=use_cache)
+    if chromosomes is None or bin_size is None:
+        raise ValueError("Chromosomes and bin size must be specified for reading from a .hic file {path}".format(path=source))
+    if norm not in NORMALIZATIONS:
+        with HicFile(source) as hic:
+            records = hic.records(chromosomes[0], chromosomes[1], bin_size, norm="NONE")
+        from balance import balance_hic_records
+        return balance_hic_records(source, chromosomes, *records, bin_size=bin_size, method=norm)
+    with HicFile(source) as hic:
+        return hic.records(chromosomes[0], chromosomes[1], bin_size, norm=norm)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds multi-resolution pyramids from finest resolution Juicer dumps")
+    parser.add_argument("dumps", type=str, nargs="+", help="Dumps, named as \"cell-line_chr1_chr2_resolution_correction.txt\"")
+    parser.add_argument("--bin-sizes", type=int, nargs="+", required=True, help="Coarse resolutions to aggregate dumps to")
+    parser.add_argument("--dump-bin-size", type=int, default=None, help="Resolution of dumps (taken from the file names by default)")
+    parser.add_argument("--no-dump-cache", action="store_false", dest="dump_cache", default=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    for dump in args.dumps:
+        dump_bin_size = args.dump_bin_size if args.dump_bin_size is not None else get_dump_bin_size(dump)
+        if dump_bin_size is None:
+            parser.error("Resolution of {dump} is not in its name, --dump-bin-size is required".format(dump=dump))
+        logger.info("Building pyramid for {dump} with resolutions {bin_sizes}".format(dump=dump, bin_sizes=args.bin_sizes))
+        build_pyramid(dump, bin_sizes=args.bin_sizes, dump_bin_size=dump_bin_size, use_cache=args.dump_cache)
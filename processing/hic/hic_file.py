@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import logging
+import os
+import struct
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger("hic_file")
+
+HIC_MAGIC = b"HIC\0"
+NORMALIZATIONS = ["NONE", "VC", "VC_SQRT", "KR"]
+
+
+class HicFormatError(Exception):
+    pass
+
+
+class _Buffer(object):
+    """ Little endian reader over an in-memory bytes buffer """
+
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def _unpack(self, fmt):
+        result = struct.unpack_from(fmt, self.data, self.position)
+        self.position += struct.calcsize(fmt)
+        return result[0]
+
+    def byte(self):
+        return self._unpack("<b")
+
+    def short(self):
+        return self._unpack("<h")
+
+    def int32(self):
+        return self._unpack("<i")
+
+    def int64(self):
+        return self._unpack("<q")
+
+    def float32(self):
+        return self._unpack("<f")
+
+    def float64(self):
+        return self._unpack("<d")
+
+    def string(self):
+        end = self.data.index(b"\0", self.position)
+        result = self.data[self.position:end].decode("utf-8")
+        self.position = end + 1
+        return result
+
+    def array(self, dtype, count):
+        dtype = np.dtype(dtype)
+        result = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.position)
+        self.position += dtype.itemsize * count
+        return result
+
+
+class MatrixZoom(object):
+    """ Metadata of a single resolution of a chromosome pair matrix: block size and file positions of blocks """
+    __slots__ = ["unit", "bin_size", "block_bin_cnt", "block_column_cnt", "blocks"]
+
+    def __init__(self, unit, bin_size, block_bin_cnt, block_column_cnt, blocks):
+        self.unit = unit
+        self.bin_size = bin_size
+        self.block_bin_cnt = block_bin_cnt
+        self.block_column_cnt = block_column_cnt
+        self.blocks = blocks  # block number -> (file position, size in bytes)
+
+
+class HicFile(object):
+    """ Reader for locally stored Juicer .hic files (versions 7 to 9)
+
+    Header, master index and normalization vectors index are parsed once on opening,
+    records for a chromosome pair are then obtained by decompressing only the blocks
+    of the requested resolution (and region, if specified).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._source = open(path, "rb")
+        self.chromosomes = []
+        self.chromosome_lengths = {}
+        self.attributes = {}
+        self.bp_resolutions = []
+        self.frag_resolutions = []
+        self._master_index = {}
+        self._norm_vectors_index = {}
+        self._matrices = {}
+        self._norm_vectors = {}
+        self._read_header()
+        self._read_footer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._source.close()
+
+    def _read(self, position, size=-1):
+        self._source.seek(position)
+        return self._source.read(size)
+
+    def _read_header(self):
+        size = 65536
+        while True:
+            data = self._read(0, size)
+            try:
+                return self._parse_header(_Buffer(data))
+            except (struct.error, ValueError):
+                if len(data) < size:
+                    raise HicFormatError("Truncated header in {path}".format(path=self.path))
+                size *= 2
+
+    def _parse_header(self, buf):
+        if buf.data[:4] != HIC_MAGIC:
+            raise HicFormatError("File {path} is not a .hic file".format(path=self.path))
+        buf.position = 4
+        self.version = buf.int32()
+        if self.version < 7:
+            raise HicFormatError("Unsupported .hic file version {version} (only 7 and higher are supported)".format(version=self.version))
+        self._master_index_position = buf.int64()
+        self.genome = buf.string()
+        # position and length of normalized expected values and of the normalization vectors index (version 9)
+        self._norm_index_position, self._norm_index_length = (buf.int64(), buf.int64()) if self.version > 8 else (0, 0)
+        attributes = {}
+        for _ in range(buf.int32()):
+            key = buf.string()
+            attributes[key] = buf.string()
+        chromosomes, lengths = [], {}
+        for _ in range(buf.int32()):
+            name = buf.string()
+            lengths[name] = buf.int64() if self.version > 8 else buf.int32()
+            chromosomes.append(name)
+        bp_resolutions = [buf.int32() for _ in range(buf.int32())]
+        frag_resolutions = [buf.int32() for _ in range(buf.int32())]
+        self.attributes, self.chromosomes, self.chromosome_lengths = attributes, chromosomes, lengths
+        self.bp_resolutions, self.frag_resolutions = bp_resolutions, frag_resolutions
+
+    def _read_footer(self):
+        # number of bytes in the footer (after the field itself): master index and expected values only, normalized expected values
+        # and the normalization vectors index follow it (see _read_norm_index)
+        length_format = "<q" if self.version > 8 else "<i"
+        length_size = struct.calcsize(length_format)
+        data = self._read(self._master_index_position, length_size)
+        if len(data) < length_size:
+            raise HicFormatError("Truncated footer in {path}".format(path=self.path))
+        length = struct.unpack(length_format, data)[0]
+        buf = _Buffer(self._read(self._master_index_position + length_size, length))
+        self._norm_value_dtype = np.dtype("<f4" if self.version > 8 else "<f8")
+        try:
+            for _ in range(buf.int32()):
+                key = buf.string()
+                self._master_index[key] = (buf.int64(), buf.int32())
+            self._skip_expected_values(buf, normalized=False)
+        except (struct.error, ValueError):
+            raise HicFormatError("Truncated footer in {path}".format(path=self.path))
+        self._read_norm_index(self._master_index_position + length_size + length)
+
+    def _skip_expected_values(self, buf, normalized):
+        value_size = self._norm_value_dtype.itemsize
+        for _ in range(buf.int32()):
+            if normalized:
+                buf.string()  # normalization type
+            buf.string()  # unit
+            buf.int32()  # bin size
+            values_cnt = buf.int64() if self.version > 8 else buf.int32()
+            buf.position += values_cnt * value_size
+            scale_factors_cnt = buf.int32()
+            buf.position += scale_factors_cnt * (4 + value_size)  # chromosome index and its scale factor
+
+    def _parse_norm_index(self, buf):
+        """ Skips normalized expected values and parses the normalization vectors index, that follows them """
+        self._skip_expected_values(buf, normalized=True)
+        index = {}
+        for _ in range(buf.int32()):
+            norm, chromosome_index, unit, bin_size = buf.string(), buf.int32(), buf.string(), buf.int32()
+            position = buf.int64()
+            size = buf.int64() if self.version > 8 else buf.int32()
+            index[(norm, chromosome_index, unit, bin_size)] = (position, size)
+        self._norm_vectors_index = index
+
+    def _read_norm_index(self, footer_end):
+        """ Reads the normalization vectors index: from the position in the header (version 9), or just after the footer,
+        reading more of the file, until it is parsed (versions 7 and 8, normalization vectors themselves are stored after it)
+        """
+        if self._norm_index_position > 0:
+            position, size, bounded = self._norm_index_position, self._norm_index_length, True
+        else:
+            position, size, bounded = footer_end, 65536, False
+        while True:
+            data = self._read(position, size)
+            if len(data) == 0:
+                logger.debug("No normalization vectors index in {path}".format(path=self.path))
+                return
+            try:
+                return self._parse_norm_index(_Buffer(data))
+            except (struct.error, ValueError):
+                if bounded or len(data) < size:
+                    logger.warning("Truncated normalization vectors index in {path}, normalized records are not available".format(path=self.path))
+                    return
+                size *= 2
+
+    def chromosome_index(self, name):
+        """ Index of a chromosome by its name, "chr" prefix is matched loosely (e.g. "chr1" and "1" are the same chromosome) """
+        candidates = [name, name[3:] if name.startswith("chr") else "chr" + name]
+        for candidate in candidates:
+            if candidate in self.chromosomes:
+                return self.chromosomes.index(candidate)
+        raise KeyError("Chromosome {name} is not present in {path}".format(name=name, path=self.path))
+
+    def _matrix(self, index1, index2):
+        key = (index1, index2)
+        if key not in self._matrices:
+            master_key = "{c1}_{c2}".format(c1=index1, c2=index2)
+            zooms = {}
+            if master_key in self._master_index:
+                position, size = self._master_index[master_key]
+                buf = _Buffer(self._read(position, size))
+                buf.int32(), buf.int32()
+                for _ in range(buf.int32()):
+                    unit = buf.string()
+                    buf.int32()  # zoom index
+                    for _ in range(4):
+                        buf.float32()  # sum counts, occupied cells count, std dev, 95 percentile
+                    bin_size, block_bin_cnt, block_column_cnt = buf.int32(), buf.int32(), buf.int32()
+                    blocks = {}
+                    for _ in range(buf.int32()):
+                        block_number = buf.int32()
+                        blocks[block_number] = (buf.int64(), buf.int32())
+                    zooms[(unit, bin_size)] = MatrixZoom(unit=unit, bin_size=bin_size, block_bin_cnt=block_bin_cnt,
+                                                         block_column_cnt=block_column_cnt, blocks=blocks)
+            self._matrices[key] = zooms
+        return self._matrices[key]
+
+    def _read_block(self, position, size):
+        """ Decompresses a single block into bin x, bin y and counts arrays """
+        buf = _Buffer(zlib.decompress(self._read(position, size)))
+        records_cnt = buf.int32()
+        x_offset, y_offset = buf.int32(), buf.int32()
+        float_counts = buf.byte() != 0
+        int_x, int_y = False, False
+        if self.version > 8:
+            int_x, int_y = buf.byte() != 0, buf.byte() != 0
+        block_type = buf.byte()
+        counts_dtype = "<f4" if float_counts else "<i2"
+        if block_type == 1:
+            xs, ys, counts = [], [], []
+            position_y = buf.int32 if int_y else buf.short
+            position_x_dtype = "<i4" if int_x else "<i2"
+            cell_dtype = np.dtype([("x", position_x_dtype), ("counts", counts_dtype)])
+            for _ in range(position_y()):
+                y = position_y()
+                cells_cnt = buf.int32() if int_x else buf.short()
+                cells = buf.array(cell_dtype, cells_cnt)
+                xs.append(cells["x"].astype(np.int64) + x_offset)
+                ys.append(np.full(cells_cnt, y + y_offset, dtype=np.int64))
+                counts.append(cells["counts"].astype(np.float64))
+            if len(xs) == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+            return np.concatenate(xs), np.concatenate(ys), np.concatenate(counts)
+        elif block_type == 2:
+            points_cnt = buf.int32()
+            width = buf.short()
+            counts = buf.array(counts_dtype, points_cnt)
+            present = ~np.isnan(counts) if float_counts else counts != -32768
+            points = np.flatnonzero(present)
+            return x_offset + points % width, y_offset + points // width, counts[present].astype(np.float64)
+        raise HicFormatError("Unknown block type {block_type} in {path}".format(block_type=block_type, path=self.path))
+
+    def norm_vector(self, chromosome, bin_size, norm, unit="BP"):
+        """ Normalization vector (one value per bin) of a chromosome, loaded once and cached """
+        index = self.chromosome_index(chromosome)
+        key = (norm, index, unit, bin_size)
+        if key not in self._norm_vectors:
+            if key not in self._norm_vectors_index:
+                raise KeyError("No {norm} normalization vector for chromosome {chromosome} at {unit} {bin_size} in {path}"
+                               "".format(norm=norm, chromosome=chromosome, unit=unit, bin_size=bin_size, path=self.path))
+            position, size = self._norm_vectors_index[key]
+            buf = _Buffer(self._read(position, size))
+            values_cnt = buf.int64() if self.version > 8 else buf.int32()
+            self._norm_vectors[key] = buf.array(self._norm_value_dtype, values_cnt).astype(np.float64)
+        return self._norm_vectors[key]
+
+    def _blocks_for_region(self, zoom, bins1, bins2, intra):
+        if bins1 is None and bins2 is None or self.version > 8:
+            return sorted(zoom.blocks)
+        bins1 = bins1 if bins1 is not None else (0, zoom.block_column_cnt * zoom.block_bin_cnt)
+        bins2 = bins2 if bins2 is not None else (0, zoom.block_column_cnt * zoom.block_bin_cnt)
+        columns = range(bins1[0] // zoom.block_bin_cnt, bins1[1] // zoom.block_bin_cnt + 1)
+        rows = range(bins2[0] // zoom.block_bin_cnt, bins2[1] // zoom.block_bin_cnt + 1)
+        result = set()
+        for row in rows:
+            for column in columns:
+                result.add(row * zoom.block_column_cnt + column)
+                if intra:
+                    result.add(column * zoom.block_column_cnt + row)
+        return sorted(number for number in result if number in zoom.blocks)
+
+    def records(self, chr1, chr2, bin_size, norm="NONE", unit="BP", region1=None, region2=None):
+        """ Sparse contact records between two chromosomes, in the same form, as they are produced by "juicebox_tools dump"
+
+        :param chr1: name of the first chromosome (its positions are returned first)
+        :param chr2: name of the second chromosome
+        :param bin_size: resolution of the matrix
+        :param norm: normalization, applied to the observed counts (NONE/VC/VC_SQRT/KR)
+        :param unit: resolution unit (BP/FRAG)
+        :param region1: optional (start, end) genomic interval on the first chromosome
+        :param region2: optional (start, end) genomic interval on the second chromosome
+        :return: positions on chr1, positions on chr2 and values numpy arrays
+        """
+        index1, index2 = self.chromosome_index(chr1), self.chromosome_index(chr2)
+        swapped = index1 > index2
+        if swapped:
+            index1, index2, region1, region2 = index2, index1, region2, region1
+        zooms = self._matrix(index1, index2)
+        if (unit, bin_size) not in zooms:
+            raise KeyError("No {unit} {bin_size} resolution for chromosomes {chr1} and {chr2} in {path}"
+                           "".format(unit=unit, bin_size=bin_size, chr1=chr1, chr2=chr2, path=self.path))
+        zoom = zooms[(unit, bin_size)]
+        bins1 = None if region1 is None else (region1[0] // bin_size, (region1[1] - 1) // bin_size)
+        bins2 = None if region2 is None else (region2[0] // bin_size, (region2[1] - 1) // bin_size)
+        xs, ys, counts = [], [], []
+        for block_number in self._blocks_for_region(zoom, bins1, bins2, intra=index1 == index2):
+            x, y, c = self._read_block(*zoom.blocks[block_number])
+            xs.append(x)
+            ys.append(y)
+            counts.append(c)
+        x = np.concatenate(xs) if len(xs) > 0 else np.zeros(0, dtype=np.int64)
+        y = np.concatenate(ys) if len(ys) > 0 else np.zeros(0, dtype=np.int64)
+        values = np.concatenate(counts) if len(counts) > 0 else np.zeros(0, dtype=np.float64)
+        selected = np.ones(len(x), dtype=bool)
+        if bins1 is not None:
+            selected &= (x >= bins1[0]) & (x <= bins1[1])
+        if bins2 is not None:
+            selected &= (y >= bins2[0]) & (y <= bins2[1])
+        x, y, values = x[selected], y[selected], values[selected]
+        order = np.lexsort((y, x))
+        x, y, values = x[order], y[order], values[order]
+        if norm != "NONE":
+            norm1 = self.norm_vector(self.chromosomes[index1], bin_size, norm, unit=unit)
+            norm2 = self.norm_vector(self.chromosomes[index2], bin_size, norm, unit=unit)
+            values = values / (norm1[x] * norm2[y])
+        if swapped:
+            x, y = y, x
+        return x * bin_size, y * bin_size, values
+
+
+def chromosome_pairs(chromosomes, pairs):
+    result = []
+    for i, chr1 in enumerate(chromosomes):
+        for chr2 in chromosomes[i:]:
+            if chr1 == chr2 and pairs == "inter" or chr1 != chr2 and pairs == "intra":
+                continue
+            result.append((chr1, chr2))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports sparse contact matrices of chromosome pairs from a local .hic file, "
+                                                 "in the same format as \"juicebox_tools dump\" does")
+    parser.add_argument("hic", type=str)
+    parser.add_argument("--cell-line", type=str, required=True)
+    parser.add_argument("--chromosomes", type=str, nargs="+", default=None, help="Defaults to all chromosomes in the .hic file (but \"ALL\")")
+    parser.add_argument("--pairs", type=str, choices=["inter", "intra", "all"], default="all")
+    parser.add_argument("--norm", type=str, choices=NORMALIZATIONS, default="KR")
+    parser.add_argument("--bin-size", type=int, default=5000)
+    parser.add_argument("--logging", type=int, choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL], default=logging.INFO)
+    parser.add_argument("-o", "--output-dir", default=".")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.logging,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    logger.setLevel(args.logging)
+    with HicFile(args.hic) as hic:
+        logger.info("Opened {path} (version {version}, genome {genome})".format(path=args.hic, version=hic.version, genome=hic.genome))
+        chromosomes = args.chromosomes if args.chromosomes is not None else [c for c in hic.chromosomes if c.upper() != "ALL"]
+        for chr1, chr2 in chromosome_pairs(chromosomes, args.pairs):
+            c1 = chr1[3:] if chr1.startswith("chr") else chr1
+            c2 = chr2[3:] if chr2.startswith("chr") else chr2
+            output_path = os.path.join(args.output_dir, "{cell_line}_{chr1}_{chr2}_{bin_size}_{correction}.txt"
+                                                        "".format(cell_line=args.cell_line.replace("_", "-"), chr1=c1, chr2=c2,
+                                                                  bin_size=args.bin_size, correction=args.norm))
+            logger.info("Exporting chromosomes {chr1} and {chr2} to {path}".format(chr1=chr1, chr2=chr2, path=output_path))
+            try:
+                positions1, positions2, values = hic.records(chr1, chr2, args.bin_size, norm=args.norm)
+            except KeyError as error:
+                logger.error("Skipping chromosomes {chr1} and {chr2}: {error}".format(chr1=chr1, chr2=chr2, error=error))
+                continue
+            with open(output_path, "wt") as dest:
+                for position1, position2, value in zip(positions1.tolist(), positions2.tolist(), values.tolist()):
+                    print(position1, position2, value, sep="\t", file=dest)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import collections
+import contextlib
+import cProfile
+import datetime
+import json
+import logging
+import os
+import resource
+import signal
+import sys
+import time
+
+logger = logging.getLogger("metrics")
+
+PROFILERS = ["cprofile", "sample"]
+
+
+def get_peak_rss():
+    """ Peak resident set size of the current process so far (in Mb) """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def get_cpu_time():
+    """ User and system CPU time of the current process """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Metrics(object):
+    """ Wall time, CPU time, process peak RSS and named counts (rows, pairs, short fragments, etc.) of consecutive stages of a run
+
+    Usage:
+        with metrics.stage("load", items="hic_records") as counts:
+            ...
+            counts["hic_records"] = len(rows)
+
+    Throughput of a stage is the number of its items per second of wall time.
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.started = datetime.datetime.now()
+        self._wall, self._cpu = time.time(), get_cpu_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None):
+        counts = collections.OrderedDict()
+        wall, cpu = time.time(), get_cpu_time()
+        try:
+            yield counts
+        finally:
+            wall, cpu = time.time() - wall, get_cpu_time() - cpu
+            items_cnt = counts.get(items)
+            self.stages[name] = {"wall": wall, "cpu": cpu, "peak_rss_mb": get_peak_rss(), "counts": dict(counts), "items": items_cnt,
+                                 "throughput": items_cnt / wall if items_cnt is not None and wall > 0 else None}
+            logger.debug("Stage {name} took {wall:.3f}s wall, {cpu:.3f}s CPU".format(name=name, wall=wall, cpu=cpu))
+
+    def report(self):
+        return {"started": self.started.isoformat(), "command": sys.argv, "wall": time.time() - self._wall, "cpu": get_cpu_time() - self._cpu,
+                "peak_rss_mb": get_peak_rss(), "stages": self.stages}
+
+    def write(self, path):
+        """ Writes the report down as json """
+        with open(path, "wt") as dest:
+            json.dump(self.report(), dest, indent=2)
+        logger.info("Metrics are written to {path}".format(path=path))
+
+
+class SamplingProfiler(object):
+    """ Statistical profiler, that samples the main thread stack every interval seconds of CPU time (unix only)
+
+    Samples are written down in a "collapsed stacks" format (frames separated by ";", followed by a samples count),
+    which is understood by flame graph tools.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{function} ({file}:{line})".format(function=code.co_name, file=os.path.basename(code.co_filename), line=frame.f_lineno))
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous)
+
+    def write(self, path):
+        with open(path, "wt") as dest:
+            for stack, count in self.samples.most_common():
+                print(stack, count, file=dest)
+
+
+@contextlib.contextmanager
+def profiling(profiler, path, interval=0.005):
+    """ Profiles the enclosed code with cProfile (stats are dumped to path) or with a SamplingProfiler, does nothing, if profiler is None """
+    if profiler is None:
+        yield
+        return
+    if profiler == "cprofile":
+        instance = cProfile.Profile()
+        instance.enable()
+    else:
+        instance = SamplingProfiler(interval=interval)
+        instance.start()
+    try:
+        yield
+    finally:
+        if profiler == "cprofile":
+            instance.disable()
+            instance.dump_stats(path)
+        else:
+            instance.stop()
+            instance.write(path)
+        logger.info("Profile is written to {path}".format(path=path))
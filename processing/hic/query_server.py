@@ -0,0 +1,419 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from fragment_catalog import load_fragment_catalog
+from frag_matrix import FragmentBins, FragmentIndex, contacts_submatrix, count_contacts, load_hic_data, resize_hic_data
+from genome_store import chromosome_order, open_genome_store, parse_dump_name
+from hic_dump import is_genome_store, is_hic_file
+
+logger = logging.getLogger("query_server")
+
+QUERIES = ["/regions", "/fragments", "/row", "/metrics"]
+
+
+class _PendingLoad(object):
+    """ A value, that is being loaded by one thread, while others wait for it """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class LRUCache(object):
+    """ Size bounded least recently used cache, concurrent requests for a missing key share a single load
+
+    :param max_bytes: maximum total size of cached values (the most recently loaded value is kept, even if it alone is larger)
+    :param sizeof: function, that returns a size of a value in bytes
+    """
+
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits, self.misses, self.shared, self.evictions, self.load_time = 0, 0, 0, 0, 0.0
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """ Cached value of a key, or a value, loaded with load() (once for all concurrent requests of the key) """
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            pending = self._loading.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._loading[key] = _PendingLoad()
+                self.misses += 1
+            else:
+                self.shared += 1
+        if not owner:
+            return pending.wait()
+        start_time = time.time()
+        try:
+            pending.value = load()
+        except Exception as error:
+            pending.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+                self.load_time += time.time() - start_time
+                if pending.error is None:
+                    size = self.sizeof(pending.value)
+                    self._entries[key] = (pending.value, size)
+                    self.bytes += size
+                    while self.bytes > self.max_bytes and len(self._entries) > 1:
+                        evicted_key, (_, evicted_size) = self._entries.popitem(last=False)
+                        self.bytes -= evicted_size
+                        self.evictions += 1
+                        logger.debug("Evicted {key} ({size:.1f} Mb) from cache".format(key=evicted_key, size=evicted_size / 2 ** 20))
+            pending.event.set()
+        return pending.value
+
+    def stats(self):
+        with self._lock:
+            requests_cnt = self.hits + self.misses + self.shared
+            return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                    "shared_loads": self.shared, "evictions": self.evictions, "load_time": self.load_time,
+                    "hit_rate": (self.hits + self.shared) / requests_cnt if requests_cnt > 0 else None,
+                    "keys": [list(key) for key in self._entries]}
+
+
+def matrix_nbytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+class ContactsSource(object):
+    """ Chromosome pairs of a directory of dumps (named as "cell-line_chr1_chr2_resolution_correction.txt"), a genome store or a .hic file
+
+    Pairs are addressed in a canonical orientation: the one of a dump, or the chromosome order (see genome_store.chromosome_order).
+    """
+
+    def __init__(self, path, bin_size=None, use_cache=True):
+        self.path = path
+        self.use_cache = use_cache
+        self.dumps = {}
+        if is_hic_file(path):
+            if bin_size is None:
+                raise ValueError("Bin size is required for a .hic file {path}".format(path=path))
+        elif is_genome_store(path):
+            bin_size = open_genome_store(path).bin_size if bin_size is None else bin_size
+        else:
+            for name in sorted(os.listdir(path)):
+                if not (name.endswith(".txt") or name.endswith(".txt.gz")) or len(name.split("_")) != 5:
+                    continue
+                _, chr1, chr2, resolution, _ = parse_dump_name(name)
+                key = frozenset((chr1, chr2))
+                if key in self.dumps:
+                    raise ValueError("Chromosomes {chr1} and {chr2} are dumped more than once in {path}".format(chr1=chr1, chr2=chr2, path=path))
+                self.dumps[key] = (os.path.join(path, name), chr1, chr2, resolution)
+            if len(self.dumps) == 0:
+                raise ValueError("No dumps in {path}".format(path=path))
+            if bin_size is None:
+                resolutions = set(resolution for _, _, _, resolution in self.dumps.values())
+                if len(resolutions) > 1:
+                    raise ValueError("Dumps in {path} have different resolutions, bin size must be specified".format(path=path))
+                bin_size = resolutions.pop()
+        self.bin_size = bin_size
+
+    def orient(self, chr1, chr2):
+        """ :return: canonical orientation of a chromosome pair """
+        if len(self.dumps) > 0:
+            dump = self.dumps.get(frozenset((chr1, chr2)))
+            if dump is None:
+                raise ValueError("No dump of chromosomes {chr1} and {chr2} in {path}".format(chr1=chr1, chr2=chr2, path=self.path))
+            return dump[1], dump[2]
+        return tuple(sorted((chr1, chr2), key=chromosome_order))
+
+    def load(self, chr1, chr2, norm="NONE", data="observed"):
+        """ CSR matrix of a chromosome pair in its canonical orientation (see frag_matrix.load_hic_data) """
+        if len(self.dumps) > 0:
+            path, _, _, dump_bin_size = self.dumps[frozenset((chr1, chr2))]
+        else:
+            path, dump_bin_size = self.path, None
+        logger.info("Loading chromosomes {chr1} and {chr2} from {path}".format(chr1=chr1, chr2=chr2, path=path))
+        return load_hic_data(hic_filename=path, step=self.bin_size, use_cache=self.use_cache, chromosomes=(chr1, chr2), norm=norm,
+                             dump_step=dump_bin_size, data=data)
+
+
+def parse_region(region):
+    """ :return: chromosome, start and end of a "chromosome:start-end" region (end is exclusive, thousands separators are allowed) """
+    try:
+        chromosome, interval = region.rsplit(":", 1)
+        start, end = (int(position.replace(",", "")) for position in interval.split("-"))
+    except ValueError:
+        raise ValueError("Region {region} is not in a \"chromosome:start-end\" form".format(region=region))
+    if start >= end:
+        raise ValueError("Region {region} is empty".format(region=region))
+    return chromosome, start, end
+
+
+def _json_values(array):
+    """ Nested lists of array values, with NaN values replaced by None """
+    array = np.asarray(array, dtype=np.float64)
+    return np.where(np.isnan(array), None, array).tolist()
+
+
+class QueryService(object):
+    """ Answers region x region, fragment x fragment and per fragment row queries from chromosome pair matrices, kept in an LRU cache
+
+    Fragments values follow frag_matrix conventions: contacts of a pair of fragments of the same chromosome are taken from the stored
+    triangle of the matrix, in the order of the fragments in the fragments file.
+    """
+
+    def __init__(self, source, cache, fragment_index=None, max_cells=10 ** 7):
+        self.source = source
+        self.cache = cache
+        self.fragment_index = fragment_index
+        self.max_cells = max_cells
+        self.locations = {}
+        if fragment_index is not None:
+            for chromosome, fragments in fragment_index.chromosomes.items():
+                for index, name in enumerate(fragments.names.tolist()):
+                    self.locations[name] = (chromosome, index)
+        self.requests = collections.defaultdict(lambda: {"count": 0, "errors": 0, "time": 0.0})
+        self._lock = threading.Lock()
+
+    def matrix(self, chr1, chr2, norm, data):
+        """ :return: CSR matrix of a chromosome pair in its canonical orientation and whether the requested orientation is transposed """
+        canonical = self.source.orient(chr1, chr2)
+
+        def load():
+            matrix = self.source.load(canonical[0], canonical[1], norm=norm, data=data)
+            if self.fragment_index is None:
+                return matrix
+            # covering bins of all fragments of both chromosomes once, rather than resizing a cached matrix on every query
+            shape = tuple(self.fragment_index.bins(chromosome, step=self.source.bin_size, measure="outer").bins_cnt for chromosome in canonical)
+            return resize_hic_data(hic_data=matrix, shape=shape)
+
+        return self.cache.get(canonical + (norm, data), load), canonical != (chr1, chr2)
+
+    def regions(self, region1, region2, norm="NONE", data="observed"):
+        (chr1, start1, end1), (chr2, start2, end2) = parse_region(region1), parse_region(region2)
+        step = self.source.bin_size
+        bins1, bins2 = np.arange(start1 // step, (end1 - 1) // step + 1), np.arange(start2 // step, (end2 - 1) // step + 1)
+        if len(bins1) * len(bins2) > self.max_cells:
+            raise ValueError("Regions span {c_cnt} cells, which is more than {max_cells}".format(c_cnt=len(bins1) * len(bins2), max_cells=self.max_cells))
+        matrix, transposed = self.matrix(chr1, chr2, norm=norm, data=data)
+        if transposed:
+            bins1, bins2 = bins2, bins1
+        block = self._block(matrix, bins1, bins2)
+        if chr1 == chr2:
+            # a single triangle is stored, so the block is mirrored, bins on the diagonal are only counted once
+            block += np.where(bins1[:, np.newaxis] == bins2[np.newaxis, :], 0.0, self._block(matrix, bins2, bins1).T)
+        if transposed:
+            bins1, bins2, block = bins2, bins1, block.T
+        return {"rows": (bins1 * step).tolist(), "columns": (bins2 * step).tolist(), "values": _json_values(block)}
+
+    @staticmethod
+    def _block(matrix, rows, columns):
+        block = np.zeros((len(rows), len(columns)), dtype=np.float64)
+        rows_in, columns_in = rows[rows < matrix.shape[0]], columns[columns < matrix.shape[1]]
+        if len(rows_in) > 0 and len(columns_in) > 0:
+            block[:len(rows_in), :len(columns_in)] = matrix[rows_in[0]:rows_in[-1] + 1, columns_in[0]:columns_in[-1] + 1].toarray()
+        return block
+
+    def _locate(self, names):
+        if self.fragment_index is None:
+            raise ValueError("Fragments are not loaded, fragment queries are not available")
+        unknown = [name for name in names if name not in self.locations]
+        if len(unknown) > 0:
+            raise ValueError("Unknown fragments: {names}".format(names=", ".join(unknown)))
+        by_chromosome = collections.OrderedDict()
+        for name in names:
+            chromosome, index = self.locations[name]
+            by_chromosome.setdefault(chromosome, set()).add(index)
+        return collections.OrderedDict((chromosome, sorted(indexes)) for chromosome, indexes in by_chromosome.items())
+
+    def _bins(self, chromosome, indexes, measure):
+        return FragmentBins(fragments=self.fragment_index.fragments(chromosome).take(indexes), step=self.source.bin_size, measure=measure)
+
+    def fragments(self, names, measure="inner", contact="value", norm="NONE", data="observed"):
+        """ Contacts between all pairs of fragments (including a fragment with itself), that have at least one hic entry between them """
+        located = self._locate(names)
+        chromosomes = list(located)
+        result = []
+        for position, chromosome1 in enumerate(chromosomes):
+            for chromosome2 in chromosomes[position:]:
+                matrix, transposed = self.matrix(chromosome1, chromosome2, norm=norm, data=data)
+                indexes1, indexes2 = located[chromosome1], located[chromosome2]
+                if transposed:
+                    indexes1, indexes2 = indexes2, indexes1
+                chr1, chr2 = (chromosome2, chromosome1) if transposed else (chromosome1, chromosome2)
+                bins1 = self._bins(chr1, indexes1, measure)
+                bins2 = bins1 if chr1 == chr2 else self._bins(chr2, indexes2, measure)
+                totals, observed = count_contacts(hic_data=matrix, bins1=bins1, bins2=bins2)
+                observed = observed.tocoo()
+                for i, j in zip(observed.row.tolist(), observed.col.tolist()):
+                    if chr1 == chr2 and i > j:
+                        continue
+                    entry = {"fragment1": bins1.names[i], "fragment2": bins2.names[j], "value": _json_values(totals[i, j])}
+                    if contact == "matrix":
+                        entry["matrix"] = _json_values(contacts_submatrix(hic_data=matrix, bins1=bins1, i=i, bins2=bins2, j=j)[0])
+                    result.append(entry)
+        return {"pairs": result}
+
+    def row(self, name, chromosome=None, measure="inner", norm="NONE", data="observed"):
+        """ Contacts of a fragment with every fragment of a chromosome (its own one by default), that it has at least one hic entry with """
+        (own_chromosome, (index,)), = self._locate([name]).items()
+        chromosome = own_chromosome if chromosome is None else chromosome
+        matrix, transposed = self.matrix(own_chromosome, chromosome, norm=norm, data=data)
+        fragment = self._bins(own_chromosome, [index], measure)
+        others = self.fragment_index.bins(chromosome, step=self.source.bin_size, measure=measure)
+        if chromosome == own_chromosome:
+            # pairs are oriented by the order of fragments, so the row is split at the fragment itself
+            totals, observed = count_contacts(hic_data=matrix, bins1=fragment, bins2=others)
+            totals_before, observed_before = count_contacts(hic_data=matrix, bins1=others, bins2=fragment)
+            totals, observed = totals.toarray().ravel(), observed.toarray().ravel()
+            totals[:index], observed[:index] = totals_before.toarray().ravel()[:index], observed_before.toarray().ravel()[:index]
+        elif transposed:
+            totals, observed = (array.toarray().ravel() for array in count_contacts(hic_data=matrix, bins1=others, bins2=fragment))
+        else:
+            totals, observed = (array.toarray().ravel() for array in count_contacts(hic_data=matrix, bins1=fragment, bins2=others))
+        return {"fragment": name, "chromosome": chromosome,
+                "contacts": [{"fragment": others.names[j], "value": _json_values(totals[j])} for j in np.flatnonzero(observed).tolist()]}
+
+    def metrics(self):
+        with self._lock:
+            requests = {path: dict(stats) for path, stats in self.requests.items()}
+        return {"cache": self.cache.stats(), "requests": requests}
+
+    def handle(self, path, query):
+        """ Dispatches a request path (one of QUERIES) with parsed query parameters (see parse_qs) to a query
+
+        :return: json serializable result
+        """
+        def get(name, default=None):
+            values = query.get(name)
+            if values is None:
+                if default is None:
+                    raise ValueError("Parameter {name} is required".format(name=name))
+                return default
+            return values[-1]
+
+        options = {"norm": get("norm", "NONE"), "data": get("data", "observed")}
+        if options["data"] not in ("observed", "oe"):
+            raise ValueError("Data must be either observed or oe")
+        if path == "/regions":
+            return self.regions(get("region1"), get("region2", get("region1")), **options)
+        if path == "/fragments":
+            names = [name for value in query.get("names", []) for name in value.split(",") if len(name) > 0]
+            if len(names) == 0:
+                raise ValueError("Parameter names is required")
+            return self.fragments(names, measure=get("measure", "inner"), contact=get("contact", "value"), **options)
+        if path == "/row":
+            return self.row(get("name"), chromosome=query.get("chromosome", [None])[-1], measure=get("measure", "inner"), **options)
+        return self.metrics()
+
+    def record(self, path, elapsed, failed):
+        with self._lock:
+            stats = self.requests[path]
+            stats["count"] += 1
+            stats["errors"] += int(failed)
+            stats["time"] += elapsed
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ GET /regions?region1=chr:start-end&region2=chr:start-end, /fragments?names=f1,f2,..., /row?name=f[&chromosome=c] and /metrics,
+    optional norm, data, measure and contact parameters are the same, as in frag_matrix.py, responses are json
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        start_time = time.time()
+        status = 200
+        try:
+            if url.path not in QUERIES:
+                status, result = 404, {"error": "Unknown query {path}, expected one of {queries}".format(path=url.path, queries=", ".join(QUERIES))}
+            else:
+                result = self.server.service.handle(url.path, parse_qs(url.query))
+        except (KeyError, ValueError) as error:
+            status, result = 400, {"error": str(error)}
+        except Exception as error:
+            logger.exception("Failed to answer {path}".format(path=self.path))
+            status, result = 500, {"error": "{name}: {error}".format(name=type(error).__name__, error=error)}
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.service.record(url.path if url.path in QUERIES else "unknown", time.time() - start_time, status != 200)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class QueryServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixQueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves contact queries over HTTP from chromosome pair matrices, that are kept loaded")
+    parser.add_argument("--hic", type=str, required=True,
+                        help="Directory of dumps, named as \"cell-line_chr1_chr2_resolution_correction.txt\", a genome store or a .hic file")
+    parser.add_argument("--fragments", type=str, default=None, help="Fragments file, fragment queries are only available with it")
+    parser.add_argument("--frag-lengths", type=int, default=-1)
+    parser.add_argument("--bin-size", type=int, default=None, help="Resolution, required for a .hic file (store / dumps resolution by default)")
+    parser.add_argument("--no-dump-cache", action="store_false", dest="dump_cache", default=True)
+    parser.add_argument("--cache-size", type=float, default=4096, help="Maximum total size of loaded matrices in Mb")
+    parser.add_argument("--max-cells", type=int, default=10 ** 7, help="Maximum number of cells of a region x region query")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", type=str, default=None, help="Listen on a unix socket at this path, rather than on host and port")
+    parser.add_argument("--logging", type=int, choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL], default=logging.INFO)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.logging,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    logger.setLevel(args.logging)
+    fragment_index = None
+    if args.fragments is not None:
+        logger.info("Loading fragments info from {f_filename}".format(f_filename=os.path.basename(args.fragments)))
+        fragment_index = FragmentIndex(fragments=load_fragment_catalog(args.fragments, use_cache=args.dump_cache), frag_lengths=args.frag_lengths)
+    service = QueryService(source=ContactsSource(args.hic, bin_size=args.bin_size, use_cache=args.dump_cache),
+                           cache=LRUCache(max_bytes=args.cache_size * 2 ** 20, sizeof=matrix_nbytes), fragment_index=fragment_index,
+                           max_cells=args.max_cells)
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = UnixQueryServer(args.unix_socket, QueryHandler)
+        logger.info("Serving queries on {path}".format(path=args.unix_socket))
+    else:
+        server = QueryServer((args.host, args.port), QueryHandler)
+        logger.info("Serving queries on http://{host}:{port}".format(host=args.host, port=server.server_address[1]))
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.server_close()
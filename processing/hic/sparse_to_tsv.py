@@ -1,40 +1,112 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
+from __future__ import print_function
 import argparse
-import csv
+import bz2
 import logging
+import multiprocessing
 import sys
 import pandas as pd
 import numpy as np
 
+from scipy import sparse
 
-def read_hic_export(file_name, step=None, ignore_empty_start=True, symmetrical=True):
-    data = []
-    chr1_max_value = -1
-    chr2_max_value = -1
-    chr1_min_value = 100000000000
-    chr2_min_value = 100000000000
-    reader = csv.reader(file_name, delimiter='\t', quotechar='|')
+from bgzf import open_text_output
+from expected import DATA_TYPES, compute_expected, expected_block, observed_over_expected, pearson_blocks
+from hic_dump import is_genome_store, is_hic_file, load_contacts
+from metrics import PROFILERS, Metrics, profiling
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+logger = logging.getLogger("sparse_to_csv")
+
+
+class SparseExport(object):
+    """ Sparse hic export records, bucketed by (dense matrix) row, and, for symmetrical matrices, by column too
+
+    Dense matrix rows/columns correspond to genomic positions row_labels/column_labels,
+    record k sits in row rows[k] and column columns[k] of it (indexes, rather than genomic positions).
+    Dense blocks hold either record values (observed or oe data), expected values by distance (expected data),
+    or Pearson correlations of rows of a symmetrical O/E matrix, that records hold (pearson data).
+    """
+
+    def __init__(self, rows, columns, values, row_labels, column_labels, symmetrical, data="observed", expected=None):
+        self.row_labels = row_labels
+        self.column_labels = column_labels
+        self.symmetrical = symmetrical
+        self.data = data
+        self.expected = expected
+        by_row = np.argsort(rows, kind="mergesort")
+        self.rows, self.columns, self.values = rows[by_row], columns[by_row], values[by_row]
+        self.row_bounds = np.searchsorted(self.rows, np.arange(len(row_labels) + 1))
+        if symmetrical:
+            # diagonal records are not mirrored, as values are summed into dense blocks
+            off_diagonal = np.flatnonzero(self.rows != self.columns)
+            by_column = off_diagonal[np.argsort(self.columns[off_diagonal], kind="mergesort")]
+            self.mirrored_rows, self.mirrored_columns, self.mirrored_values = self.columns[by_column], self.rows[by_column], self.values[by_column]
+            self.mirrored_row_bounds = np.searchsorted(self.mirrored_rows, np.arange(len(row_labels) + 1))
+
+    @property
+    def shape(self):
+        return len(self.row_labels), len(self.column_labels)
+
+    def dense_blocks(self, block_rows, upper_triangular=False):
+        """ Yields (row labels, dense block of values) for consecutive blocks of at most block_rows matrix rows
+
+        Symmetrical records are mirrored and lower triangle is zeroed out on the fly, so that
+        at most a single (block_rows x columns) dense block is allocated at a time.
+        """
+        rows_cnt, columns_cnt = self.shape
+        for block_start, block in self._blocks(block_rows):
+            block_end = block_start + len(block)
+            block[np.isnan(block)] = 0.0
+            if upper_triangular:
+                lower = np.arange(columns_cnt)[np.newaxis, :] < np.arange(block_start, block_end)[:, np.newaxis]
+                block[lower] = 0.0
+            yield self.row_labels[block_start:block_end], block
+
+    def _blocks(self, block_rows):
+        rows_cnt, columns_cnt = self.shape
+        if self.data == "pearson":
+            # O/E matrix is assembled from the same dense blocks, as observed values are written from, so that mirroring is consistent
+            matrix = sparse.vstack([sparse.csr_matrix(np.nan_to_num(block)) for block_start, block in self._value_blocks(block_rows)], format="csr")
+            for block_start, block in pearson_blocks(matrix, block_rows):
+                yield block_start, block
+        elif self.data == "expected":
+            for block_start in range(0, rows_cnt, block_rows):
+                block_end = min(block_start + block_rows, rows_cnt)
+                yield block_start, expected_block(self.expected, np.arange(block_start, block_end), np.arange(columns_cnt), intra=self.symmetrical)
+        else:
+            for block_start, block in self._value_blocks(block_rows):
+                yield block_start, block
+
+    def _value_blocks(self, block_rows):
+        rows_cnt, columns_cnt = self.shape
+        for block_start in range(0, rows_cnt, block_rows):
+            block_end = min(block_start + block_rows, rows_cnt)
+            block = np.zeros((block_end - block_start, columns_cnt), dtype=np.float64)
+            first, last = self.row_bounds[block_start], self.row_bounds[block_end]
+            # records, that fall into the same cell, are summed rather than overwritten
+            np.add.at(block, (self.rows[first:last] - block_start, self.columns[first:last]), self.values[first:last])
+            if self.symmetrical:
+                first, last = self.mirrored_row_bounds[block_start], self.mirrored_row_bounds[block_end]
+                np.add.at(block, (self.mirrored_rows[first:last] - block_start, self.mirrored_columns[first:last]), self.mirrored_values[first:last])
+            yield block_start, block
+
+
+def read_hic_export(file_name, step=None, ignore_empty_start=True, symmetrical=True, use_cache=True, chromosomes=None, norm="NONE", data="observed"):
     logger.info("Reading sparse hic export matrix")
-    for row in reader:
-        row_id, column_id, value = int(row[0]), int(row[1]), float(row[2])
-        data.append((row_id, column_id, value))
-        if column_id > chr2_max_value:
-            chr2_max_value = column_id
-        if row_id > chr1_max_value:
-            chr1_max_value = row_id
-        if column_id < chr2_min_value:
-            chr2_min_value = column_id
-        if row_id < chr1_min_value:
-            chr1_min_value = row_id
-    logger.info("Creating pandas DataFrame")
+    rows, columns, values = load_contacts(file_name, chromosomes=chromosomes, bin_size=step, norm=norm, use_cache=use_cache)
+    chr1_max_value, chr1_min_value = int(rows.max()), int(rows.min())
+    chr2_max_value, chr2_min_value = int(columns.max()), int(columns.min())
     if step is None:
         logger.info("Inferring matrix resolution")
-        rows = sorted(set([entry[0] for entry in data]))
-        rows_min = min(a2 - a1 for a1, a2 in zip(rows[:-1], rows[1:]))
-        columns = sorted(set([entry[1] for entry in data]))
-        columns_min = min(a2 - a1 for a1, a2 in zip(columns[:-1], columns[1:]))
-        step = min(rows_min, columns_min)
+        rows_min = np.diff(np.unique(rows)).min()
+        columns_min = np.diff(np.unique(columns)).min()
+        step = int(min(rows_min, columns_min))
         logger.info("Inferred matrix resolution: {res}".format(res=step))
     chr1_min_value = 0 if ignore_empty_start else chr1_min_value
     chr2_min_value = 0 if ignore_empty_start else chr2_min_value
@@ -53,49 +125,154 @@ def read_hic_export(file_name, step=None, ignore_empty_start=True, symmetrical=T
     logger.info("Chr2 (columns) range from: {start} to {end} with step {step}".format(start=chr2_min_value,
                                                                                       end=chr2_max_value,
                                                                                       step=step))
-    df = pd.DataFrame(0, index=np.arange(chr1_min_value, chr1_max_value, step),
-                      columns=np.arange(chr2_min_value, chr2_max_value, step))
-    total_records_length = len(data)
-    ticks = [int(total_records_length * (i / 10.0)) for i in range(0, 11, 1)]
-    for cnt, (row_id, column_id, value) in enumerate(data):
-        if cnt in ticks:
-            logger.info("Assigned {cnt}% of values".format(cnt=ticks.index(cnt) * 10))
-        value = 0.0 if np.isnan(value) else value
-        df.set_value(row_id, column_id, value)
-        df.set_value(column_id, row_id, value)
-    logger.info("Assigned 100% of values")
-    return df
+    expected = None
+    if data != "observed":
+        logger.info("Computing expected values")
+        expected = compute_expected(rows, columns, values, step, intra=symmetrical)
+        if data in ("oe", "pearson"):
+            values = observed_over_expected(rows, columns, values, step, intra=symmetrical, expected=expected)
+    logger.info("Bucketing {r_cnt} records by matrix rows".format(r_cnt=len(rows)))
+    return SparseExport(rows=(rows - chr1_min_value) // step,
+                        columns=(columns - chr2_min_value) // step,
+                        values=np.asarray(values),
+                        row_labels=np.arange(chr1_min_value, chr1_max_value + step, step),
+                        column_labels=np.arange(chr2_min_value, chr2_max_value + step, step),
+                        symmetrical=symmetrical,
+                        data=data,
+                        expected=expected)
+
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+
+class CompressorWriter(object):
+    """ Text writer, that compresses data with a (bz2 or lzma) compressor object into a binary file object """
+
+    def __init__(self, output, compressor):
+        """
+        :param output: path to write to, "-" for stdout
+        """
+        self._own = output != "-"
+        self._dest = open(output, "wb") if self._own else (sys.stdout.buffer if hasattr(sys.stdout, "buffer") else sys.stdout)
+        self._compressor = compressor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self._dest.write(self._compressor.compress(data))
+
+    def close(self):
+        self._dest.write(self._compressor.flush())
+        if self._own:
+            self._dest.close()
+        else:
+            self._dest.flush()
+
+
+def infer_compression(path, compression):
+    """ Compression of an output: the one of its extension for "infer" (none for stdout), None for "none" """
+    if compression == "infer":
+        return next((inferred for suffix, inferred in COMPRESSION_SUFFIXES.items() if path != "-" and path.endswith(suffix)), None)
+    return None if compression == "none" else compression
+
+
+def open_output(path, compression, threads=1):
+    """ gzip output is written as BGZF blocks, compressed in threads, with a block index next to it (see bgzf.py) """
+    if compression in (None, "gzip"):
+        return open_text_output(path, compression=compression, threads=threads)
+    return CompressorWriter(path, bz2.BZ2Compressor() if compression == "bz2" else lzma.LZMACompressor())
+
+
+def write_dense(export, dest, separator="\t", upper_triangular=False, block_rows=1000):
+    """ Writes a sparse export as a dense matrix (with genomic positions as a header and as a first column) block by block """
+    print(separator.join([""] + [str(label) for label in export.column_labels]), file=dest)
+    rows_cnt = export.shape[0]
+    written_cnt, reported = 0, 0
+    debug_blocks = logger.isEnabledFor(logging.DEBUG)
+    for labels, block in export.dense_blocks(block_rows=block_rows, upper_triangular=upper_triangular):
+        if debug_blocks:
+            logger.debug("Writing rows {first} to {last} ({nnz} non zero values)".format(first=labels[0], last=labels[-1], nnz=np.count_nonzero(block)))
+        dest.write(pd.DataFrame(block, index=labels).to_csv(sep=separator, header=False))
+        written_cnt += len(labels)
+        if written_cnt * 10 // rows_cnt > reported:
+            reported = written_cnt * 10 // rows_cnt
+            logger.info("Written {cnt}% of rows".format(cnt=reported * 10))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("sparse_contact_matrix", type=argparse.FileType("rt"), default=sys.stdin)
-    parser.add_argument("-o", "--output", default=sys.stdout, type=argparse.FileType("wt"))
+    parser.add_argument("sparse_contact_matrix", type=str,
+                        help="Sparse Juicer dump (plain or gzip compressed), \"-\" for stdin, a genome store (see genome_store.py) or a .hic file")
+    parser.add_argument("-o", "--output", default="-", type=str)
     parser.add_argument("--ignore-empty-start", action="store_true", default=False)
-    parser.add_argument("--step", type=int, default=None)
+    parser.add_argument("--step", type=int, default=None,
+                        help="Matrix resolution, if a dump has a pyramid (see hic_dump.py), any of its resolutions can be requested")
     parser.add_argument("--diff-chromosomes", action="store_false", dest="same_chromosomes", default=True)
     parser.add_argument("--output-separator", default="\t")
     parser.add_argument("--output-upper-triangular", action="store_true", dest="upper_tria", default=False)
-    parser.add_argument("--compression", choices=["gzip", "bz2", "xz", None], default="gzip")
+    parser.add_argument("--no-dump-cache", action="store_false", dest="dump_cache", default=True)
+    parser.add_argument("--chromosomes", type=str, nargs=2, default=None, help="Chromosomes to read from a genome store or a .hic file")
+    parser.add_argument("--norm", type=str, choices=["NONE", "VC", "VC_SQRT", "KR", "ICE"], default="NONE",
+                        help="Normalization to read from a .hic file, raw (NONE) dumps are balanced natively (see balance.py), --step is required then")
+    parser.add_argument("--data", choices=DATA_TYPES, default="observed",
+                        help="Observed contacts, observed / expected, expected or Pearson correlations of observed / expected contacts, "
+                             "expected values are computed from the observed contacts")
+    parser.add_argument("--compression", choices=["infer", "gzip", "bz2", "xz", "none"], default="infer",
+                        help="Output compression, inferred from the output extension (.gz, .bz2, .xz) by default, stdout is not compressed then")
+    parser.add_argument("--compress-threads", type=int, default=multiprocessing.cpu_count(), help="Number of threads, compressing gzip output")
+    parser.add_argument("--block-rows", type=int, default=1000, help="Number of dense matrix rows to hold in memory at a time")
+    parser.add_argument("--logging", type=int, choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL], default=logging.INFO)
+    parser.add_argument("--metrics-out", type=str, default=None, help="Path to write a json report of per stage times, memory and counts to")
+    parser.add_argument("--profile", choices=PROFILERS, default=None, help="Profile the run with cProfile or with a sampling profiler")
+    parser.add_argument("--profile-out", type=str, default="sparse_to_tsv.prof",
+                        help="Path to write cProfile stats or sampled collapsed stacks to")
     args = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG,
+    if is_hic_file(args.sparse_contact_matrix) and (args.chromosomes is None or args.step is None):
+        parser.error("--chromosomes and --step are required for reading from a .hic file")
+    if is_genome_store(args.sparse_contact_matrix) and args.chromosomes is None:
+        parser.error("--chromosomes are required for reading from a genome store")
+    if args.data == "pearson" and not args.same_chromosomes:
+        parser.error("Pearson correlations are only computed for intra chromosomal contacts")
+    if args.norm != "NONE" and (args.step is None or args.sparse_contact_matrix == "-"):
+        parser.error("--step and a dump path are required for balancing")
+    compression = infer_compression(args.output, args.compression)
+    if compression == "xz" and lzma is None:
+        parser.error("xz compression requires the lzma module (python 3)")
+    logging.basicConfig(level=args.logging,
                         format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
                         datefmt='%m-%d %H:%M')
     logger = logging.getLogger("sparse_to_csv")
-    logger.setLevel(logging.DEBUG)
-    logger.info("Processing file {file_name}".format(file_name=args.sparse_contact_matrix.name))
+    logger.setLevel(args.logging)
+    logger.info("Processing file {file_name}".format(file_name=args.sparse_contact_matrix))
     if args.step is None:
         logger.info("Matrix resolution is not specified, will be inferred")
     else:
         logger.info("Matrix resolution is specified at {res}".format(res=args.step))
-    df = read_hic_export(file_name=args.sparse_contact_matrix,
-                         step=args.step,
-                         ignore_empty_start=args.ignore_empty_start,
-                         symmetrical=args.same_chromosomes)
-    df = df.fillna(0.0)
-    if args.upper_tria:
-        logger.info("Substituting all the data from lower triangle of the matrix with zeros")
-        df = df.where(np.triu(np.ones(df.shape)).astype(np.bool)).fillna(0)
-    logger.info("Writing matrix down tyo {output}".format(output=args.output.name))
-    df.to_csv(path_or_buf=args.output, sep=args.output_separator, compression=args.compression)
-    logger.info("All done. Full matrix is written to {output}".format(output=args.output.name))
+    metrics = Metrics()
+    with profiling(args.profile, args.profile_out):
+        with metrics.stage("load", items="hic_records") as counts:
+            export = read_hic_export(file_name=sys.stdin if args.sparse_contact_matrix == "-" else args.sparse_contact_matrix,
+                                     step=args.step,
+                                     ignore_empty_start=args.ignore_empty_start,
+                                     symmetrical=args.same_chromosomes,
+                                     use_cache=args.dump_cache,
+                                     chromosomes=args.chromosomes,
+                                     norm=args.norm,
+                                     data=args.data)
+            counts["hic_records"] = len(export.values)
+        if args.upper_tria:
+            logger.info("Substituting all the data from lower triangle of the matrix with zeros")
+        logger.info("Writing matrix down to {output}".format(output=args.output))
+        with metrics.stage("output", items="rows") as counts:
+            with open_output(args.output, compression, threads=args.compress_threads) as dest:
+                write_dense(export=export, dest=dest, separator=args.output_separator, upper_triangular=args.upper_tria, block_rows=args.block_rows)
+            counts["rows"], counts["columns"] = export.shape
+    if args.metrics_out is not None:
+        metrics.write(args.metrics_out)
+    logger.info("All done. Full matrix is written to {output}".format(output=args.output))
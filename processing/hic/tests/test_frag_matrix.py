@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import io
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frag_matrix import FragmentBins, compute_frag_matrix, count_contacts, load_hic_data, resize_hic_data  # noqa: E402
+from fragment_catalog import Fragment, FragmentCatalog  # noqa: E402
+
+STEP = 1000
+
+
+def _fragments(rng, chromosome, cnt):
+    """ Fragments with gaps between them, from ones within a single bin to ones of several bins,
+    starts and ends are multiples of 125, so that fractions of bins (and contacts) are exact binary floats
+    """
+    fragments, position = [], 0
+    for number in range(cnt):
+        position += 125 * rng.randint(0, 20)
+        length = 125 * rng.randint(1, 60)
+        fragments.append(Fragment(name="{c}_f{n:02d}".format(c=chromosome, n=number), start=position, end=position + length, chromosome=chromosome))
+        position += length
+    return fragments
+
+
+def _records(rng, rows_cnt, columns_cnt, intra):
+    return {(row, column): float(rng.randint(0, 40)) for row in range(rows_cnt) for column in range(columns_cnt)
+            if (not intra or column >= row) and rng.random() < 0.2}
+
+
+def _bins(fragment, measure):
+    """ (bin, multiplier) of bins overlapped by a fragment, a multiplier is an int, unless it is a fraction of a bin """
+    result = []
+    first = fragment.start // STEP
+    for index in range(first, max(-(-fragment.end // STEP), first)):
+        overlap = min(fragment.end, (index + 1) * STEP) - max(fragment.start, index * STEP)
+        if measure == "outer":
+            result.append((index, 1))
+        elif measure == "inner":
+            result.append((index, int(overlap == STEP)))
+        else:
+            result.append((index, 1 if overlap == STEP else overlap / STEP))
+    return result
+
+
+def _brute_force(records, fragments1, fragments2, measure):
+    """ Per bin contacts, totals and numbers of hic entries of every pair of fragments, keyed by (sorted) names,
+    rows are bins of a fragment of a pair, that comes first, when iterating over fragments1 x fragments2
+    """
+    result = {}
+    for fragment1 in fragments1:
+        for fragment2 in fragments2:
+            key = tuple(sorted([fragment1.name, fragment2.name]))
+            if key in result:
+                continue
+            matrix, total, entries = [], 0, 0
+            for index1, multiplier1 in _bins(fragment1, measure):
+                row = []
+                for index2, multiplier2 in _bins(fragment2, measure):
+                    row.append(records.get((index1, index2), 0) * multiplier1 * multiplier2)
+                    entries += int((index1, index2) in records)
+                total += sum(row)
+                matrix.append(row)
+            result[key] = (matrix, total, entries)
+    return result
+
+
+def _expected_lines(reference, contact, write_zeros):
+    lines = []
+    for (name1, name2), (matrix, total, entries) in sorted(reference.items()):
+        if entries == 0 and not write_zeros:
+            continue
+        if contact == "value":
+            lines.append("\t".join([name1, name2, str(total)]))
+        else:
+            lines.append("\t".join([name1, name2, str(len(matrix))] + ["\t".join(str(value) for value in row) for row in matrix]))
+    return lines
+
+
+def _write_dump(path, records):
+    with open(path, "wt") as dest:
+        for (row, column), value in sorted(records.items()):
+            print(row * STEP, column * STEP, value, sep="\t", file=dest)
+    return path
+
+
+@pytest.fixture(scope="module")
+def genome(tmpdir_factory):
+    rng = random.Random(7)
+    fragments = {"1": _fragments(rng, "1", 25), "2": _fragments(rng, "2", 20)}
+    bins_cnt = {chromosome: max(fragment.end for fragment in chromosome_fragments) // STEP + 1
+                for chromosome, chromosome_fragments in fragments.items()}
+    directory = tmpdir_factory.mktemp("dumps")
+    dumps = {}
+    for chr1, chr2 in [("1", "1"), ("1", "2")]:
+        records = _records(rng, bins_cnt[chr1], bins_cnt[chr2], intra=chr1 == chr2)
+        dumps[(chr1, chr2)] = (_write_dump(str(directory.join("cl_{c1}_{c2}_{step}_NONE.txt".format(c1=chr1, c2=chr2, step=STEP))), records), records)
+    return fragments, dumps
+
+
+@pytest.mark.parametrize("measure", ["inner", "outer", "fractions"])
+@pytest.mark.parametrize("chromosomes", [("1", "1"), ("1", "2")])
+def test_count_contacts(genome, measure, chromosomes):
+    fragments, dumps = genome
+    dump_path, records = dumps[chromosomes]
+    fragments1, fragments2 = fragments[chromosomes[0]], fragments[chromosomes[1]]
+    bins1, bins2 = FragmentBins(fragments1, step=STEP, measure=measure), FragmentBins(fragments2, step=STEP, measure=measure)
+    hic_data = resize_hic_data(hic_data=load_hic_data(dump_path, step=STEP, use_cache=False), shape=(bins1.bins_cnt, bins2.bins_cnt))
+    totals, observed = count_contacts(hic_data=hic_data, bins1=bins1, bins2=bins2)
+    totals, observed = totals.toarray(), observed.toarray()
+    for i, fragment1 in enumerate(fragments1):
+        for j, fragment2 in enumerate(fragments2):
+            (_, total, entries), = _brute_force(records, [fragment1], [fragment2], measure).values()
+            assert totals[i, j] == total
+            assert observed[i, j] == entries
+
+
+@pytest.mark.parametrize("measure", ["inner", "outer", "fractions"])
+@pytest.mark.parametrize("contact", ["value", "matrix"])
+@pytest.mark.parametrize("chromosomes", [("1", "1"), ("1", "2")])
+@pytest.mark.parametrize("write_zeros", [False, True])
+def test_text_output(genome, measure, contact, chromosomes, write_zeros):
+    fragments, dumps = genome
+    dump_path, records = dumps[chromosomes]
+    catalog = FragmentCatalog.from_fragments(fragments["1"] + fragments["2"])
+    output = io.StringIO()
+    compute_frag_matrix(hic=dump_path, fragments=catalog, fragments_filename="fragments.txt", output=output, measure=measure, contact=contact,
+                        write_zeros=write_zeros, use_cache=False)
+    lines = [line for line in output.getvalue().splitlines() if not line.startswith("#")]
+    reference = _brute_force(records, fragments[chromosomes[0]], fragments[chromosomes[1]], measure)
+    assert lines == _expected_lines(reference, contact, write_zeros)
+    assert np.any([entries > 0 for _, _, entries in reference.values()])
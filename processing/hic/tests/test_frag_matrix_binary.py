@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import io
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frag_matrix import compute_frag_matrix  # noqa: E402
+from frag_matrix_binary import BinaryContacts  # noqa: E402
+from fragment_catalog import Fragment, FragmentCatalog  # noqa: E402
+
+BIN_SIZE = 1000
+
+
+def _fragments(rng):
+    """ Fragments of a chromosome, from ones shorter than a bin to ones of a dozen of bins, with gaps between them """
+    fragments, position = [], 0
+    for number in range(40):
+        position += rng.randint(0, 3000)
+        length = rng.randint(100, 12000)
+        fragments.append(Fragment(name="f{n}".format(n=number), start=position, end=position + length, chromosome="1"))
+        position += length
+    return fragments, position
+
+
+def _write_dump(path, rng, bins_cnt, density):
+    with open(path, "wt") as dest:
+        for row in range(bins_cnt):
+            for column in range(row, bins_cnt):
+                if rng.random() < density:
+                    # a few stored zeros, which are reported as floats
+                    print(row * BIN_SIZE, column * BIN_SIZE, float(rng.choice([0, rng.randint(1, 50)])), sep="\t", file=dest)
+
+
+@pytest.mark.parametrize("measure", ["inner", "outer", "fractions"])
+@pytest.mark.parametrize("write_zeros", [False, True])
+def test_binary_matches_text(tmpdir, measure, write_zeros):
+    rng = random.Random(len(measure) * 2 + int(write_zeros))
+    fragments, length = _fragments(rng)
+    dump_path = str(tmpdir.join("cl_1_1_{size}_NONE.txt".format(size=BIN_SIZE)))
+    _write_dump(dump_path, rng, bins_cnt=length // BIN_SIZE + 1, density=0.05)
+    outputs = {}
+    for contact in ["matrix", "value"]:
+        text = io.StringIO()
+        compute_frag_matrix(hic=dump_path, fragments=FragmentCatalog.from_fragments(fragments), fragments_filename="fragments.txt", output=text,
+                            measure=measure, contact=contact, write_zeros=write_zeros, use_cache=False)
+        outputs[contact] = text.getvalue()
+    binary_path = str(tmpdir.join("contacts.bin"))
+    compute_frag_matrix(hic=dump_path, fragments=FragmentCatalog.from_fragments(fragments), fragments_filename="fragments.txt", output=binary_path,
+                        measure=measure, write_zeros=write_zeros, use_cache=False, output_format="binary")
+    contacts = BinaryContacts(binary_path)
+    for contact, expected in outputs.items():
+        text = io.StringIO()
+        contacts.to_text(text, contact=contact)
+        assert text.getvalue() == expected
+    # only hic entries are stored, so the binary file is smaller than the text matrix output
+    assert os.path.getsize(binary_path) < len(outputs["matrix"].encode("utf-8"))
+    matrix = contacts.matrix("f1", "f0")
+    assert matrix is None or np.array_equal(matrix, contacts.matrix("f0", "f1").T)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fragment_catalog import Fragment, FragmentCatalog, load_fragment_catalog  # noqa: E402
+
+
+def _random_fragments(rng):
+    """ Fragments of two chromosomes in an unsorted order, of very different lengths, so that short ones are nested in long ones """
+    fragments = []
+    for number in range(300):
+        chromosome = rng.choice(["1", "2"])
+        start = rng.randint(0, 100000)
+        fragments.append(Fragment(name="f{n}".format(n=number), start=start, end=start + rng.choice([10, 500, 20000]), chromosome=chromosome))
+    return fragments
+
+
+def _brute_force(fragments, start, end):
+    return [index for index, fragment in enumerate(fragments) if fragment.start < end and fragment.end > start]
+
+
+def test_overlapping(tmpdir):
+    rng = random.Random(1)
+    fragments = _random_fragments(rng)
+    fragments_path = str(tmpdir.join("fragments.txt"))
+    with open(fragments_path, "wt") as dest:
+        for fragment in fragments:
+            print(fragment.name, fragment.start, fragment.end, fragment.chromosome, sep="\t", file=dest)
+    mapped = load_fragment_catalog(fragments_path)
+    assert mapped.path is not None
+    for catalog in [FragmentCatalog.from_fragments(fragments), mapped]:
+        for chromosome in ["1", "2"]:
+            chromosome_fragments = list(catalog.fragments(chromosome))
+            for _ in range(100):
+                start = rng.randint(-1000, 120000)
+                end = start + rng.randint(1, 30000)
+                assert catalog.overlapping(chromosome, start, end).tolist() == _brute_force(chromosome_fragments, start, end)
+            for bin_index in range(25):
+                assert catalog.bin_fragments(chromosome, bin_index, 5000).tolist() == \
+                    _brute_force(chromosome_fragments, bin_index * 5000, (bin_index + 1) * 5000)
+        assert len(catalog.overlapping("3", 0, 100000)) == 0
+        assert catalog.overlapping("1", 0, 0).dtype == np.int64
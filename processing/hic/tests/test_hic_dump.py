@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hic_dump import load_dump_resolution  # noqa: E402
+from sparse_to_tsv import read_hic_export  # noqa: E402
+
+RECORDS = [(0, 0, 1.0), (0, 1000, 2.0), (1000, 4000, 3.0), (4000, 4000, 4.0), (4000, 5000, 5.0), (5000, 9000, 6.0)]
+
+
+def _write_dump(path):
+    with open(path, "wt") as dest:
+        for row, column, value in RECORDS:
+            print(row, column, value, sep="\t", file=dest)
+    return path
+
+
+def test_coarse_resolution_from_file_name(tmpdir):
+    dump_path = _write_dump(str(tmpdir.join("cl_1_1_1000_NONE.txt")))
+    rows, columns, values = load_dump_resolution(dump_path, bin_size=5000, use_cache=False)
+    assert list(zip(rows.tolist(), columns.tolist(), values.tolist())) == [(0, 0, 10.0), (0, 5000, 5.0), (5000, 5000, 6.0)]
+
+
+def test_unknown_dump_resolution(tmpdir):
+    dump_path = _write_dump(str(tmpdir.join("dump.txt")))
+    with pytest.raises(ValueError):
+        load_dump_resolution(dump_path, bin_size=5000, use_cache=False)
+    rows, _, _ = load_dump_resolution(dump_path, bin_size=1000, use_cache=False)
+    assert len(rows) == len(RECORDS)
+
+
+def test_dense_matrix_sums_records(tmpdir):
+    dump_path = _write_dump(str(tmpdir.join("cl_1_1_1000_NONE.txt")))
+    export = read_hic_export(dump_path, step=5000, use_cache=False)
+    block = np.concatenate([block for _, block in export.dense_blocks(block_rows=1)])
+    assert np.array_equal(block, [[10.0, 5.0], [5.0, 6.0]])
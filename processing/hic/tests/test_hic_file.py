@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import os
+import random
+import struct
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hic_file import HicFile, HicFormatError  # noqa: E402
+
+BIN_SIZE = 1000
+BLOCK_BIN_CNT = 4
+CHROMOSOMES = [("ALL", 100), ("1", 60000), ("2", 40000)]
+
+
+def _string(value):
+    return value.encode("utf-8") + b"\0"
+
+
+def _block(version, records, block_type, float_counts):
+    """ A compressed block of (x, y, count) records, either as a list of rows (type 1) or as a dense grid (type 2) """
+    x_offset, y_offset = min(x for x, _, _ in records), min(y for _, y, _ in records)
+    count_format = "<f" if float_counts else "<h"
+    data = struct.pack("<iiib", len(records), x_offset, y_offset, 1 if float_counts else 0)
+    if version > 8:
+        data += struct.pack("<bb", 0, 0)  # short x and y positions
+    data += struct.pack("<b", block_type)
+    if block_type == 1:
+        rows = {}
+        for x, y, count in records:
+            rows.setdefault(y - y_offset, []).append((x - x_offset, count))
+        data += struct.pack("<h", len(rows))
+        for y, cells in sorted(rows.items()):
+            data += struct.pack("<hh", y, len(cells))
+            data += b"".join(struct.pack("<h", x) + struct.pack(count_format, count) for x, count in cells)
+    else:
+        width = max(x for x, _, _ in records) - x_offset + 1
+        height = max(y for _, y, _ in records) - y_offset + 1
+        grid = [float("nan") if float_counts else -32768] * (width * height)
+        for x, y, count in records:
+            grid[(y - y_offset) * width + x - x_offset] = count
+        data += struct.pack("<ih", len(grid), width) + b"".join(struct.pack(count_format, count) for count in grid)
+    return zlib.compress(data)
+
+
+def write_hic(path, version, records, norms, block_type=1, float_counts=False):
+    """ Writes a minimal .hic file with a single BP resolution
+
+    :param records: dict of (chromosome index 1, chromosome index 2) -> list of (bin x, bin y, count)
+    :param norms: dict of (normalization, chromosome index) -> list of values
+    """
+    long_format = "<q" if version > 8 else "<i"
+    data = bytearray(b"HIC\0" + struct.pack("<iq", version, 0) + _string("hg19"))
+    if version > 8:
+        data += struct.pack("<qq", 0, 0)
+    data += struct.pack("<i", 1) + _string("software") + _string("test")
+    data += struct.pack("<i", len(CHROMOSOMES))
+    for name, length in CHROMOSOMES:
+        data += _string(name) + struct.pack(long_format, length)
+    data += struct.pack("<iii", 1, BIN_SIZE, 0)
+    column_cnt = max(length for _, length in CHROMOSOMES) // BIN_SIZE // BLOCK_BIN_CNT + 1
+    matrices = {}
+    for (index1, index2), pair_records in sorted(records.items()):
+        blocks = {}
+        for x, y, count in pair_records:
+            blocks.setdefault(y // BLOCK_BIN_CNT * column_cnt + x // BLOCK_BIN_CNT, []).append((x, y, count))
+        matrix = struct.pack("<iii", index1, index2, 1) + _string("BP") + struct.pack("<iffffiiii", 0, 0, 0, 0, 0, BIN_SIZE, BLOCK_BIN_CNT,
+                                                                                       column_cnt, len(blocks))
+        for number, block_records in sorted(blocks.items()):
+            block = _block(version, block_records, block_type, float_counts)
+            matrix += struct.pack("<iqi", number, len(data), len(block))
+            data += block
+        matrices[(index1, index2)] = (len(data), len(matrix))
+        data += matrix
+    value_format = "<f" if version > 8 else "<d"
+    footer = struct.pack("<i", len(matrices))
+    for (index1, index2), (position, size) in sorted(matrices.items()):
+        footer += _string("{i1}_{i2}".format(i1=index1, i2=index2)) + struct.pack("<qi", position, size)
+    # a single expected values vector of 3 values with a scale factor of a single chromosome
+    footer += struct.pack("<i", 1) + _string("BP") + struct.pack("<i", BIN_SIZE) + struct.pack(long_format, 3)
+    footer += struct.pack(value_format, 0) * 3 + struct.pack("<ii", 1, 0) + struct.pack(value_format, 0)
+    struct.pack_into("<q", data, 8, len(data))
+    # as in Juicer, the footer length only covers the master index and expected values
+    data += struct.pack(long_format, len(footer)) + footer
+    # normalized expected values (a long vector, so that the index does not fit a single read) and the normalization vectors index
+    # follow the footer, normalization vectors are stored after them
+    normalized_expected = struct.pack("<i", 1) + _string("KR") + _string("BP") + struct.pack("<i", BIN_SIZE) + struct.pack(long_format, 20000)
+    normalized_expected += struct.pack(value_format, 1) * 20000 + struct.pack("<i", 0)
+    vectors = [(norm, index, struct.pack(long_format, len(values)) + b"".join(struct.pack(value_format, value) for value in values))
+               for (norm, index), values in sorted(norms.items())]
+
+    def index_entries(position):
+        entries = struct.pack("<i", len(vectors))
+        for norm, index, vector in vectors:
+            entries += _string(norm) + struct.pack("<i", index) + _string("BP") + struct.pack("<iq", BIN_SIZE, position)
+            entries += struct.pack(long_format, len(vector))
+            position += len(vector)
+        return entries
+
+    norm_index_position = len(data)
+    norm_index = normalized_expected + index_entries(norm_index_position + len(normalized_expected) + len(index_entries(0)))
+    if version > 8:
+        struct.pack_into("<qq", data, 21, norm_index_position, len(norm_index))
+    data += norm_index + b"".join(vector for _, _, vector in vectors)
+    with open(path, "wb") as dest:
+        dest.write(bytes(data))
+
+
+def _random_records(rng, bins1, bins2, intra):
+    return [(x, y, rng.randint(1, 300)) for x in range(bins1) for y in range(bins2) if (not intra or y >= x) and rng.random() < 0.3]
+
+
+@pytest.mark.parametrize("version", [8, 9])
+@pytest.mark.parametrize("block_type, float_counts", [(1, False), (2, False), (2, True)])
+def test_records_and_norm_vectors(tmpdir, version, block_type, float_counts):
+    rng = random.Random(version * 10 + block_type)
+    records = {(1, 1): _random_records(rng, 60, 60, intra=True), (1, 2): _random_records(rng, 60, 40, intra=False)}
+    norms = {("KR", 1): [rng.uniform(0.5, 2) for _ in range(60)], ("KR", 2): [rng.uniform(0.5, 2) for _ in range(40)]}
+    path = str(tmpdir.join("test.hic"))
+    write_hic(path, version, records, norms, block_type=block_type, float_counts=float_counts)
+    norm_dtype = np.float32 if version > 8 else np.float64
+    with HicFile(path) as hic:
+        assert hic.version == version
+        assert hic.genome == "hg19"
+        assert hic.chromosomes == ["ALL", "1", "2"]
+        assert hic.bp_resolutions == [BIN_SIZE]
+        for chr1, chr2, key in [("1", "1", (1, 1)), ("chr1", "2", (1, 2))]:
+            positions1, positions2, values = hic.records(chr1, chr2, BIN_SIZE)
+            assert sorted(zip(positions1.tolist(), positions2.tolist(), values.tolist())) == \
+                sorted((x * BIN_SIZE, y * BIN_SIZE, float(count)) for x, y, count in records[key])
+        positions2, positions1, _ = hic.records("2", "1", BIN_SIZE)
+        assert sorted(zip(positions1.tolist(), positions2.tolist())) == sorted((x * BIN_SIZE, y * BIN_SIZE) for x, y, _ in records[(1, 2)])
+        positions1, positions2, _ = hic.records("1", "2", BIN_SIZE, region1=(10000, 20000), region2=(5000, 9000))
+        assert sorted(zip(positions1.tolist(), positions2.tolist())) == \
+            sorted((x * BIN_SIZE, y * BIN_SIZE) for x, y, _ in records[(1, 2)] if 10 <= x < 20 and 5 <= y < 9)
+        for (norm, index), values in norms.items():
+            assert np.array_equal(hic.norm_vector(str(index), BIN_SIZE, norm), np.array(values, dtype=norm_dtype).astype(np.float64))
+        positions1, positions2, values = hic.records("1", "2", BIN_SIZE, norm="KR")
+        norm1, norm2 = np.array(norms[("KR", 1)], dtype=norm_dtype), np.array(norms[("KR", 2)], dtype=norm_dtype)
+        expected = {(x * BIN_SIZE, y * BIN_SIZE): count / (float(norm1[x]) * float(norm2[y])) for x, y, count in records[(1, 2)]}
+        assert len(values) == len(expected)
+        for position1, position2, value in zip(positions1.tolist(), positions2.tolist(), values.tolist()):
+            assert value == pytest.approx(expected[(position1, position2)])
+        with pytest.raises(KeyError):
+            hic.norm_vector("1", BIN_SIZE, "VC")
+
+
+def test_not_a_hic_file(tmpdir):
+    path = tmpdir.join("test.hic")
+    path.write_binary(b"NOT A HIC FILE")
+    with pytest.raises(HicFormatError):
+        HicFile(str(path))
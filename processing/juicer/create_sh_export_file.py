@@ -2,9 +2,20 @@
 from __future__ import print_function, division
 
 import argparse
+import gzip
+import hashlib
+import json
 import logging
-
+import os
+import shlex
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger("creating_sh_export_file")
 
 HUMAN_CHROMOSOMES = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "X"]
 MOUSE_CHROMOSOMES = ["chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11", "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chrX"]
@@ -51,52 +62,243 @@ CELL_LINE_SOURCES = {
     "rudan15_rabbit2": "http://hicfiles.s3.amazonaws.com/external/rudan/rabbit-rep2.hic"
 }
 
+DUMP_COMMAND = "java -jar {juicebox_tools_path} dump {data} {norm} {source} {chr1} {chr2} BP {bin_size}"
+MANIFEST_NAME = "manifest.json"
+CHUNK_SIZE = 2 ** 20
+
+
+def get_chromosome_pairs(cell_line, chromosomes):
+    """ Pairs of chromosomes of a cell line to export: inter / intra chromosomal ones, or all of them """
+    result = []
+    if chromosomes == "inter" or chromosomes == "all":
+        observed = set()
+        for chr1 in CELL_LINES_CHROMOSOMES[cell_line]:
+            for chr2 in CELL_LINES_CHROMOSOMES[cell_line]:
+                c1, c2 = (chr1, chr2) if chr1 < chr2 else (chr2, chr1)
+                if (c1, c2) in observed:
+                    continue
+                if c1 == c2 and chromosomes == "inter":
+                    continue
+                result.append((c1, c2))
+                observed.add((c1, c2))
+    else:
+        result = [(c, c) for c in CELL_LINES_CHROMOSOMES[cell_line]]
+    return result
+
+
+def get_export_file_name(cell_line, chr1, chr2, bin_size, norm, compress=False):
+    c1 = chr1[3:] if chr1.startswith("chr") else chr1
+    c2 = chr2[3:] if chr2.startswith("chr") else chr2
+    return "{cell_line}_{chr1}_{chr2}_{bin_size}_{correction}.txt{suffix}".format(cell_line=cell_line.replace("_", "-"), chr1=c1, chr2=c2,
+                                                                                 bin_size=bin_size, correction=norm, suffix=".gz" if compress else "")
+
+
+def get_source(cell_line, hic=None, mirror=None):
+    """ Path or URL of a cell line .hic file: a local file, the same file under a mirror (a directory or a base URL),
+    that replicates the layout of the hicfiles bucket, or the original URL
+    """
+    if hic is not None:
+        return hic
+    source = CELL_LINE_SOURCES[cell_line]
+    if mirror is None:
+        return source
+    path = source.split("://", 1)[1].split("/", 1)[1]
+    return mirror.rstrip("/") + "/" + path
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _HashingWriter(object):
+    """ File object wrapper, that counts and hashes everything written through it """
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self.dest.write(data)
+
+    def flush(self):
+        self.dest.flush()
+
+
+class Manifest(object):
+    """ Json record of exported files (name -> size, sha256 checksum, command and completion time), rewritten on every update """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "rt") as source:
+                self.files = json.load(source)["files"]
+
+    def is_complete(self, output_path):
+        """ Whether an output file exists and matches its manifest entry in size and checksum """
+        entry = self.files.get(os.path.basename(output_path))
+        if entry is None or not os.path.exists(output_path) or os.path.getsize(output_path) != entry["size"]:
+            return False
+        return file_checksum(output_path) == entry["sha256"]
+
+    def add(self, output_path, size, checksum, command):
+        with self._lock:
+            self.files[os.path.basename(output_path)] = {"size": size, "sha256": checksum, "command": command,
+                                                         "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wt") as dest:
+                json.dump({"files": self.files}, dest, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+
+
+def run_dump(command, output_path, compress=True):
+    """ Runs a dump command, that writes a dump to its stdout, and streams it to output_path (gzip compressed, if requested)
+
+    Output is written to "<output_path>.partial" and renamed on success.
+
+    :return: size and sha256 checksum of the output file
+    """
+    partial_path = output_path + ".partial"
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=errors)
+        with open(partial_path, "wb") as raw:
+            writer = _HashingWriter(raw)
+            dest = gzip.GzipFile(filename="", mode="wb", fileobj=writer, mtime=0) if compress else writer
+            for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):
+                dest.write(chunk)
+            if compress:
+                dest.close()
+        process.stdout.close()
+        if process.wait() != 0:
+            errors.seek(0)
+            message = " ".join(errors.read().decode("utf-8", "replace").strip().splitlines()[-3:])
+            os.remove(partial_path)
+            raise RuntimeError("Dump command exited with code {code}{message}".format(code=process.returncode,
+                                                                                   message=": " + message if len(message) > 0 else ""))
+    os.rename(partial_path, output_path)
+    return writer.size, writer.digest.hexdigest()
+
+
+def _export(job, manifest, compress, retries, retry_delay):
+    command, output_path = job
+    for attempt in range(retries + 1):
+        start_time = time.time()
+        try:
+            size, checksum = run_dump(command, output_path, compress=compress)
+        except (IOError, OSError, RuntimeError) as error:
+            logger.warning("Attempt {attempt} of {output} failed: {error}".format(attempt=attempt + 1, output=os.path.basename(output_path), error=error))
+            if attempt < retries:
+                time.sleep(retry_delay * 2 ** attempt)
+            last_error = error
+            continue
+        manifest.add(output_path, size, checksum, command)
+        logger.info("Exported {output} ({size:.1f} Mb) in {elapsed:.1f}s".format(output=os.path.basename(output_path), size=size / 2 ** 20,
+                                                                                  elapsed=time.time() - start_time))
+        return output_path, None
+    return output_path, str(last_error)
+
+
+def run_exports(jobs, output_dir, workers, compress=True, retries=2, retry_delay=10.0):
+    """ Runs (dump command, output path) jobs with at most workers concurrent dump commands
+
+    Outputs, that are recorded in the output directory manifest with a matching size and checksum, are skipped,
+    failed jobs are retried with an exponentially growing delay.
+
+    :return: dict of output path -> error message (None for exported and skipped outputs)
+    """
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    results, pending = {}, []
+    for command, output_path in jobs:
+        if manifest.is_complete(output_path):
+            logger.info("Skipping {output}, it is already exported".format(output=os.path.basename(output_path)))
+            results[output_path] = None
+        else:
+            pending.append((command, output_path))
+    logger.info("Exporting {p_cnt} of {j_cnt} chromosome pairs with {w_cnt} workers".format(p_cnt=len(pending), j_cnt=len(jobs), w_cnt=workers))
+    pool = ThreadPool(processes=workers)
+    try:
+        for output_path, error in pool.imap_unordered(lambda job: _export(job, manifest, compress, retries, retry_delay), pending):
+            results[output_path] = error
+            if error is not None:
+                logger.error("Failed to export {output}: {error}".format(output=os.path.basename(output_path), error=error))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["script", "run"], default="script",
+                        help="Either write an sbatch script, that runs dumps one after another, or run them here with a pool of workers")
     parser.add_argument("--cell-line", type=str, choices=CELL_LINES_CHROMOSOMES.keys(), required=True)
     parser.add_argument("--chromosomes", type=str, choices=["inter", "intra", "all"], required=True)
     parser.add_argument("--data", type=str, choices=["observed", "oe", "pearson", "norm", "expected"], default="observed")
     parser.add_argument("--norm", type=str, choices=["NONE", "VC", "VC_SQRT", "KR"], default="KR")
     parser.add_argument("--bin-size", type=str, default="5000")
-    parser.add_argument("--juicebox-tools-path", type=str, required=True)
+    parser.add_argument("--juicebox-tools-path", type=str, default=None, help="Required, unless a custom --dump-command is given")
+    parser.add_argument("--hic", type=str, default=None, help="Local .hic file to export from, rather than the cell line source URL")
+    parser.add_argument("--mirror", type=str, default=None,
+                        help="Directory or base URL, that mirrors the hicfiles bucket, to read the cell line .hic file from")
     parser.add_argument("--job-name", default="", type=str)
-    parser.add_argument("-o", "--output", default=sys.stdout, type=argparse.FileType("wt"))
-    logger = logging.getLogger("creating_sh_export_file")
+    parser.add_argument("--time", default="6:00:00", type=str)
+    parser.add_argument("-o", "--output", default=sys.stdout, type=argparse.FileType("wt"), help="Script to write in \"script\" mode")
+    parser.add_argument("--output-dir", type=str, default=".", help="Directory to export dumps (and the manifest) to in \"run\" mode")
+    parser.add_argument("--workers", type=int, default=4, help="Number of concurrent dump commands in \"run\" mode")
+    parser.add_argument("--retries", type=int, default=2, help="Number of retries of a failed dump in \"run\" mode")
+    parser.add_argument("--retry-delay", type=float, default=10.0, help="Delay (in seconds) before the first retry, doubled for every next one")
+    parser.add_argument("--no-compress", action="store_false", dest="compress", default=True,
+                        help="Write plain text dumps in \"run\" mode, rather than gzip compressed ones")
+    parser.add_argument("--dump-command", type=str, default=DUMP_COMMAND,
+                        help="Command, that writes a dump to stdout in \"run\" mode, with {juicebox_tools_path}, {data}, {norm}, {source}, {chr1}, "
+                             "{chr2} and {bin_size} placeholders")
+    parser.add_argument("--logging", type=int, choices=[logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL], default=logging.INFO)
     args = parser.parse_args()
-    chromosomes = []
-    if args.chromosomes == "inter" or args.chromosomes == "all":
-        observed = set()
-        for chr1 in CELL_LINES_CHROMOSOMES[args.cell_line]:
-            for chr2 in CELL_LINES_CHROMOSOMES[args.cell_line]:
-                c1, c2 = (chr1, chr2) if chr1 < chr2 else (chr2, chr1)
-                if (c1, c2) in observed:
-                    continue
-                if c1 == c2 and args.chromosomes == "inter":
-                    continue
-                chromosomes.append((c1, c2))
-                observed.add((c1, c2))
-    else:
-        chromosomes = [(c, c) for c in CELL_LINES_CHROMOSOMES[args.cell_line]]
+    if args.juicebox_tools_path is None and (args.mode == "script" or args.dump_command == DUMP_COMMAND):
+        parser.error("--juicebox-tools-path is required")
+    logging.basicConfig(level=args.logging,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S')
+    logger.setLevel(args.logging)
+    chromosomes = get_chromosome_pairs(args.cell_line, args.chromosomes)
+    source = get_source(args.cell_line, hic=args.hic, mirror=args.mirror)
+    if args.mode == "run":
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        jobs = [(args.dump_command.format(juicebox_tools_path=args.juicebox_tools_path, data=args.data, norm=args.norm, source=source,
+                                          chr1=chr1, chr2=chr2, bin_size=args.bin_size),
+                 os.path.join(args.output_dir, get_export_file_name(args.cell_line, chr1, chr2, args.bin_size, args.norm, compress=args.compress)))
+                for chr1, chr2 in chromosomes]
+        start_time = time.time()
+        results = run_exports(jobs, args.output_dir, workers=args.workers, compress=args.compress, retries=args.retries, retry_delay=args.retry_delay)
+        failed = [output_path for output_path, error in results.items() if error is not None]
+        logger.info("Exported {j_cnt} chromosome pairs in {elapsed:.1f}s, {failed_cnt} failed".format(j_cnt=len(results), elapsed=time.time() - start_time,
+                                                                                                    failed_cnt=len(failed)))
+        sys.exit(1 if len(failed) > 0 else 0)
     job_name = args.job_name
     if len(args.job_name) == 0:
         job_name = "_".join([args.cell_line.replace("_", "-"), args.chromosomes, args.data, args.norm, args.bin_size])
     print("#!/bin/sh", file=args.output)
     print("#SBATCH -p short", file=args.output)
-    print("#SBATCH -t 6:00:00")
+    print("#SBATCH -t {time}".format(time=args.time), file=args.output)
     print("#SBATCH -J {job_name}".format(job_name=job_name), file=args.output)
     print("#SBATCH -o {job_name}.out".format(job_name=job_name), file=args.output)
     print("#SBATCH -e {job_name}.err".format(job_name=job_name), file=args.output)
     print("module load jdk/1.8.0", file=args.output)
     for chr1, chr2 in chromosomes:
-        c1 = chr1[3:] if chr1.startswith("chr") else chr1
-        c2 = chr2[3:] if chr2.startswith("chr") else chr2
-        output_path = "{cell_line}_{chr1}_{chr2}_{bin_size}_{correction}.txt".format(cell_line=args.cell_line.replace("_", "-"),
-                                                                                     chr1=c1, chr2=c2, bin_size=args.bin_size,
-                                                                                     correction=args.norm)
+        output_path = get_export_file_name(args.cell_line, chr1, chr2, args.bin_size, args.norm)
         print("echo \"working with cell-line: {cell_line}; chromosome 1: {chr1}; chromosomes 2: {chr2}; resolution {bin_size}\""
               "".format(cell_line=args.cell_line, chr1=chr1, chr2=chr2, bin_size=args.bin_size), file=args.output)
         print("java -jar {juicebox_tools_path} dump {data} {correction} {path} {chr1} {chr2} BP {bin_size} {output_path}"
               "".format(juicebox_tools_path=args.juicebox_tools_path,
-                        data=args.data, correction=args.norm, path=CELL_LINE_SOURCES[args.cell_line],
+                        data=args.data, correction=args.norm, path=source,
                         chr1=chr1, chr2=chr2, bin_size=args.bin_size, output_path=output_path),
               file=args.output)
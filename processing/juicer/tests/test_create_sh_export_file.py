@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import gzip
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from create_sh_export_file import MANIFEST_NAME, file_checksum, run_exports  # noqa: E402
+
+DUMP = "0\t0\t1.0\n0\t5000\t2.0\n5000\t5000\t3.0\n"
+
+# fails as many times, as it is asked to (counting its runs in a file), then writes a dump to stdout
+STUB = """
+import sys
+counter_path, failures = sys.argv[1], int(sys.argv[2])
+try:
+    with open(counter_path) as source:
+        runs = int(source.read())
+except IOError:
+    runs = 0
+with open(counter_path, "w") as dest:
+    dest.write(str(runs + 1))
+if runs < failures:
+    sys.stderr.write("connection reset\\n")
+    sys.exit(1)
+sys.stdout.write({dump!r})
+""".format(dump=DUMP)
+
+
+def _stub_command(tmpdir, name, failures):
+    stub_path = tmpdir.join("stub.py")
+    if not stub_path.check():
+        stub_path.write(STUB)
+    return "\"{python}\" \"{stub}\" \"{counter}\" {failures}".format(python=sys.executable, stub=str(stub_path), counter=str(tmpdir.join(name + ".runs")),
+                                                                     failures=failures)
+
+
+def _runs(tmpdir, name):
+    counter_path = tmpdir.join(name + ".runs")
+    return int(counter_path.read()) if counter_path.check() else 0
+
+
+def test_retry_then_success(tmpdir):
+    output_path = str(tmpdir.join("cl_1_1_5000_KR.txt.gz"))
+    results = run_exports([(_stub_command(tmpdir, "1_1", failures=2), output_path)], str(tmpdir), workers=1, retries=2, retry_delay=0)
+    assert results == {output_path: None}
+    assert _runs(tmpdir, "1_1") == 3
+    assert not os.path.exists(output_path + ".partial")
+    with gzip.open(output_path, "rb") as source:
+        assert source.read().decode("utf-8") == DUMP
+    with open(str(tmpdir.join(MANIFEST_NAME))) as source:
+        entry = json.load(source)["files"][os.path.basename(output_path)]
+    assert entry["size"] == os.path.getsize(output_path)
+    assert entry["sha256"] == file_checksum(output_path)
+
+
+def test_retries_exhausted(tmpdir):
+    output_path = str(tmpdir.join("cl_1_2_5000_KR.txt"))
+    results = run_exports([(_stub_command(tmpdir, "1_2", failures=5), output_path)], str(tmpdir), workers=1, compress=False, retries=1, retry_delay=0)
+    assert "connection reset" in results[output_path]
+    assert _runs(tmpdir, "1_2") == 2
+    assert not os.path.exists(output_path)
+    assert not os.path.exists(output_path + ".partial")
+
+
+def test_manifest_skip(tmpdir):
+    exported_path, changed_path = str(tmpdir.join("cl_1_1_5000_KR.txt")), str(tmpdir.join("cl_2_2_5000_KR.txt"))
+    jobs = [(_stub_command(tmpdir, "1_1", failures=0), exported_path), (_stub_command(tmpdir, "2_2", failures=0), changed_path)]
+    assert run_exports(jobs, str(tmpdir), workers=2, compress=False, retry_delay=0) == {exported_path: None, changed_path: None}
+    with open(changed_path, "at") as dest:
+        dest.write("10000\t10000\t4.0\n")
+    assert run_exports(jobs, str(tmpdir), workers=2, compress=False, retry_delay=0) == {exported_path: None, changed_path: None}
+    # an output, that matches the manifest, is not exported again, a changed one is
+    assert _runs(tmpdir, "1_1") == 1
+    assert _runs(tmpdir, "2_2") == 2
+    with open(changed_path) as source:
+        assert source.read() == DUMP